@@ -0,0 +1,152 @@
+"""Замер пропускной способности хранилищ на сценариях обработчиков бота.
+
+Каждый сценарий повторяет обращения к хранилищу, которые делает обработчик
+(регистрация, анкета, /myschedule, «Как на прошлой неделе», отчет, /stats,
+воскресное напоминание), и одинаков для всех хранилищ.
+
+    python benchmark.py --users 500 --backends sqlite memory
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+from database import Database, UserCache
+from memory_storage import MemoryStorage
+
+TIME_SLOTS = ["9.00-15.00", "15.00-21.00", "Как нужно ПВЗ", "Выходной", "10:00-18:30"]
+
+
+def week_dates(monday):
+    """Даты недели "дд.мм" и понедельник ГГГГ-ММ-ДД"""
+    return [(monday + timedelta(days=i)).strftime("%d.%m") for i in range(7)], monday.isoformat()
+
+
+def create_storage(backend, directory):
+    if backend == 'memory':
+        return MemoryStorage()
+    storage = Database(os.path.join(directory, f'{backend}.db'))
+    storage.ensure_schema()
+    return storage
+
+
+def register(storage, user_id, pvz_id):
+    """start -> handle_password -> handle_full_name"""
+    storage.get_user(user_id)
+    storage.set_user_state(user_id, {'state': 'waiting_password'})
+    storage.get_user_state(user_id)
+    pvz = storage.get_pvz_by_password('1525')
+    storage.set_user_state(user_id, {'state': 'waiting_full_name', 'pvz_id': pvz_id, 'pvz_name': pvz[1]})
+    storage.get_user_state(user_id)
+    storage.add_user(user_id, f'user{user_id}', 'Имя', pvz_id, f'Сотрудник {user_id}')
+    storage.clear_user_state(user_id)
+
+
+def fill_form(storage, user_id, dates):
+    """send_form -> 7 ответов в черновик в памяти -> перенос в расписание
+
+    Черновик сохраняется в базу периодически; анкета, заполненная быстрее
+    FORM_DRAFT_FLUSH_INTERVAL, в базу его не пишет.
+    """
+    answers = {}
+    storage.get_form_draft(user_id, 48)
+    for i, day in enumerate(dates):
+        storage.get_user_schedule(user_id, [day])
+        answers[day] = TIME_SLOTS[(user_id + i) % len(TIME_SLOTS)]
+    storage.save_week_schedule(user_id, answers)
+    storage.get_user_schedule(user_id, dates)
+
+
+def my_schedule(storage, user_id, week_start):
+    """/myschedule и листание на неделю назад"""
+    schedule, previous_week, next_week = storage.get_user_week_schedule(user_id, week_start)
+    if previous_week:
+        storage.get_user_week_schedule(user_id, previous_week)
+
+
+def copy_week(storage, user_id, dates, week_start):
+    """«Как на прошлой неделе» и итог недели"""
+    storage.copy_previous_week(user_id, week_start)
+    storage.get_user_schedule(user_id, dates)
+
+
+def admin_report(storage, pvz_id, dates):
+    """Отчет, /stats и воскресное напоминание по ПВЗ"""
+    storage.get_pvz_schedule_version(pvz_id, dates)
+    storage.get_pvz_schedule_report(pvz_id, dates)
+    storage.get_pvz_stats(pvz_id, dates)
+    storage.get_filled_user_ids(pvz_id, dates)
+    storage.get_pvz_shifts(pvz_id, dates)
+
+
+def analytics(storage, pvz_id, since_week, live_weeks):
+    """/analytics: итоги завершенных недель (подсчитываются при первом вызове) и текущие недели"""
+    storage.refresh_fill_summary(pvz_id, since_week, live_weeks[0], 420)
+    storage.get_fill_analytics(pvz_id, since_week, live_weeks, 420, 3)
+
+
+def measure_cache_memory(storage):
+    """Объем кэша пользователей и ПВЗ после загрузки: (сотрудников, байт)"""
+    cache = UserCache(storage, ttl=60)
+    cache.preload()
+    return len(cache.users), cache.get_memory_size()
+
+
+def measure(name, calls, action):
+    started_at = time.perf_counter()
+    for args in calls:
+        action(*args)
+    elapsed = time.perf_counter() - started_at
+    return name, len(calls), elapsed
+
+
+def run(backend, users, weeks, directory):
+    storage = create_storage(backend, directory)
+    pvz_id = storage.get_pvz_by_password('1525')[0]
+    user_ids = list(range(1, users + 1))
+
+    # Недели в прошлом от ближайшего понедельника: история для листания и копирования
+    monday = date.today() - timedelta(days=date.today().weekday())
+    history = [week_dates(monday - timedelta(weeks=weeks - i)) for i in range(weeks)]
+    target_dates, target_week = week_dates(monday + timedelta(weeks=1))
+
+    results = [measure("регистрация", [(storage, user_id, pvz_id) for user_id in user_ids], register)]
+    cached_users, cache_size = measure_cache_memory(storage)
+    print(f"  кэш пользователей: {cached_users} сотрудников, {cache_size / 1024:.0f} КБ, "
+          f"{cache_size / max(cached_users, 1):.0f} байт на сотрудника")
+    for dates, week_start in history[:-1]:
+        for user_id in user_ids:
+            storage.save_week_schedule(user_id, {day: TIME_SLOTS[user_id % len(TIME_SLOTS)] for day in dates})
+    results.append(measure("анкета (7 дней)", [(storage, user_id, history[-1][0]) for user_id in user_ids], fill_form))
+    results.append(measure("/myschedule", [(storage, user_id, history[-1][1]) for user_id in user_ids], my_schedule))
+    results.append(measure(
+        "как на прошлой неделе",
+        [(storage, user_id, target_dates, target_week) for user_id in user_ids],
+        copy_week
+    ))
+    results.append(measure("отчет по ПВЗ", [(storage, pvz_id, target_dates)] * 20, admin_report))
+    results.append(measure(
+        "/analytics",
+        [(storage, pvz_id, history[0][1], [history[-1][1], target_week])] * 20,
+        analytics
+    ))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300, help="сотрудников в ПВЗ")
+    parser.add_argument('--weeks', type=int, default=8, help="недель истории расписания")
+    parser.add_argument('--backends', nargs='+', default=['sqlite', 'memory'], choices=['sqlite', 'memory'])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in args.backends:
+            print(f"\n{backend}: {args.users} сотрудников, {args.weeks} недель истории")
+            for name, count, elapsed in run(backend, args.users, args.weeks, directory):
+                print(f"  {name:<24}{count:>6} шт. {elapsed:>8.3f} с {count / elapsed:>10.0f} в секунду")
+
+
+if __name__ == '__main__':
+    main()
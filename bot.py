@@ -1,51 +1,203 @@
+import asyncio
+import json
 import logging
+import multiprocessing
 import os
-from datetime import datetime, timedelta
+import random
+import socket
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from database import Database
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, ReplyKeyboardMarkup, KeyboardButton, Message
+from telegram.error import RetryAfter
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, filters, ContextTypes
+from staffing import build_coverage_matrix, find_uncovered_intervals, format_minutes, render_coverage_grid
+from importer import IMPORT_COLUMNS, decode_import_file, parse_import_csv
+from logging_setup import log_context, setup_logging as setup_queued_logging
+from database import Database, UserCache, DEFAULT_TIMEZONE, SLOT_AS_NEEDED, SLOT_SHIFT
+from memory_storage import MemoryStorage
 
-# Загружаем переменные окружения
+# Загружаем переменные окружения (до чтения конфигурации ниже; уже
+# установленные переменные окружения не перезаписываются)
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_CHAT_ID = "457081438"  # Ваш chat_id
 
-# Проверка токена
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN не установлен в .env файле")
+# Уведомления администратору собираются в сводку раз в ADMIN_DIGEST_INTERVAL секунд.
+# ADMIN_NOTIFY_IMMEDIATE=1 - отправлять каждое уведомление сразу, как раньше
+ADMIN_DIGEST_INTERVAL = int(os.getenv('ADMIN_DIGEST_INTERVAL', '600'))
+ADMIN_NOTIFY_IMMEDIATE = os.getenv('ADMIN_NOTIFY_IMMEDIATE', '0') == '1'
+
+# Напоминания: как часто проверять расписание, насколько давние пропущенные
+# запуски догонять и как разносить отправку по ПВЗ (в секундах)
+REMINDER_CHECK_INTERVAL = int(os.getenv('REMINDER_CHECK_INTERVAL', '60'))
+REMINDER_CATCHUP_WINDOW = timedelta(hours=int(os.getenv('REMINDER_CATCHUP_HOURS', '12')))
+REMINDER_STAGGER = float(os.getenv('REMINDER_STAGGER', '2'))
+REMINDER_JITTER = float(os.getenv('REMINDER_JITTER', '30'))
+
+# Несколько процессов: BOT_WORKERS > 1 включает режим с процессом-диспетчером,
+# который получает обновления и раздает их рабочим процессам.
+# WEBHOOK_URL - получать обновления через вебхук вместо polling
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+
+# Сколько обновлений обрабатывается одновременно (обновления одного чата -
+# всегда строго по очереди)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '32'))
+
+# Ограничение очереди обновлений при наплыве (например, после субботнего
+# напоминания): сколько обновлений сотрудников может ждать и выполняться
+# одновременно и сколько секунд обновление может ждать своей очереди. Сверх
+# этого нажатия на кнопки получают ответ «бот занят» вместо обработки.
+# Обновления администратора не ограничиваются, и для них всегда остается
+# свободный слот обработки
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', '500'))
+UPDATE_MAX_WAIT = int(os.getenv('UPDATE_MAX_WAIT', '30'))
+BUSY_TEXT = "⏳ Бот сейчас перегружен, повторите через минуту"
+# Как часто (в секундах) писать в журнал метрики очереди обновлений
+UPDATE_METRICS_INTERVAL = int(os.getenv('UPDATE_METRICS_INTERVAL', '60'))
+# Обработка обновления дольше стольких миллисекунд пишется в журнал как
+# предупреждение (всегда); время остальных - на уровне DEBUG с выборкой
+SLOW_UPDATE_MS = int(os.getenv('SLOW_UPDATE_MS', '1000'))
+
+# Аналитика заполнения анкет (/analytics): сколько последних недель показывать
+# и со скольких пропущенных завершенных недель сотрудник попадает в список
+# постоянно не заполняющих
+ANALYTICS_WEEKS = int(os.getenv('ANALYTICS_WEEKS', '8'))
+ANALYTICS_MIN_MISSED = int(os.getenv('ANALYTICS_MIN_MISSED', '3'))
+
+# Аренда ведущего процесса: только он запускает напоминания и сводки
+SCHEDULER_LEASE = 'scheduler'
+SCHEDULER_LEASE_TTL = 3 * REMINDER_CHECK_INTERVAL
+
+# Норма сотрудников на получасовой блок для отчета /coverage
+COVERAGE_MIN_STAFF = int(os.getenv('COVERAGE_MIN_STAFF', '1'))
+COVERAGE_MAX_STAFF = int(os.getenv('COVERAGE_MAX_STAFF', '3'))
+
+# Сколько запросов на незакрытые смены отправляется одновременно
+GAP_REQUEST_CONCURRENCY = int(os.getenv('GAP_REQUEST_CONCURRENCY', '10'))
+
+# Через сколько часов брошенный черновик анкеты удаляется
+FORM_DRAFT_TTL_HOURS = int(os.getenv('FORM_DRAFT_TTL_HOURS', '48'))
+
+# Сколько дней хранится журнал изменений расписания (schedule_changes)
+SCHEDULE_CHANGES_RETENTION_DAYS = int(os.getenv('SCHEDULE_CHANGES_RETENTION_DAYS', '90'))
+
+# Раз в сколько секунд измененные черновики анкет сохраняются в базу
+FORM_DRAFT_FLUSH_INTERVAL = int(os.getenv('FORM_DRAFT_FLUSH_INTERVAL', '30'))
+
+# Через сколько секунд кэш пользователей и ПВЗ перечитывается из базы
+# (изменения из других процессов видны не позже чем через это время)
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))
+
+# Перед рассылкой напоминаний кэш перечитывается, если он старше этого
+REMINDER_CACHE_MAX_AGE = 60
+
+# Максимальный размер CSV для /import (байт) и сколько ошибок показывать
+MAX_IMPORT_SIZE = int(os.getenv('MAX_IMPORT_SIZE', str(5 * 1024 * 1024)))
+MAX_IMPORT_ERRORS_SHOWN = 20
+
+# Хранилище: sqlite (файл базы) или memory (в памяти процесса - данные
+# теряются при перезапуске, только для проверок с одним процессом)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
 
-# Инициализация базы данных
-db = Database()
+# Насколько (в секундах) данные отчетов, /stats и воскресных напоминаний могут
+# отставать от базы: > 0 - отчеты читают копию базы в памяти, обновляемую с
+# этим интервалом; 0 - всегда актуальные данные через читателей WAL
+READ_SNAPSHOT_MAX_AGE = int(os.getenv('READ_SNAPSHOT_MAX_AGE', '0'))
 
-# Состояния пользователей
-user_states = {}
+# Сколько секунд помнить обработанные нажатия на кнопки и сколько их хранить
+CALLBACK_DEDUP_TTL = int(os.getenv('CALLBACK_DEDUP_TTL', '600'))
+CALLBACK_DEDUP_MAX_SIZE = int(os.getenv('CALLBACK_DEDUP_MAX_SIZE', '10000'))
 
-# Барнаул часовой пояс (UTC+7)
-BARNAUL_TZ = timedelta(hours=7)
+# Журнал: уровень, формат (json - одна строка JSON на запись, text - как
+# раньше), файл (кроме вывода в консоль) и доля записей DEBUG, которые
+# попадают в журнал (частые события вроде обработки каждого обновления)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_FILE = os.getenv('LOG_FILE')
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1'))
+
+# Максимальная длина сообщения в Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+# База данных (файл открывается при первом запросе, схема проверяется
+# лениво, поэтому импорт модуля не обращается к диску)
+if STORAGE_BACKEND == 'memory':
+    db = MemoryStorage()
+else:
+    db = Database(snapshot_max_age=READ_SNAPSHOT_MAX_AGE)
+
+# Пользователи и ПВЗ в памяти - загружаются после старта и перед рассылками
+user_cache = UserCache(db, USER_CACHE_TTL)
+
+# Время запуска процесса (time.monotonic()) и было ли уже первое обновление -
+# для замера времени до первого обновления
+startup_metrics = {'started_at': None, 'first_update_seen': False}
+
+def setup_logging():
+    """Настройка логирования: запись в очередь, вывод в отдельном потоке"""
+    setup_queued_logging(
+        level=LOG_LEVEL,
+        log_format=LOG_FORMAT,
+        debug_sample_rate=LOG_DEBUG_SAMPLE_RATE,
+        log_file=LOG_FILE
+    )
+
+def check_config():
+    """Проверка конфигурации перед запуском"""
+    if not BOT_TOKEN:
+        raise ValueError("BOT_TOKEN не установлен в .env файле")
+    if STORAGE_BACKEND not in ('sqlite', 'memory'):
+        raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={STORAGE_BACKEND} (sqlite или memory)")
+    if STORAGE_BACKEND == 'memory' and BOT_WORKERS > 1:
+        raise ValueError("Хранилище memory не видно другим процессам - используйте BOT_WORKERS=1")
+
+def mark_startup():
+    """Запомнить время запуска процесса"""
+    startup_metrics['started_at'] = time.monotonic()
+    startup_metrics['first_update_seen'] = False
+
+def get_uptime():
+    """Секунд с запуска процесса"""
+    return time.monotonic() - startup_metrics['started_at']
+
+# Состояния пользователей хранятся в базе (db.get_user_state / db.set_user_state),
+# чтобы их видели все процессы бота
 
 def is_private_chat(update: Update) -> bool:
     """Проверяем, что сообщение из приватного чата"""
     return update.effective_chat.type == 'private'
 
-def get_barnaul_time():
-    """Получить текущее время в Барнаульском часовом поясе (UTC+7)"""
-    return datetime.utcnow() + BARNAUL_TZ
+@lru_cache(maxsize=None)
+def get_zone(timezone_name):
+    """Получить часовой пояс по имени (например, Asia/Barnaul)"""
+    return ZoneInfo(timezone_name)
 
-def format_barnaul_time(dt=None):
-    """Форматировать время в Барнаульском часовом поясе"""
+def get_local_time(timezone_name=DEFAULT_TIMEZONE):
+    """Получить текущее время в часовом поясе ПВЗ (по умолчанию - Барнаул)"""
+    return datetime.now(get_zone(timezone_name))
+
+def format_local_time(dt=None, timezone_name=DEFAULT_TIMEZONE):
+    """Форматировать время в часовом поясе ПВЗ"""
     if dt is None:
-        dt = get_barnaul_time()
+        dt = get_local_time(timezone_name)
     return dt.strftime('%d.%m.%Y %H:%M')
 
+def get_user_timezone(user):
+    """Часовой пояс ПВЗ пользователя (user - строка из db.get_user)"""
+    # user структура: [0]id, [1]user_id, [2]username, [3]first_name, [4]pvz_id, [5]full_name, [6]pvz_name, [7]pvz_timezone
+    if user and user[7]:
+        return user[7]
+    return DEFAULT_TIMEZONE
+
 def get_main_keyboard(user_id):
     """Получить основную клавиатуру с кнопками"""
     # Проверяем, является ли пользователь администратором
@@ -63,9 +215,8 @@ def get_main_keyboard(user_id):
     
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-def get_next_saturday():
-    """Получить следующую субботу в Барнаульском времени"""
-    today = get_barnaul_time()
+def get_next_saturday(today):
+    """Получить следующую субботу после дня today"""
     days_ahead = 5 - today.weekday()  # 5 - суббота
     if days_ahead <= 0:  # Если сегодня суббота или позже
         days_ahead += 7
@@ -80,125 +231,457 @@ def get_week_dates(start_date):
         dates.append(current_date.strftime("%d.%m"))
     return dates
 
-def get_target_week_dates():
-    """Получить даты целевой недели (неделя после следующей субботы)"""
-    next_saturday = get_next_saturday()
-    return get_week_dates(next_saturday)
+@lru_cache(maxsize=64)
+def get_target_week_dates_for_day(today):
+    """Даты целевой недели для местной даты today (кэшируются - меняются раз в сутки)"""
+    return tuple(get_week_dates(get_next_saturday(today)))
 
-async def start_schedule_collection(context: ContextTypes.DEFAULT_TYPE):
-    """Субботнее напоминание - обычное (в 9:00 по Барнаулу)"""
-    all_pvz = db.get_all_pvz()
+def get_target_week_dates(timezone_name=DEFAULT_TIMEZONE):
+    """Получить даты целевой недели (неделя после следующей субботы) по местному времени ПВЗ"""
+    return get_target_week_dates_for_day(get_local_time(timezone_name).date())
+
+def get_target_week_start(timezone_name=DEFAULT_TIMEZONE):
+    """Понедельник целевой недели (ГГГГ-ММ-ДД) по местному времени ПВЗ"""
+    saturday = get_next_saturday(get_local_time(timezone_name).date())
+    return (saturday + timedelta(days=2)).isoformat()
+
+async def send_saturday_reminder(context: ContextTypes.DEFAULT_TYPE, pvz, target_week_dates=None):
+    """Субботнее напоминание в чат одного ПВЗ"""
+    pvz_id, pvz_name, password, chat_id, timezone_name = pvz
+    if not chat_id:
+        return
     
-    for pvz in all_pvz:
-        pvz_id, pvz_name, password, chat_id = pvz
-        if chat_id:
-            try:
-                keyboard = [
-                    [InlineKeyboardButton("📝 Заполнить анкету", url=f"https://t.me/{context.bot.username}?start=form")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                target_week_dates = get_target_week_dates()
-                
-                message_text = (
-                    "📋 Субботнее напоминание!\n\n"
-                    f"Пора заполнить анкету расписания на неделю {target_week_dates[0]} - {target_week_dates[-1]}.\n"
-                    "Нажмите на кнопку ниже чтобы перейти к заполнению."
-                )
-                
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text,
-                    reply_markup=reply_markup
-                )
-                logging.info(f"Субботнее напоминание отправлено в чат ПВЗ {pvz_name}")
-            except Exception as e:
-                logging.error(f"Ошибка отправки субботнего напоминания в чат {pvz_name}: {e}")
+    try:
+        keyboard = [
+            [InlineKeyboardButton("📝 Заполнить анкету", url=f"https://t.me/{context.bot.username}?start=form")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        if target_week_dates is None:
+            target_week_dates = get_target_week_dates(timezone_name)
+        
+        message_text = (
+            "📋 Субботнее напоминание!\n\n"
+            f"Пора заполнить анкету расписания на неделю {target_week_dates[0]} - {target_week_dates[-1]}.\n"
+            "Нажмите на кнопку ниже чтобы перейти к заполнению."
+        )
+        
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=message_text,
+            reply_markup=reply_markup
+        )
+        logging.info("Субботнее напоминание отправлено в чат ПВЗ %s", pvz_name)
+    except Exception as e:
+        logging.error("Ошибка отправки субботнего напоминания в чат %s: %s", pvz_name, e)
 
-async def send_sunday_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Воскресное напоминание - отмечает тех, кто не заполнил (в 9:00 по Барнаулу)"""
-    target_week_dates = get_target_week_dates()
+async def start_schedule_collection(context: ContextTypes.DEFAULT_TYPE):
+    """Субботнее напоминание - обычное, во все ПВЗ сразу"""
+    user_cache.preload(max_age=REMINDER_CACHE_MAX_AGE)
+    for pvz in user_cache.get_all_pvz():
+        await send_saturday_reminder(context, pvz)
+
+async def send_sunday_reminder(context: ContextTypes.DEFAULT_TYPE, pvz, target_week_dates=None):
+    """Воскресное напоминание в чат одного ПВЗ - отмечает тех, кто не заполнил"""
+    pvz_id, pvz_name, password, chat_id, timezone_name = pvz
+    if not chat_id:
+        return
     
-    all_pvz = db.get_all_pvz()
+    if target_week_dates is None:
+        target_week_dates = get_target_week_dates(timezone_name)
     
-    for pvz in all_pvz:
-        pvz_id, pvz_name, password, chat_id = pvz
-        if not chat_id:
-            continue
+    try:
+        # Все пользователи этого ПВЗ (из кэша) и те, кто уже заполнил расписание
+        all_users = user_cache.get_pvz_users(pvz_id)
+        filled_users = db.get_filled_user_ids(pvz_id, target_week_dates)
+        
+        # Находим пользователей, которые НЕ заполнили расписание
+        not_filled_users = []
+        for user in all_users:
+            # user структура: [1]user_id, [2]username, [3]first_name, [5]full_name
+            user_id, username, first_name, full_name = user[1], user[2], user[3], user[5]
+            # Пропускаем администратора
+            if str(user_id) == ADMIN_CHAT_ID:
+                continue
+                
+            if user_id not in filled_users:
+                display_name = full_name or first_name or username or f"User_{user_id}"
+                not_filled_users.append(display_name)
+        
+        if not_filled_users:
+            # Формируем сообщение с упоминаниями
+            message_text = "📢 Воскресное напоминание!\n\n"
+            message_text += f"Следующие сотрудники еще не заполнили расписание на неделю {target_week_dates[0]} - {target_week_dates[-1]}:\n\n"
             
-        try:
-            # Получаем всех пользователей этого ПВЗ
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT user_id, username, first_name, full_name 
-                FROM users 
-                WHERE pvz_id = ?
-            ''', (pvz_id,))
-            all_users = cursor.fetchall()
+            for i, user_name in enumerate(not_filled_users, 1):
+                message_text += f"{i}. {user_name}\n"
             
-            # Получаем пользователей, которые уже заполнили расписание
-            placeholders = ','.join('?' for _ in target_week_dates)
-            cursor.execute(f'''
-                SELECT DISTINCT user_id 
-                FROM schedule 
-                WHERE date IN ({placeholders})
-                AND user_id IN (SELECT user_id FROM users WHERE pvz_id = ?)
-            ''', (*target_week_dates, pvz_id))
-            filled_users = [row[0] for row in cursor.fetchall()]
-            conn.close()
+            message_text += "\nПожалуйста, заполните расписание до начала недели!"
             
-            # Находим пользователей, которые НЕ заполнили расписание
-            not_filled_users = []
-            for user in all_users:
-                user_id, username, first_name, full_name = user
-                # Пропускаем администратора
-                if str(user_id) == ADMIN_CHAT_ID:
-                    continue
-                    
-                if user_id not in filled_users:
-                    display_name = full_name or first_name or username or f"User_{user_id}"
-                    not_filled_users.append(display_name)
+            keyboard = [
+                [InlineKeyboardButton("📝 Заполнить анкету", url=f"https://t.me/{context.bot.username}?start=form")]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
             
-            if not_filled_users:
-                # Формируем сообщение с упоминаниями
-                message_text = "📢 Воскресное напоминание!\n\n"
-                message_text += f"Следующие сотрудники еще не заполнили расписание на неделю {target_week_dates[0]} - {target_week_dates[-1]}:\n\n"
-                
-                for i, user_name in enumerate(not_filled_users, 1):
-                    message_text += f"{i}. {user_name}\n"
-                
-                message_text += "\nПожалуйста, заполните расписание до начала недели!"
-                
-                keyboard = [
-                    [InlineKeyboardButton("📝 Заполнить анкету", url=f"https://t.me/{context.bot.username}?start=form")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text,
-                    reply_markup=reply_markup
-                )
-                logging.info(f"Воскресное напоминание отправлено в чат ПВЗ {pvz_name}. Не заполнили: {len(not_filled_users)} чел.")
-            else:
-                # Все заполнили - отправляем позитивное сообщение
-                message_text = "✅ Отличная работа!\n\n"
-                message_text += f"Все сотрудники заполнили расписание на неделю {target_week_dates[0]} - {target_week_dates[-1]}!\n"
-                message_text += "Спасибо за своевременное заполнение!"
-                
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text
-                )
-                logging.info(f"Все сотрудники ПВЗ {pvz_name} заполнили расписание")
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=message_text,
+                reply_markup=reply_markup
+            )
+            logging.info("Воскресное напоминание отправлено в чат ПВЗ %s. Не заполнили: %s чел.", pvz_name, len(not_filled_users))
+        else:
+            # Все заполнили - отправляем позитивное сообщение
+            message_text = "✅ Отличная работа!\n\n"
+            message_text += f"Все сотрудники заполнили расписание на неделю {target_week_dates[0]} - {target_week_dates[-1]}!\n"
+            message_text += "Спасибо за своевременное заполнение!"
             
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=message_text
+            )
+            logging.info("Все сотрудники ПВЗ %s заполнили расписание", pvz_name)
+        
+    except Exception as e:
+        logging.error("Ошибка отправки воскресного напоминания в чат %s: %s", pvz_name, e)
+
+async def send_sunday_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Воскресное напоминание - во все ПВЗ сразу"""
+    user_cache.preload(max_age=REMINDER_CACHE_MAX_AGE)
+    for pvz in user_cache.get_all_pvz():
+        await send_sunday_reminder(context, pvz)
+
+def find_pvz_gaps(pvz_id, target_week_dates):
+    """Незакрытые часы ПВЗ и кто отметил «Как нужно ПВЗ».
+
+    Возвращает {дата: (незакрытые интервалы, [(user_id, имя), ...])}
+    только для дней, где есть незакрытые интервалы.
+    """
+    schedule_data = db.get_pvz_schedule_report(pvz_id, target_week_dates)
+    
+    shifts_by_date = {date: [] for date in target_week_dates}
+    as_needed_by_date = {date: [] for date in target_week_dates}
+    for row in schedule_data:
+        # row структура: [0]first_name, [1]username, [2]user_id, [3]date, [4]time_slot, [5]full_name,
+        # [6]slot_kind, [7]start_minute, [8]end_minute (смены отсортированы по времени начала)
+        if row[6] == SLOT_SHIFT:
+            shifts_by_date[row[3]].append((row[7], row[8]))
+        elif row[6] == SLOT_AS_NEEDED:
+            full_name = row[5] if row[5] else (row[0] or row[1] or f"User_{row[2]}")
+            as_needed_by_date[row[3]].append((row[2], full_name))
+    
+    gaps = {}
+    for date in target_week_dates:
+        intervals = find_uncovered_intervals(shifts_by_date[date])
+        if intervals:
+            gaps[date] = (intervals, as_needed_by_date[date])
+    return gaps
+
+async def send_gap_requests_for_pvz(context: ContextTypes.DEFAULT_TYPE, pvz, target_week_dates=None):
+    """Попросить сотрудников с «Как нужно ПВЗ» закрыть незакрытые часы ПВЗ"""
+    pvz_id, pvz_name, password, chat_id, timezone_name = pvz
+    if target_week_dates is None:
+        target_week_dates = get_target_week_dates(timezone_name)
+    day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+    
+    # Собираем для каждого сотрудника все его дни, чтобы отправить одно сообщение
+    requests = {}
+    for date, (intervals, as_needed_users) in find_pvz_gaps(pvz_id, target_week_dates).items():
+        day_name = day_names[target_week_dates.index(date)]
+        hours = ", ".join(f"{format_minutes(start)}-{format_minutes(end)}" for start, end in intervals)
+        for user_id, full_name in as_needed_users:
+            requests.setdefault(user_id, (full_name, []))[1].append(f"• {date} - {day_name}: {hours}")
+    
+    if not requests:
+        return
+    
+    semaphore = asyncio.Semaphore(GAP_REQUEST_CONCURRENCY)
+    
+    async def send_request(user_id, full_name, lines):
+        text = (
+            f"🙏 {full_name}, в ПВЗ {pvz_name} остались незакрытые часы:\n\n"
+            + "\n".join(lines)
+            + "\n\nВ эти дни вы отметили «Как нужно ПВЗ». Сможете выйти? "
+            "Укажите точное время, перезаполнив анкету: /form"
+        )
+        async with semaphore:
+            try:
+                await context.bot.send_message(chat_id=user_id, text=text)
+            except Exception as e:
+                logging.error("Ошибка отправки запроса на незакрытые смены сотруднику %s: %s", full_name, e)
+    
+    await asyncio.gather(*(
+        send_request(user_id, full_name, lines)
+        for user_id, (full_name, lines) in requests.items()
+    ))
+    logging.info("Запросы на незакрытые смены ПВЗ %s отправлены: %s чел.", pvz_name, len(requests))
+
+async def send_gap_requests(context: ContextTypes.DEFAULT_TYPE):
+    """Запросы на незакрытые смены - во все ПВЗ одновременно"""
+    await asyncio.gather(*(
+        send_gap_requests_for_pvz(context, pvz) for pvz in user_cache.get_all_pvz()
+    ))
+
+# Напоминания по типам из таблицы reminder_schedule
+REMINDER_SENDERS = {
+    'saturday': send_saturday_reminder,
+    'sunday': send_sunday_reminder,
+    'gaps': send_gap_requests_for_pvz,
+}
+
+# Запущенные, но еще не отправленные напоминания (id записей reminder_schedule)
+pending_reminders = set()
+
+def get_last_due_time(weekday, remind_time, timezone_name, now_utc):
+    """Последний момент (UTC, <= now_utc), когда напоминание должно было сработать"""
+    tz = get_zone(timezone_name)
+    now_local = now_utc.replace(tzinfo=timezone.utc).astimezone(tz)
+    hour, minute = map(int, remind_time.split(':'))
+    
+    due_date = (now_local - timedelta(days=(now_local.weekday() - weekday) % 7)).date()
+    due_local = datetime(due_date.year, due_date.month, due_date.day, hour, minute, tzinfo=tz)
+    if due_local > now_local:
+        due_local -= timedelta(days=7)
+    
+    return due_local.astimezone(timezone.utc).replace(tzinfo=None)
+
+async def run_zone_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Отправить напоминания ПВЗ одного часового пояса и запомнить время запуска"""
+    timezone_name, reminders = context.job.data
+    # Целевая неделя одна на весь часовой пояс
+    target_week_dates = get_target_week_dates(timezone_name)
+    # Свежие пользователи для всей рассылки
+    user_cache.preload(max_age=REMINDER_CACHE_MAX_AGE)
+    
+    for i, (reminder_id, kind, pvz) in enumerate(reminders):
+        if i:
+            await asyncio.sleep(REMINDER_STAGGER)
+        # Записи журнала во время отправки относятся к этому ПВЗ
+        token = log_context.set({'pvz': pvz[1]})
+        try:
+            await REMINDER_SENDERS[kind](context, pvz, target_week_dates)
+        finally:
+            db.mark_reminder_run(reminder_id, datetime.utcnow())
+            pending_reminders.discard(reminder_id)
+            log_context.reset(token)
+
+async def dispatch_due_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Запустить напоминания, время которых наступило (в том числе пропущенные при перезапуске).
+
+    На каждый часовой пояс запускается одна задача. Задачи разносятся по времени
+    с шагом REMINDER_STAGGER и случайной задержкой до REMINDER_JITTER секунд,
+    ПВЗ внутри пояса отправляются с шагом REMINDER_STAGGER.
+    """
+    now_utc = datetime.utcnow()
+    due_times = {}
+    due_by_zone = {}
+    
+    for reminder in db.get_reminder_schedule():
+        reminder_id, pvz_id, kind, weekday, remind_time, last_run_at, pvz_name, chat_id, timezone_name = reminder
+        if reminder_id in pending_reminders or kind not in REMINDER_SENDERS:
+            continue
+        
+        # У большинства ПВЗ одинаковое время - считаем его один раз
+        due_key = (weekday, remind_time, timezone_name)
+        if due_key not in due_times:
+            due_times[due_key] = get_last_due_time(weekday, remind_time, timezone_name, now_utc)
+        due_at = due_times[due_key]
+        logging.debug("Напоминание %s ПВЗ %s: срок %s UTC, последний запуск %s", kind, pvz_name, due_at, last_run_at)
+        if last_run_at and datetime.fromisoformat(last_run_at) >= due_at:
+            continue
+        
+        if now_utc - due_at > REMINDER_CATCHUP_WINDOW:
+            # Пропущено слишком давно - напоминание уже неактуально
+            logging.warning("Пропущено напоминание %s для ПВЗ %s (%s UTC), не догоняем", kind, pvz_name, due_at)
+            db.mark_reminder_run(reminder_id, now_utc)
+            continue
+        
+        pvz = (pvz_id, pvz_name, None, chat_id, timezone_name)
+        due_by_zone.setdefault(timezone_name, []).append((reminder_id, kind, pvz))
+    
+    for i, (timezone_name, reminders) in enumerate(due_by_zone.items()):
+        pending_reminders.update(reminder_id for reminder_id, kind, pvz in reminders)
+        context.job_queue.run_once(
+            run_zone_reminders,
+            when=i * REMINDER_STAGGER + random.uniform(0, REMINDER_JITTER),
+            data=(timezone_name, reminders),
+            name=f"reminders_{timezone_name}"
+        )
+    
+    if due_by_zone:
+        due_count = sum(len(reminders) for reminders in due_by_zone.values())
+        logging.info("Запланирована отправка напоминаний: %s в %s часовых поясах", due_count, len(due_by_zone))
+
+# Заголовки разделов сводки для администратора
+ADMIN_DIGEST_TITLES = {
+    'form': "📋 Заполненные расписания",
+    'registration': "👤 Новые сотрудники",
+}
+
+async def notify_admin(context: ContextTypes.DEFAULT_TYPE, kind: str, text: str, summary: str):
+    """Уведомить администратора: сразу или через очередь для сводки.
+
+    text - полное сообщение для немедленной отправки,
+    summary - короткая строка для сводки.
+    """
+    # Без планировщика сводку отправлять некому - шлем сразу
+    if ADMIN_NOTIFY_IMMEDIATE or context.job_queue is None:
+        try:
+            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=text)
+            return
         except Exception as e:
-            logging.error(f"Ошибка отправки воскресного напоминания в чат {pvz_name}: {e}")
+            logging.error("Ошибка отправки уведомления администратору, откладываем в очередь: %s", e)
+
+    db.add_admin_notification(kind, summary)
+
+async def flush_admin_notifications(context: ContextTypes.DEFAULT_TYPE):
+    """Отправить администратору сводку накопленных уведомлений"""
+    pending = db.get_pending_admin_notifications()
+    if not pending:
+        return
+
+    # Группируем по типу, сохраняя порядок поступления
+    grouped = {}
+    for notification_id, kind, text, created_at in pending:
+        grouped.setdefault(kind, []).append((notification_id, text))
+
+    lines = [(f"📬 Сводка уведомлений ({len(pending)}) на {format_local_time()}", None), ("", None)]
+    for kind, entries in grouped.items():
+        lines.append((ADMIN_DIGEST_TITLES.get(kind, kind) + f" ({len(entries)}):", None))
+        lines.extend((f"• {text}", notification_id) for notification_id, text in entries)
+        lines.append(("", None))
+
+    # Каждая часть сводки помнит, какие уведомления в нее вошли,
+    # чтобы при ошибке отправки неотправленные остались в очереди
+    parts = []
+    current_lines, current_ids, current_length = [], [], 0
+    for line, notification_id in lines:
+        if current_lines and current_length + len(line) + 1 > MAX_MESSAGE_LENGTH:
+            parts.append((current_lines, current_ids))
+            current_lines, current_ids, current_length = [], [], 0
+        current_lines.append(line)
+        current_length += len(line) + 1
+        if notification_id is not None:
+            current_ids.append(notification_id)
+    if current_lines:
+        parts.append((current_lines, current_ids))
+
+    for lines, notification_ids in parts:
+        try:
+            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text="\n".join(lines).strip())
+        except RetryAfter as e:
+            logging.warning("Лимит Telegram при отправке сводки, повтор через %s с", e.retry_after)
+            return
+        except Exception as e:
+            logging.error("Ошибка отправки сводки администратору: %s", e)
+            return
+        db.mark_admin_notifications_sent(notification_ids)
+
+    logging.info("Сводка отправлена администратору: %s уведомлений", len(pending))
+
+# Черновики анкет: user_id -> {'week': ..., 'answers': {дата: время}, 'updated': time.time(),
+# 'single_day': номер дня при изменении одного дня или None, 'dirty': не сохранен в базу}.
+# Рабочая копия - в памяти процесса (все обновления чата попадают в один процесс).
+# Измененные черновики раз в FORM_DRAFT_FLUSH_INTERVAL секунд и при остановке
+# сохраняются в базу одной транзакцией, чтобы пережить перезапуск; анкета,
+# заполненная быстрее, пишется в базу только один раз - при переносе в расписание
+form_drafts = {}
+
+def get_form_draft(user_id, target_week_dates):
+    """Черновик анкеты пользователя на неделю (новый, если нет или устарел)"""
+    week = f"{target_week_dates[0]}-{target_week_dates[-1]}"
+    draft = form_drafts.get(user_id)
+    if draft and time.time() - draft['updated'] > FORM_DRAFT_TTL_HOURS * 3600:
+        draft = None
+    if draft is None:
+        stored = db.get_form_draft(user_id, FORM_DRAFT_TTL_HOURS)
+        if stored:
+            draft = {'week': stored[0], 'answers': stored[1], 'updated': time.time(), 'single_day': stored[2], 'dirty': False}
+    if draft is None or draft['week'] != week:
+        draft = {'week': week, 'answers': {}, 'updated': time.time(), 'single_day': None, 'dirty': True}
+    form_drafts[user_id] = draft
+    return draft
+
+def start_form_draft(user_id, target_week_dates):
+    """Начать заполнение анкеты заново с пустым черновиком"""
+    week = f"{target_week_dates[0]}-{target_week_dates[-1]}"
+    form_drafts[user_id] = {'week': week, 'answers': {}, 'updated': time.time(), 'single_day': None, 'dirty': True}
+
+def start_day_edit(user_id, target_week_dates, day_index):
+    """Изменить один день уже заполненной недели (после ответа анкета не продолжается)"""
+    week = f"{target_week_dates[0]}-{target_week_dates[-1]}"
+    form_drafts[user_id] = {'week': week, 'answers': {}, 'updated': time.time(), 'single_day': day_index, 'dirty': True}
+
+def record_form_answer(user_id, target_week_dates, date, time_slot):
+    """Запомнить ответ на день в черновике (в расписание он попадет в конце анкеты)"""
+    draft = get_form_draft(user_id, target_week_dates)
+    draft['answers'][date] = time_slot
+    draft['updated'] = time.time()
+    draft['dirty'] = True
+
+def save_dirty_form_drafts():
+    """Сохранить измененные черновики в базу одной транзакцией, вернуть их число"""
+    dirty = [(user_id, draft) for user_id, draft in form_drafts.items() if draft['dirty']]
+    if not dirty:
+        return 0
+    db.save_form_drafts([
+        (user_id, draft['week'], draft['answers'], draft['single_day'])
+        for user_id, draft in dirty
+    ])
+    for _, draft in dirty:
+        draft['dirty'] = False
+    return len(dirty)
+
+def commit_form_draft(user_id, target_week_dates):
+    """Перенести черновик в расписание одной транзакцией. False - нечего переносить"""
+    draft = get_form_draft(user_id, target_week_dates)
+    form_drafts.pop(user_id, None)
+    if not draft['answers']:
+        return False
+    db.save_week_schedule(user_id, draft['answers'])
+    return True
+
+async def log_update_metrics(context: ContextTypes.DEFAULT_TYPE):
+    """Записать в журнал глубину очереди обновлений, если она не пуста или были отказы"""
+    processor = context.application.update_processor
+    metrics = processor.get_metrics()
+    if metrics['pending'] or metrics['shed'] != context.job.data['shed']:
+        logging.info(
+            "Очередь обновлений: ждут %s, выполняются %s, максимум %s, отклонено %s",
+            metrics['waiting'], metrics['in_flight'], metrics['max_pending'], metrics['shed'],
+            extra={'metrics': metrics}
+        )
+    context.job.data['shed'] = metrics['shed']
+    processor.max_pending_seen = metrics['pending']
+
+async def flush_form_drafts(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое сохранение измененных черновиков анкет"""
+    try:
+        saved = save_dirty_form_drafts()
+    except Exception as e:
+        logging.error("Ошибка сохранения черновиков анкет: %s", e)
+        return
+    if saved:
+        logging.debug("Сохранено черновиков анкет: %s", saved)
+
+async def cleanup_form_drafts(context: ContextTypes.DEFAULT_TYPE):
+    """Удалить брошенные черновики анкет из памяти и из базы"""
+    expired_before = time.time() - FORM_DRAFT_TTL_HOURS * 3600
+    for user_id in [user_id for user_id, draft in form_drafts.items() if draft['updated'] < expired_before]:
+        del form_drafts[user_id]
+    
+    deleted = db.delete_expired_form_drafts(FORM_DRAFT_TTL_HOURS)
+    if deleted:
+        logging.info("Удалено брошенных черновиков анкет: %s", deleted)
+
+async def prune_schedule_changes(context: ContextTypes.DEFAULT_TYPE):
+    """Удалить из журнала изменений расписания записи старше SCHEDULE_CHANGES_RETENTION_DAYS"""
+    deleted = db.delete_old_schedule_changes(SCHEDULE_CHANGES_RETENTION_DAYS)
+    if deleted:
+        logging.info("Удалено старых записей журнала изменений расписания: %s", deleted)
 
 async def send_day_form(chat_id: int, day_index: int, context: ContextTypes.DEFAULT_TYPE):
     """Отправка формы для одного дня"""
-    user = db.get_user(chat_id)
+    user = user_cache.get_user(chat_id)
     if not user:
         await context.bot.send_message(
             chat_id=chat_id, 
@@ -207,11 +690,15 @@ async def send_day_form(chat_id: int, day_index: int, context: ContextTypes.DEFA
         )
         return
     
-    target_week_dates = get_target_week_dates()
+    target_week_dates = get_target_week_dates(get_user_timezone(user))
     day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
     
     if day_index >= len(target_week_dates):
-        # Все дни заполнены
+        # Все дни заполнены - переносим черновик в расписание
+        if not commit_form_draft(chat_id, target_week_dates):
+            # Повторное нажатие на уже завершенной анкете
+            return
+        
         user_schedule = db.get_user_schedule(chat_id, target_week_dates)
         filled_days = sum(1 for date in target_week_dates if date in user_schedule)
         
@@ -224,38 +711,20 @@ async def send_day_form(chat_id: int, day_index: int, context: ContextTypes.DEFA
             reply_markup=get_main_keyboard(chat_id)
         )
         
-        # Отправляем уведомление администратору
-        user_info = db.get_user(chat_id)
-        if user_info:
-            # user_info структура: [0]id, [1]user_id, [2]username, [3]first_name, [4]pvz_id, [5]full_name, [6]pvz_name
-            full_name = user_info[5] if user_info[5] else (user_info[3] or user_info[2] or f"User_{chat_id}")
-            pvz_name = user_info[6]  # pvz_name находится в индексе 6
-            
-            admin_message = (
-                f"📋 Новое заполненное расписание!\n\n"
-                f"👤 Сотрудник: {full_name}\n"
-                f"🏪 ПВЗ: {pvz_name}\n"
-                f"📅 Период: {target_week_dates[0]} - {target_week_dates[-1]}\n"
-                f"✅ Заполнено дней: {filled_days}/{len(target_week_dates)}\n"
-                f"🕒 Время заполнения: {format_barnaul_time()}"
-            )
-            
-            try:
-                await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=admin_message)
-                logging.info(f"Уведомление отправлено администратору о заполнении анкеты сотрудником {full_name}")
-            except Exception as e:
-                logging.error(f"Ошибка отправки уведомления администратору: {e}")
-        
+        await notify_form_filled(context, user, target_week_dates, filled_days)
         return
     
     date = target_week_dates[day_index]
     day_name = day_names[day_index]
     
-    # Загружаем сохраненное расписание для этого дня
-    saved_schedule = db.get_user_schedule(chat_id, [date])
-    saved_time = saved_schedule.get(date, "")
+    # Ответ из черновика, а если его нет - текущее расписание на этот день
+    draft = get_form_draft(chat_id, target_week_dates)
+    saved_time = draft['answers'].get(date)
+    if saved_time is None:
+        saved_time = db.get_user_schedule(chat_id, [date]).get(date, "")
     
-    if day_index == 0:
+    single_day = draft.get('single_day') is not None
+    if day_index == 0 and not single_day:
         # Первый день - отправляем приветственное сообщение
         # user структура: [0]id, [1]user_id, [2]username, [3]first_name, [4]pvz_id, [5]full_name, [6]pvz_name
         pvz_name = user[6]  # pvz_name находится в индексе 6
@@ -285,6 +754,12 @@ async def send_day_form(chat_id: int, day_index: int, context: ContextTypes.DEFA
         ]
     ]
     
+    # На первом дне - заполнить всю неделю как прошлую одним нажатием
+    if day_index == 0 and not single_day:
+        target_week_start = get_target_week_start(get_user_timezone(user))
+        if db.get_user_previous_week(chat_id, target_week_start):
+            keyboard.append([InlineKeyboardButton("🔁 Как на прошлой неделе", callback_data="copyweek")])
+    
     reply_markup = InlineKeyboardMarkup(keyboard)
     day_message = f"{date} - {day_name}{time_indicator}"
     
@@ -294,9 +769,68 @@ async def send_day_form(chat_id: int, day_index: int, context: ContextTypes.DEFA
         reply_markup=reply_markup
     )
 
+async def notify_form_filled(context: ContextTypes.DEFAULT_TYPE, user, target_week_dates, filled_days):
+    """Уведомить администратора о заполненном расписании"""
+    # user структура: [0]id, [1]user_id, [2]username, [3]first_name, [4]pvz_id, [5]full_name, [6]pvz_name
+    full_name = user[5] if user[5] else (user[3] or user[2] or f"User_{user[1]}")
+    pvz_name = user[6]  # pvz_name находится в индексе 6
+    filled_at = format_local_time(timezone_name=get_user_timezone(user))
+    
+    admin_message = (
+        f"📋 Новое заполненное расписание!\n\n"
+        f"👤 Сотрудник: {full_name}\n"
+        f"🏪 ПВЗ: {pvz_name}\n"
+        f"📅 Период: {target_week_dates[0]} - {target_week_dates[-1]}\n"
+        f"✅ Заполнено дней: {filled_days}/{len(target_week_dates)}\n"
+        f"🕒 Время заполнения: {filled_at}"
+    )
+    
+    admin_summary = (
+        f"{full_name} ({pvz_name}) - {filled_days}/{len(target_week_dates)} дн., "
+        f"{filled_at}"
+    )
+    
+    await notify_admin(context, 'form', admin_message, admin_summary)
+    logging.info("Уведомление администратору о заполнении анкеты сотрудником %s", full_name)
+
+def build_week_summary(user_id, target_week_dates, title):
+    """Расписание целевой недели одним сообщением с кнопками изменения каждого дня"""
+    day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+    schedule = db.get_user_schedule(user_id, target_week_dates)
+    
+    text = f"{title}\nПериод: {target_week_dates[0]} - {target_week_dates[-1]}\n\n"
+    for i, date in enumerate(target_week_dates):
+        time_slot = schedule.get(date)
+        if time_slot:
+            text += f"✅ {date} - {day_names[i]}: {time_slot}\n"
+        else:
+            text += f"❌ {date} - {day_names[i]}: Не заполнено\n"
+    text += "\nИзменить день - кнопкой ниже"
+    
+    buttons = [
+        InlineKeyboardButton(f"✏️ {WEEKDAY_NAMES[i]}", callback_data=f"editday_{i}")
+        for i in range(len(target_week_dates))
+    ]
+    keyboard = [buttons[:4], buttons[4:]]
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def send_next_day_form(user_id: int, day_index: int, context: ContextTypes.DEFAULT_TYPE):
+    """После ответа на день: следующий день анкеты или, при изменении одного дня, итог недели"""
+    draft = form_drafts.get(user_id)
+    if not draft or draft.get('single_day') != day_index:
+        await send_day_form(user_id, day_index + 1, context)
+        return
+    
+    user = user_cache.get_user(user_id)
+    target_week_dates = get_target_week_dates(get_user_timezone(user))
+    if not commit_form_draft(user_id, target_week_dates):
+        return
+    text, reply_markup = build_week_summary(user_id, target_week_dates, "✅ День изменен")
+    await context.bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+
 async def show_start_time_selection(chat_id: int, day_index: int, context: ContextTypes.DEFAULT_TYPE):
     """Показать выбор времени начала смены"""
-    target_week_dates = get_target_week_dates()
+    target_week_dates = get_target_week_dates(get_user_timezone(user_cache.get_user(chat_id)))
     day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
     
     date = target_week_dates[day_index]
@@ -338,7 +872,7 @@ async def show_start_time_selection(chat_id: int, day_index: int, context: Conte
 
 async def show_end_time_selection(chat_id: int, day_index: int, start_hour: int, start_minute: int, context: ContextTypes.DEFAULT_TYPE):
     """Показать выбор времени окончания смены"""
-    target_week_dates = get_target_week_dates()
+    target_week_dates = get_target_week_dates(get_user_timezone(user_cache.get_user(chat_id)))
     day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
     
     date = target_week_dates[day_index]
@@ -398,11 +932,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     
     # Проверяем, зарегистрирован ли пользователь
-    existing_user = db.get_user(user_id)
+    existing_user = user_cache.get_user(user_id)
     
     if existing_user:
         # Пользователь уже зарегистрирован
-        target_week_dates = get_target_week_dates()
+        target_week_dates = get_target_week_dates(get_user_timezone(existing_user))
         
         welcome_text = (
             f"👋 С возвращением, {user.first_name}!\n\n"
@@ -421,7 +955,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
     else:
         # Новый пользователь - просим ввести пароль
-        user_states[user_id] = {'state': 'waiting_password'}
+        db.set_user_state(user_id, {'state': 'waiting_password'})
         await update.message.reply_text(
             "👋 Добро пожаловать!\n\n"
             "Для регистрации введите пароль вашего ПВЗ.\n"
@@ -440,7 +974,8 @@ async def handle_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     password = update.message.text.strip()
     
     # Проверяем состояние пользователя
-    if user_id not in user_states or user_states[user_id].get('state') != 'waiting_password':
+    user_state = db.get_user_state(user_id)
+    if not user_state or user_state.get('state') != 'waiting_password':
         # Если пользователь не в состоянии ожидания пароля, игнорируем сообщение
         return
     
@@ -448,11 +983,11 @@ async def handle_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pvz = db.get_pvz_by_password(password)
     if pvz:
         # Переходим к вводу имени и фамилии
-        user_states[user_id] = {
+        db.set_user_state(user_id, {
             'state': 'waiting_full_name',
             'pvz_id': pvz[0],
             'pvz_name': pvz[1]
-        }
+        })
         
         await update.message.reply_text(
             "✅ Пароль принят!\n\n"
@@ -479,7 +1014,8 @@ async def handle_full_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     
     # Проверяем состояние пользователя
-    if user_id not in user_states or user_states[user_id].get('state') != 'waiting_full_name':
+    user_state = db.get_user_state(user_id)
+    if not user_state or user_state.get('state') != 'waiting_full_name':
         # Если пользователь не в состоянии ожидания имени, игнорируем сообщение
         return
     
@@ -496,11 +1032,12 @@ async def handle_full_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Регистрируем пользователя
-    pvz_id = user_states[user_id]['pvz_id']
-    pvz_name = user_states[user_id]['pvz_name']
+    pvz_id = user_state['pvz_id']
+    pvz_name = user_state['pvz_name']
     
     db.add_user(user_id, user.username, user.first_name, pvz_id, full_name)
-    user_states[user_id] = {'state': 'registered'}
+    user_cache.invalidate_user(user_id)
+    db.clear_user_state(user_id)
     
     await update.message.reply_text(
         f"✅ Регистрация успешна!\n\n"
@@ -510,18 +1047,18 @@ async def handle_full_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_keyboard(user_id)
     )
     
-    # Уведомляем администратора о новой регистрации
+    # Уведомляем администратора о новой регистрации (время - по часовому поясу ПВЗ)
+    registered_at = format_local_time(timezone_name=get_user_timezone(user_cache.get_user(user_id)))
     admin_message = (
         f"👤 Новый сотрудник зарегистрировался!\n\n"
         f"Имя: {full_name}\n"
         f"ПВЗ: {pvz_name}\n"
-        f"Время: {format_barnaul_time()}"
+        f"Время: {registered_at}"
     )
     
-    try:
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=admin_message)
-    except Exception as e:
-        logging.error(f"Ошибка отправки уведомления о регистрации: {e}")
+    admin_summary = f"{full_name} ({pvz_name}) - {registered_at}"
+    
+    await notify_admin(context, 'registration', admin_message, admin_summary)
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений (кнопок)"""
@@ -533,8 +1070,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     text = update.message.text
     
     # Сначала проверяем, не находится ли пользователь в процессе регистрации
-    if user_id in user_states:
-        state = user_states[user_id].get('state')
+    user_state = db.get_user_state(user_id)
+    if user_state:
+        state = user_state.get('state')
         if state == 'waiting_password':
             await handle_password(update, context)
             return
@@ -563,7 +1101,7 @@ async def send_form(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = user_cache.get_user(user_id)
     
     if not user:
         await update.message.reply_text(
@@ -572,23 +1110,93 @@ async def send_form(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Удаляем старое расписание пользователя для целевой недели при перезаполнении
-    target_week_dates = get_target_week_dates()
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    placeholders = ','.join('?' for _ in target_week_dates)
-    cursor.execute(f'DELETE FROM schedule WHERE user_id = ? AND date IN ({placeholders})', (user_id, *target_week_dates))
-    conn.commit()
-    conn.close()
+    # Ответы копятся в черновике; текущее расписание заменяется только
+    # после ответа на последний день
+    target_week_dates = get_target_week_dates(get_user_timezone(user))
+    start_form_draft(user_id, target_week_dates)
     
     # Начинаем заполнение с первого дня
     await send_day_form(user_id, 0, context)
 
+class CallbackDeduplicator:
+    """Недавно обработанные ключи нажатий: не больше max_size, каждый живет ttl секунд"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # ключ -> время обработки (time.monotonic()), в порядке добавления
+        self._seen = OrderedDict()
+
+    def check_and_add(self, key):
+        """True, если ключ уже обрабатывался; иначе запомнить его и вернуть False"""
+        now = time.monotonic()
+        # Ключи добавляются по времени - устаревшие всегда в начале
+        while self._seen:
+            oldest_key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at <= self.ttl:
+                break
+            del self._seen[oldest_key]
+        
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return False
+
+    def forget(self, key):
+        """Разрешить повторную обработку (после ошибки)"""
+        self._seen.pop(key, None)
+
+# Нажатия одного чата обрабатываются одним процессом (см. get_update_shard),
+# поэтому копии в памяти процесса достаточно
+callback_deduplicator = CallbackDeduplicator(CALLBACK_DEDUP_MAX_SIZE, CALLBACK_DEDUP_TTL)
+
+def get_callback_key(query):
+    """Ключ нажатия: сообщение и его версия (время последнего изменения и
+    хэш текста с кнопками).
+
+    Каждый обработчик кнопок изменяет свое сообщение, поэтому на одну версию
+    сообщения обрабатывается только одно нажатие - повторные и нажатия на
+    устаревшую клавиатуру (которые Telegram успел отправить до изменения)
+    отбрасываются, даже если нажата другая кнопка. Время изменения - с
+    точностью до секунды, поэтому две правки за одну секунду (быстрое
+    листание /myschedule) различаются по содержимому сообщения.
+    """
+    message = query.message
+    if message is None:
+        return (query.from_user.id, query.inline_message_id, query.data)
+    if not isinstance(message, Message):
+        # Старое или удаленное сообщение (InaccessibleMessage): ни версии,
+        # ни содержимого у него нет
+        return (query.from_user.id, query.data)
+    version = getattr(message, 'edit_date', None) or message.date
+    buttons = tuple(
+        button.callback_data
+        for row in (message.reply_markup.inline_keyboard if message.reply_markup else ())
+        for button in row
+    )
+    content = hash((message.text, buttons))
+    return (message.chat.id, message.message_id, version.timestamp() if version else None, content)
+
 async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на кнопки"""
+    """Обработчик нажатий на кнопки (повторные нажатия отбрасываются)"""
     query = update.callback_query
+    key = get_callback_key(query)
+    if callback_deduplicator.check_and_add(key):
+        # Без обращения к базе и новых сообщений - только всплывающая подсказка
+        await query.answer("Уже обработано")
+        return
     await query.answer()
     
+    try:
+        await process_button_click(query, context)
+    except Exception:
+        callback_deduplicator.forget(key)
+        raise
+
+async def process_button_click(query, context: ContextTypes.DEFAULT_TYPE):
+    """Действие по нажатой кнопке"""
     user_id = query.from_user.id
     data = query.data
     
@@ -597,12 +1205,12 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
         day_index = int(parts[1])
         time_type = parts[2]
         
-        user = db.get_user(user_id)
+        user = user_cache.get_user(user_id)
         if not user:
             await query.edit_message_text("❌ Сначала зарегистрируйтесь с помощью /start")
             return
         
-        target_week_dates = get_target_week_dates()
+        target_week_dates = get_target_week_dates(get_user_timezone(user))
         day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
         selected_date = target_week_dates[day_index]
         day_name = day_names[day_index]
@@ -624,14 +1232,14 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
             }
             
             selected_time = time_mapping[time_type]
-            db.save_schedule(user_id, selected_date, selected_time)
+            record_form_answer(user_id, target_week_dates, selected_date, selected_time)
             
             await query.edit_message_text(
-                text=f"✅ {selected_date} - {day_name}\nСохранено: {selected_time}"
+                text=f"✅ {selected_date} - {day_name}\nВыбрано: {selected_time}"
             )
             
             # Отправляем следующий день
-            await send_day_form(user_id, day_index + 1, context)
+            await send_next_day_form(user_id, day_index, context)
     
     elif data.startswith("start_"):
         # Пользователь выбрал время начала
@@ -654,21 +1262,66 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
         end_hour = int(parts[4])
         end_minute = int(parts[5])
         
-        target_week_dates = get_target_week_dates()
+        target_week_dates = get_target_week_dates(get_user_timezone(user_cache.get_user(user_id)))
         day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
         selected_date = target_week_dates[day_index]
         day_name = day_names[day_index]
         
         # Сохраняем выбранное время
         time_slot = f"{start_hour}:{start_minute:02d}-{end_hour}:{end_minute:02d}"
-        db.save_schedule(user_id, selected_date, time_slot)
+        record_form_answer(user_id, target_week_dates, selected_date, time_slot)
         
         await query.edit_message_text(
-            text=f"✅ {selected_date} - {day_name}\nСохранено: {time_slot}"
+            text=f"✅ {selected_date} - {day_name}\nВыбрано: {time_slot}"
         )
         
         # Отправляем следующий день
-        await send_day_form(user_id, day_index + 1, context)
+        await send_next_day_form(user_id, day_index, context)
+    
+    elif data == "copyweek":
+        # Неделя как прошлая: одна транзакция в базе и одно сообщение с итогом
+        user = user_cache.get_user(user_id)
+        if not user:
+            await query.edit_message_text("❌ Сначала зарегистрируйтесь с помощью /start")
+            return
+        
+        target_week_dates = get_target_week_dates(get_user_timezone(user))
+        source_week, copied = db.copy_previous_week(user_id, get_target_week_start(get_user_timezone(user)))
+        form_drafts.pop(user_id, None)
+        if not copied:
+            await query.edit_message_text("❌ Нет прошлой недели для копирования. Заполните анкету: /form")
+            return
+        
+        source_monday = datetime.strptime(source_week, "%Y-%m-%d")
+        text, reply_markup = build_week_summary(
+            user_id, target_week_dates,
+            f"🔁 Расписание скопировано с недели от {source_monday.strftime('%d.%m')}"
+        )
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+        await notify_form_filled(context, user, target_week_dates, copied)
+    
+    elif data.startswith("editday_"):
+        # Изменить один день недели из итогового сообщения
+        day_index = int(data.split("_")[1])
+        user = user_cache.get_user(user_id)
+        if not user:
+            await query.edit_message_text("❌ Сначала зарегистрируйтесь с помощью /start")
+            return
+        
+        start_day_edit(user_id, get_target_week_dates(get_user_timezone(user)), day_index)
+        # Убираем кнопки итога - дальше работает форма дня
+        await query.edit_message_reply_markup(reply_markup=None)
+        await send_day_form(user_id, day_index, context)
+    
+    elif data.startswith("mysched_"):
+        # Листание /myschedule по неделям - редактируем то же сообщение
+        user = user_cache.get_user(user_id)
+        if not user:
+            await query.edit_message_text("❌ Сначала зарегистрируйтесь с помощью /start")
+            return
+        
+        text, reply_markup = build_my_schedule_page(user, data[len("mysched_"):])
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
     
     elif data.startswith("cancel_"):
         # Отмена выбора времени
@@ -676,49 +1329,125 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.edit_message_text("❌ Выбор времени отменен")
         await send_day_form(user_id, day_index, context)
 
-async def send_admin_report(context: ContextTypes.DEFAULT_TYPE):
-    """Отправка отчета администратору"""
-    target_week_dates = get_target_week_dates()
+def build_report_snapshot(schedule_data):
+    """Содержимое отчета по дням: {дата: [[user_id, имя, время], ...]}"""
+    snapshot = {}
+    for row in schedule_data:
+        # row структура: [0]first_name, [1]username, [2]user_id, [3]date, [4]time_slot, [5]full_name,
+        # [6]slot_kind, [7]start_minute, [8]end_minute (смены отсортированы по времени начала)
+        # Используем полное имя из базы данных
+        full_name = row[5] if row[5] else (row[0] or row[1] or f"User_{row[2]}")
+        snapshot.setdefault(row[3], []).append([row[2], full_name, row[4]])
+    return snapshot
+
+def format_admin_report(pvz_name, target_week_dates, snapshot):
+    """Текст полного отчета по ПВЗ"""
     day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
     
-    all_pvz = db.get_all_pvz()
+    report = f"📊 ОТЧЕТ ПО РАСПИСАНИЮ\nПВЗ: {pvz_name}\nПериод: {target_week_dates[0]} - {target_week_dates[-1]}\n\n"
     
-    for pvz in all_pvz:
-        pvz_id, pvz_name, password, chat_id = pvz
+    for i, date in enumerate(target_week_dates):
+        report += f"📅 {date} - {day_names[i]}:\n"
         
-        report = f"📊 ОТЧЕТ ПО РАСПИСАНИЮ\nПВЗ: {pvz_name}\nПериод: {target_week_dates[0]} - {target_week_dates[-1]}\n\n"
+        if date in snapshot:
+            for user_id, full_name, time_slot in snapshot[date]:
+                report += f"  👤 {full_name} - {time_slot}\n"
+        else:
+            report += "  ❌ Нет данных\n"
         
-        schedule_data = db.get_pvz_schedule_report(pvz_id, target_week_dates)
+        report += "\n"
+    
+    return report
+
+def diff_report_snapshots(target_week_dates, old_snapshot, new_snapshot):
+    """Строки изменений между двумя отчетами (пустой список - изменений нет)"""
+    lines = []
+    for date in target_week_dates:
+        old_day = {entry[0]: (entry[1], entry[2]) for entry in old_snapshot.get(date, [])}
+        new_day = {entry[0]: (entry[1], entry[2]) for entry in new_snapshot.get(date, [])}
         
-        # Группируем по дням
-        day_schedule = {}
-        for row in schedule_data:
-            # row структура: [0]first_name, [1]username, [2]user_id, [3]date, [4]time_slot, [5]full_name
-            # Используем полное имя из базы данных
-            full_name = row[5] if row[5] else (row[0] or row[1] or f"User_{row[2]}")
-            date = row[3]
-            time_slot = row[4]
-            
-            if date not in day_schedule:
-                day_schedule[date] = []
-            day_schedule[date].append(f"{full_name} - {time_slot}")
+        day_lines = []
+        for user_id, (full_name, time_slot) in new_day.items():
+            if user_id not in old_day:
+                day_lines.append(f"  ➕ {full_name} - {time_slot}")
+            elif old_day[user_id][1] != time_slot:
+                day_lines.append(f"  ✏️ {full_name}: {old_day[user_id][1]} → {time_slot}")
+        for user_id, (full_name, time_slot) in old_day.items():
+            if user_id not in new_day:
+                day_lines.append(f"  ➖ {full_name} - {time_slot}")
         
-        for i, date in enumerate(target_week_dates):
-            report += f"📅 {date} - {day_names[i]}:\n"
-            
-            if date in day_schedule:
-                for entry in day_schedule[date]:
-                    report += f"  👤 {entry}\n"
-            else:
-                report += "  ❌ Нет данных\n"
-            
-            report += "\n"
+        if day_lines:
+            lines.append(f"📅 {date}:")
+            lines.extend(day_lines)
+    return lines
+
+def report_names_changed(previous_version, version):
+    """Изменились ли название ПВЗ или имена сотрудников между версиями отчета
+    (у версий старого формата хэша имен нет - считаем, что не изменились)"""
+    previous_parts, parts = previous_version.split(':'), version.split(':')
+    return len(previous_parts) > 2 and previous_parts[2] != parts[2]
+
+async def send_admin_report(context: ContextTypes.DEFAULT_TYPE, force_full=False):
+    """Отправка отчета администратору.
+
+    Если с прошлого отчета за ту же неделю расписание ПВЗ не менялось, отчет
+    не отправляется. Иначе прошлое сообщение отчета редактируется на месте,
+    а ответом на него приходит краткий список изменений. force_full - всегда
+    отправлять полный отчет новым сообщением.
+    Возвращает названия ПВЗ без изменений.
+    """
+    unchanged = []
+    
+    for pvz in user_cache.get_all_pvz():
+        pvz_id, pvz_name, password, chat_id, timezone_name = pvz
+        target_week_dates = get_target_week_dates(timezone_name)
+        week = f"{target_week_dates[0]}-{target_week_dates[-1]}"
+        
+        # Дешевая проверка версии - без чтения всего расписания ПВЗ
+        version = db.get_pvz_schedule_version(pvz_id, target_week_dates)
+        previous = None if force_full else db.get_report_snapshot(pvz_id, week)
+        if previous and previous[0] == version:
+            unchanged.append(pvz_name)
+            continue
+        
+        snapshot = build_report_snapshot(db.get_pvz_schedule_report(pvz_id, target_week_dates))
+        report = format_admin_report(pvz_name, target_week_dates, snapshot)
         
         try:
-            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=report)
-            logging.info(f"Отчет для {pvz_name} отправлен администратору")
+            if previous:
+                previous_version, previous_snapshot, message_id = previous
+                changes = diff_report_snapshots(target_week_dates, previous_snapshot, snapshot)
+                if not changes and not report_names_changed(previous_version, version):
+                    # Записи перезаписаны теми же значениями
+                    db.save_report_snapshot(pvz_id, week, version, snapshot, message_id)
+                    unchanged.append(pvz_name)
+                    continue
+                
+                try:
+                    await context.bot.edit_message_text(chat_id=ADMIN_CHAT_ID, message_id=message_id, text=report)
+                except Exception as e:
+                    # Сообщение удалено или недоступно - отправляем отчет заново
+                    logging.warning("Не удалось обновить отчет для %s, отправляем новый: %s", pvz_name, e)
+                    message = await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=report)
+                    message_id = message.message_id
+                
+                # Только переименование - отчет обновлен на месте, списка изменений нет
+                if changes:
+                    await context.bot.send_message(
+                        chat_id=ADMIN_CHAT_ID,
+                        text=f"🔄 Изменения в расписании\nПВЗ: {pvz_name}\n\n" + "\n".join(changes),
+                        reply_to_message_id=message_id
+                    )
+            else:
+                message = await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=report)
+                message_id = message.message_id
+            
+            db.save_report_snapshot(pvz_id, week, version, snapshot, message_id)
+            logging.info("Отчет для %s отправлен администратору", pvz_name)
         except Exception as e:
-            logging.error(f"Ошибка отправки отчета для {pvz_name}: {e}")
+            logging.error("Ошибка отправки отчета для %s: %s", pvz_name, e)
+    
+    return unchanged
 
 async def my_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать мое расписание"""
@@ -727,7 +1456,7 @@ async def my_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = user_cache.get_user(user_id)
     
     if not user:
         await update.message.reply_text(
@@ -736,17 +1465,36 @@ async def my_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    target_week_dates = get_target_week_dates()
-    day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
-    
-    schedule = db.get_user_schedule(user_id, target_week_dates)
-    
+    text, reply_markup = build_my_schedule_page(user, get_target_week_start(get_user_timezone(user)))
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+def build_my_schedule_page(user, week_start):
+    """Страница /myschedule за неделю с понедельника week_start: (текст, кнопки листания)"""
     # user структура: [0]id, [1]user_id, [2]username, [3]first_name, [4]pvz_id, [5]full_name, [6]pvz_name
+    user_id = user[1]
     pvz_name = user[6]
-    text = f"📋 Ваше расписание на неделю:\nПВЗ: {pvz_name}\nПериод: {target_week_dates[0]} - {target_week_dates[-1]}\n\n"
+    day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+    
+    target_week_start = get_target_week_start(get_user_timezone(user))
+    monday = datetime.strptime(week_start, "%Y-%m-%d").date()
+    week_days = [monday + timedelta(days=i) for i in range(7)]
+    
+    schedule, previous_week, next_week = db.get_user_week_schedule(user_id, week_start)
+    # Целевая неделя доступна всегда, даже если на нее еще ничего не заполнено
+    if week_start < target_week_start and (next_week is None or next_week > target_week_start):
+        next_week = target_week_start
+    if week_start > target_week_start and (previous_week is None or previous_week < target_week_start):
+        previous_week = target_week_start
+    
+    title = "Ваше расписание на неделю" if week_start == target_week_start else "Ваше расписание (архив)"
+    text = (
+        f"📋 {title}:\nПВЗ: {pvz_name}\n"
+        f"Период: {week_days[0].strftime('%d.%m.%Y')} - {week_days[-1].strftime('%d.%m.%Y')}\n\n"
+    )
     
     has_data = False
-    for i, date in enumerate(target_week_dates):
+    for i, day in enumerate(week_days):
+        date = day.strftime("%d.%m")
         time_slot = schedule.get(date)
         if time_slot:
             has_data = True
@@ -754,20 +1502,23 @@ async def my_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             text += f"❌ {date} - {day_names[i]}: Не заполнено\n"
     
-    if has_data:
-        text += "\nИзменить расписание: нажмите кнопку '📝 Заполнить анкету'"
-    else:
-        text += "\nЗаполнить расписание: нажмите кнопку '📝 Заполнить анкету'"
-        
-    await update.message.reply_text(
-        text,
-        reply_markup=get_main_keyboard(user_id)
-    )
+    if week_start == target_week_start:
+        if has_data:
+            text += "\nИзменить расписание: нажмите кнопку '📝 Заполнить анкету'"
+        else:
+            text += "\nЗаполнить расписание: нажмите кнопку '📝 Заполнить анкету'"
+    
+    buttons = []
+    if previous_week:
+        buttons.append(InlineKeyboardButton("◀️ Раньше", callback_data=f"mysched_{previous_week}"))
+    if next_week:
+        buttons.append(InlineKeyboardButton("Позже ▶️", callback_data=f"mysched_{next_week}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
 
 async def set_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Установить чат для напоминаний"""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = user_cache.get_user(user_id)
     
     if not user:
         await update.message.reply_text(
@@ -788,14 +1539,134 @@ async def set_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     db.set_pvz_chat_id(pvz_id, chat_id)
+    user_cache.invalidate()
+    
+    reminders = db.get_pvz_reminders(pvz_id)
+    reminder_lines = "\n".join(
+        f"• {REMINDER_NAMES[kind]}: {WEEKDAY_NAMES[weekday]} в {remind_time}"
+        for kind, (weekday, remind_time) in reminders.items()
+        if kind in REMINDER_NAMES
+    )
     
     await update.message.reply_text(
         f"✅ Чат настроен для получения напоминаний!\n"
         f"ПВЗ: {user[6]}\n"
         f"Chat ID: {chat_id}\n\n"
         f"Теперь бот будет отправлять сюда напоминания:\n"
-        f"• Субботние в 9:00 по Барнаулу\n"
-        f"• Воскресные в 9:00 по Барнаулу",
+        f"{reminder_lines}\n\n"
+        f"Изменить время: /setreminder",
+        reply_markup=get_main_keyboard(user_id)
+    )
+
+# Названия напоминаний и дней недели для сообщений
+REMINDER_NAMES = {
+    'saturday': "Субботнее напоминание",
+    'sunday': "Воскресное напоминание",
+    'gaps': "Запросы на незакрытые смены",
+}
+WEEKDAY_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+async def set_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Изменить время напоминания ПВЗ: /setreminder saturday|sunday|gaps [день] ЧЧ:ММ"""
+    # Разрешаем только в приватных чатах
+    if not is_private_chat(update):
+        return
+    
+    user_id = update.effective_user.id
+    if str(user_id) != ADMIN_CHAT_ID:
+        await update.message.reply_text(
+            "❌ У вас нет прав для этой команды.",
+            reply_markup=get_main_keyboard(user_id)
+        )
+        return
+    
+    user = user_cache.get_user(user_id)
+    if not user:
+        await update.message.reply_text(
+            "❌ Сначала зарегистрируйтесь с помощью /start",
+            reply_markup=get_main_keyboard(user_id)
+        )
+        return
+    
+    args = context.args or []
+    usage = (
+        "Использование: /setreminder saturday|sunday|gaps [день] ЧЧ:ММ\n"
+        "День - Пн, Вт, Ср, Чт, Пт, Сб или Вс (по умолчанию - текущий день напоминания).\n"
+        "Время указывается по часовому поясу ПВЗ.\n"
+        "Например: /setreminder sunday 10:30"
+    )
+    if len(args) not in (2, 3) or args[0] not in REMINDER_NAMES:
+        await update.message.reply_text(usage, reply_markup=get_main_keyboard(user_id))
+        return
+    
+    kind = args[0]
+    pvz_id = user[4]
+    weekday = db.get_pvz_reminders(pvz_id).get(kind, (None, None))[0]
+    if len(args) == 3:
+        day = args[1].capitalize()
+        weekday = WEEKDAY_NAMES.index(day) if day in WEEKDAY_NAMES else None
+    
+    try:
+        remind_time = datetime.strptime(args[-1], "%H:%M").strftime("%H:%M")
+    except ValueError:
+        remind_time = None
+    
+    if weekday is None or remind_time is None:
+        await update.message.reply_text(usage, reply_markup=get_main_keyboard(user_id))
+        return
+    
+    db.set_reminder_time(pvz_id, kind, weekday, remind_time)
+    await update.message.reply_text(
+        f"✅ {REMINDER_NAMES[kind]} для ПВЗ {user[6]}: "
+        f"{WEEKDAY_NAMES[weekday]} в {remind_time}",
+        reply_markup=get_main_keyboard(user_id)
+    )
+
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Изменить часовой пояс ПВЗ: /settimezone Asia/Novosibirsk"""
+    # Разрешаем только в приватных чатах
+    if not is_private_chat(update):
+        return
+    
+    user_id = update.effective_user.id
+    if str(user_id) != ADMIN_CHAT_ID:
+        await update.message.reply_text(
+            "❌ У вас нет прав для этой команды.",
+            reply_markup=get_main_keyboard(user_id)
+        )
+        return
+    
+    user = user_cache.get_user(user_id)
+    if not user:
+        await update.message.reply_text(
+            "❌ Сначала зарегистрируйтесь с помощью /start",
+            reply_markup=get_main_keyboard(user_id)
+        )
+        return
+    
+    args = context.args or []
+    timezone_name = args[0] if len(args) == 1 else None
+    if timezone_name:
+        try:
+            get_zone(timezone_name)
+        except (ValueError, ZoneInfoNotFoundError):
+            timezone_name = None
+    
+    if not timezone_name:
+        await update.message.reply_text(
+            "Использование: /settimezone Регион/Город\n"
+            f"Текущий часовой пояс ПВЗ {user[6]}: {get_user_timezone(user)}\n"
+            "Например: /settimezone Asia/Novosibirsk",
+            reply_markup=get_main_keyboard(user_id)
+        )
+        return
+    
+    db.set_pvz_timezone(user[4], timezone_name)
+    # Часовой пояс хранится в строках пользователей ПВЗ
+    user_cache.invalidate()
+    await update.message.reply_text(
+        f"✅ Часовой пояс ПВЗ {user[6]}: {timezone_name}\n"
+        f"Местное время: {format_local_time(timezone_name=timezone_name)}",
         reply_markup=get_main_keyboard(user_id)
     )
 
@@ -814,6 +1685,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Команды:\n"
         "/myschedule - посмотреть мое расписание\n"
         "/setchat - настроить чат для напоминаний (администратор)\n"
+        "/setreminder - время напоминаний (администратор)\n"
+        "/settimezone - часовой пояс ПВЗ (администратор)\n"
+        "/coverage - покрытие смен по получасам (администратор)\n"
+        "/analytics - заполнение анкет по неделям (администратор)\n"
+        "/import - загрузить ПВЗ и сотрудников из CSV (администратор)\n"
         "/help - эта справка"
     )
     await update.message.reply_text(
@@ -821,6 +1697,89 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_keyboard(update.effective_user.id)
     )
 
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начать импорт ПВЗ и сотрудников: /import, затем CSV-файл"""
+    # Разрешаем только в приватных чатах
+    if not is_private_chat(update):
+        return
+    
+    user_id = update.effective_user.id
+    if str(user_id) != ADMIN_CHAT_ID:
+        await update.message.reply_text(
+            "❌ У вас нет прав для этой команды.",
+            reply_markup=get_main_keyboard(user_id)
+        )
+        return
+    
+    db.set_user_state(user_id, {'state': 'waiting_import'})
+    await update.message.reply_text(
+        "📥 Отправьте CSV-файл с ПВЗ и сотрудниками.\n\n"
+        f"Колонки: {', '.join(IMPORT_COLUMNS)} (разделитель - запятая или точка с запятой).\n"
+        "• Строка с паролем создает ПВЗ или меняет его пароль и часовой пояс\n"
+        "• Строка с user_id регистрирует сотрудника в ПВЗ из колонки pvz\n\n"
+        "Пример:\n"
+        "pvz;password;timezone;user_id;full_name;username\n"
+        "Ленина_10;2048;Asia/Novosibirsk;;;\n"
+        "Ленина_10;;;123456789;Иванов Иван;ivanov\n\n"
+        "Если в файле есть ошибки, ничего не загружается.",
+        reply_markup=get_main_keyboard(user_id)
+    )
+
+async def handle_import_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """CSV-файл после /import: проверить и загрузить одной транзакцией"""
+    if not is_private_chat(update):
+        return
+    
+    user_id = update.effective_user.id
+    user_state = db.get_user_state(user_id)
+    if str(user_id) != ADMIN_CHAT_ID or not user_state or user_state.get('state') != 'waiting_import':
+        return
+    db.clear_user_state(user_id)
+    
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_IMPORT_SIZE:
+        await update.message.reply_text(
+            f"❌ Файл больше {MAX_IMPORT_SIZE // 1024} КБ. Разбейте его на части и повторите /import",
+            reply_markup=get_main_keyboard(user_id)
+        )
+        return
+    
+    started_at = time.monotonic()
+    file = await document.get_file()
+    data = bytes(await file.download_as_bytearray())
+    pvz_rows, user_rows, errors = parse_import_csv(decode_import_file(data))
+    
+    stats = None
+    if not errors:
+        if not pvz_rows and not user_rows:
+            errors = ["в файле нет ни одного ПВЗ или сотрудника"]
+        else:
+            stats, errors = db.import_pvz_and_users(pvz_rows, user_rows)
+    
+    if errors:
+        text = f"❌ Импорт отменен, ошибок: {len(errors)}\n\n"
+        text += "\n".join(f"• {error}" for error in errors[:MAX_IMPORT_ERRORS_SHOWN])
+        if len(errors) > MAX_IMPORT_ERRORS_SHOWN:
+            text += f"\n… и еще {len(errors) - MAX_IMPORT_ERRORS_SHOWN}"
+        text += "\n\nИсправьте файл и повторите /import"
+        await update.message.reply_text(text[:MAX_MESSAGE_LENGTH], reply_markup=get_main_keyboard(user_id))
+        return
+    
+    # Новые сотрудники и ПВЗ должны быть видны сразу
+    user_cache.invalidate()
+    logging.info(
+        "Импорт: ПВЗ +%s/~%s, сотрудники +%s/~%s за %.2f с",
+        stats['pvz_created'], stats['pvz_updated'],
+        stats['users_created'], stats['users_updated'], time.monotonic() - started_at
+    )
+    await update.message.reply_text(
+        "✅ Импорт завершен\n\n"
+        f"🏪 ПВЗ: создано {stats['pvz_created']}, обновлено {stats['pvz_updated']}\n"
+        f"👥 Сотрудники: добавлено {stats['users_created']}, обновлено {stats['users_updated']}\n\n"
+        "Новым ПВЗ назначены напоминания по умолчанию.",
+        reply_markup=get_main_keyboard(user_id)
+    )
+
 async def manual_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ручная отправка отчета"""
     # Разрешаем только в приватных чатах
@@ -834,9 +1793,15 @@ async def manual_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    await send_admin_report(context)
+    # /report full - полный отчет новым сообщением, даже без изменений
+    force_full = bool(context.args) and context.args[0] == 'full'
+    unchanged = await send_admin_report(context, force_full=force_full)
+    
+    text = "✅ Отчет отправлен!"
+    if unchanged:
+        text += f"\n\nБез изменений с прошлого отчета: {', '.join(unchanged)}\nПолный отчет: /report full"
     await update.message.reply_text(
-        "✅ Отчет отправлен!",
+        text,
         reply_markup=get_main_keyboard(update.effective_user.id)
     )
 
@@ -878,6 +1843,136 @@ async def manual_sunday_reminders(update: Update, context: ContextTypes.DEFAULT_
         reply_markup=get_main_keyboard(update.effective_user.id)
     )
 
+def build_pvz_coverage(pvz_id, target_week_dates):
+    """Матрица покрытия ПВЗ на неделю и число «Как нужно ПВЗ» по дням"""
+    shifts = db.get_pvz_shifts(pvz_id, target_week_dates, slot_kinds=(SLOT_SHIFT, SLOT_AS_NEEDED))
+    
+    # row структура: [0]user_id, [1]full_name, [2]first_name, [3]username,
+    # [4]date, [5]slot_kind, [6]start_minute, [7]end_minute
+    matrix = build_coverage_matrix(
+        target_week_dates,
+        [(row[4], row[6], row[7]) for row in shifts if row[5] == SLOT_SHIFT]
+    )
+    as_needed_counts = [0] * len(target_week_dates)
+    date_index = {date: i for i, date in enumerate(target_week_dates)}
+    for row in shifts:
+        if row[5] == SLOT_AS_NEEDED:
+            as_needed_counts[date_index[row[4]]] += 1
+    
+    return matrix, as_needed_counts
+
+async def coverage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Покрытие смен по получасам для всех ПВЗ (администратор)"""
+    # Разрешаем только в приватных чатах
+    if not is_private_chat(update):
+        return
+    
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text(
+            "❌ У вас нет прав для этой команды.",
+            reply_markup=get_main_keyboard(update.effective_user.id)
+        )
+        return
+    
+    for pvz in user_cache.get_all_pvz():
+        pvz_id, pvz_name, password, chat_id, timezone_name = pvz
+        target_week_dates = get_target_week_dates(timezone_name)
+        matrix, as_needed_counts = build_pvz_coverage(pvz_id, target_week_dates)
+        
+        text = render_coverage_grid(
+            pvz_name, target_week_dates, matrix, as_needed_counts,
+            COVERAGE_MIN_STAFF, COVERAGE_MAX_STAFF
+        )
+        await update.message.reply_text(
+            text,
+            parse_mode='HTML',
+            reply_markup=get_main_keyboard(update.effective_user.id)
+        )
+
+async def manual_gap_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ручной запуск запросов на незакрытые смены"""
+    # Разрешаем только в приватных чатах
+    if not is_private_chat(update):
+        return
+    
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text(
+            "❌ У вас нет прав для этой команды.",
+            reply_markup=get_main_keyboard(update.effective_user.id)
+        )
+        return
+    
+    await send_gap_requests(context)
+    await update.message.reply_text(
+        "✅ Запросы на незакрытые смены отправлены!",
+        reply_markup=get_main_keyboard(update.effective_user.id)
+    )
+
+def format_fill_minutes(minutes):
+    """Время от напоминания до заполнения анкеты (например, "1 д 5 ч" или "3 ч 20 мин")"""
+    if minutes is None:
+        return "—"
+    hours, minutes = divmod(int(round(minutes)), 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f"{days} д {hours} ч"
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    return f"{minutes} мин"
+
+def build_pvz_analytics(pvz):
+    """Текст /analytics для одного ПВЗ: заполнение по неделям и постоянно не заполняющие"""
+    pvz_id, pvz_name, password, chat_id, timezone_name = pvz
+    target_monday = datetime.strptime(get_target_week_start(timezone_name), "%Y-%m-%d").date()
+    # Целевая неделя и неделя перед ней еще могут меняться - их считаем по
+    # расписанию, более ранние берем из итогов (подсчитываются один раз)
+    live_weeks = [(target_monday - timedelta(weeks=1)).isoformat(), target_monday.isoformat()]
+    since_week = (target_monday - timedelta(weeks=ANALYTICS_WEEKS - 1)).isoformat()
+    utc_offset = int(get_local_time(timezone_name).utcoffset().total_seconds() // 60)
+    
+    db.refresh_fill_summary(pvz_id, since_week, live_weeks[0], utc_offset)
+    weeks, non_fillers = db.get_fill_analytics(pvz_id, since_week, live_weeks, utc_offset, ANALYTICS_MIN_MISSED)
+    
+    text = f"📈 Заполнение анкет: {pvz_name}\n\n"
+    text += "Неделя: заполнили, медиана после субботнего напоминания\n"
+    for week_start, users_total, users_filled, median_minutes in weeks:
+        monday = datetime.strptime(week_start, "%Y-%m-%d").date()
+        rate = round(users_filled * 100 / users_total) if users_total else 0
+        mark = " (идет заполнение)" if week_start in live_weeks else ""
+        text += (
+            f"{monday.strftime('%d.%m')}-{(monday + timedelta(days=6)).strftime('%d.%m')}: "
+            f"{users_filled}/{users_total} ({rate}%), {format_fill_minutes(median_minutes)}{mark}\n"
+        )
+    if not weeks:
+        text += "Нет данных\n"
+    
+    if non_fillers:
+        text += f"\n⚠️ Пропустили {ANALYTICS_MIN_MISSED} и больше завершенных недель:\n"
+        for user_id, full_name, first_name, username, missed, weeks_total, streak in non_fillers:
+            display_name = full_name or first_name or username or f"User_{user_id}"
+            text += f"• {display_name}: пропущено {missed} из {weeks_total}"
+            text += f", подряд {streak}\n" if streak > 1 else "\n"
+    return text
+
+async def analytics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Аналитика заполнения анкет по неделям для всех ПВЗ (администратор)"""
+    # Разрешаем только в приватных чатах
+    if not is_private_chat(update):
+        return
+    
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text(
+            "❌ У вас нет прав для этой команды.",
+            reply_markup=get_main_keyboard(update.effective_user.id)
+        )
+        return
+    
+    for pvz in user_cache.get_all_pvz():
+        await update.message.reply_text(
+            build_pvz_analytics(pvz)[:MAX_MESSAGE_LENGTH],
+            reply_markup=get_main_keyboard(update.effective_user.id)
+        )
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Статистика"""
     # Разрешаем только в приватных чатах
@@ -891,28 +1986,21 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    all_pvz = db.get_all_pvz()
+    all_pvz = user_cache.get_all_pvz()
     stats_text = "📈 Статистика бота:\n\n"
     
+    metrics = context.application.update_processor.get_metrics()
+    stats_text += (
+        f"⚙️ Обновления: в очереди {metrics['waiting']}, выполняются {metrics['in_flight']}, "
+        f"отклонено {metrics['shed']}\n\n"
+    )
+    
     for pvz in all_pvz:
-        pvz_id, pvz_name, password, chat_id = pvz
-        
-        # Получаем количество пользователей для этого ПВЗ
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM users WHERE pvz_id = ?', (pvz_id,))
-        user_count = cursor.fetchone()[0]
-        
-        # Получаем количество заполненных расписаний на эту неделю
-        target_week_dates = get_target_week_dates()
-        placeholders = ','.join('?' for _ in target_week_dates)
-        cursor.execute(f'''
-            SELECT COUNT(DISTINCT user_id) FROM schedule 
-            WHERE date IN ({placeholders})
-            AND user_id IN (SELECT user_id FROM users WHERE pvz_id = ?)
-        ''', (*target_week_dates, pvz_id))
-        filled_count = cursor.fetchone()[0]
-        conn.close()
+        pvz_id, pvz_name, password, chat_id, timezone_name = pvz
+        
+        # Сотрудники ПВЗ и сколько из них заполнили расписание на эту неделю
+        target_week_dates = get_target_week_dates(timezone_name)
+        user_count, filled_count = db.get_pvz_stats(pvz_id, target_week_dates)
         
         stats_text += f"🏪 {pvz_name}:\n"
         stats_text += f"  👥 Сотрудников: {user_count}\n"
@@ -935,9 +2023,231 @@ async def set_commands(application: Application):
     ]
     await application.bot.set_my_commands(commands)
 
-def main():
-    """Основная функция"""
-    application = Application.builder().token(BOT_TOKEN).build()
+def get_worker_id():
+    """Идентификатор текущего процесса бота (для аренд)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def leader_only(callback):
+    """Запускать задачу планировщика только в ведущем процессе.
+
+    Ведущий - процесс, который держит аренду SCHEDULER_LEASE; каждый запуск
+    задачи продлевает ее. Если ведущий процесс остановился, аренду после
+    истечения забирает другой.
+    """
+    async def wrapper(context: ContextTypes.DEFAULT_TYPE):
+        if not db.acquire_lease(SCHEDULER_LEASE, get_worker_id(), SCHEDULER_LEASE_TTL):
+            return
+        await callback(context)
+    wrapper.__name__ = callback.__name__
+    return wrapper
+
+def get_update_log_context(update):
+    """Поля обновления для журнала: update_id, user_id и ПВЗ (если пользователь в кэше)"""
+    if not isinstance(update, Update):
+        return None
+    fields = {'update_id': update.update_id}
+    if update.effective_user:
+        fields['user_id'] = update.effective_user.id
+        # Без обращения к базе - только то, что уже загружено в кэш
+        user = user_cache.users.get(update.effective_user.id)
+        if user:
+            fields['pvz'] = user[6]
+    return fields
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов.
+
+    Обновления одного чата обрабатываются строго по очереди в порядке
+    поступления, чтобы быстрые повторные нажатия не гонялись друг с другом
+    в handle_button_click и при записи черновика анкеты.
+
+    Очередь чата, слоты обработки (max_concurrent_updates) и отказы при
+    перегрузке реализованы в do_process_update: обновление сначала ждет своей
+    очереди в чате и только потом занимает слот, чтобы очередь одного чата не
+    занимала все слоты. Семафор базового класса лишь ограничивает число
+    принятых обновлений.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates=MAX_PENDING_UPDATES,
+                 max_wait=UPDATE_MAX_WAIT):
+        # Семафор базового класса пропускает с запасом: лишние обновления
+        # отклоняются по max_pending_updates, а не ждут перед ним
+        super().__init__(max_concurrent_updates + max_pending_updates)
+        # chat_id -> [блокировка, число ожидающих обновлений]
+        self._chat_locks = {}
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # Сотрудникам доступны не все слоты: один всегда остается для администратора
+        self._employee_slots = asyncio.BoundedSemaphore(max(1, max_concurrent_updates - 1))
+        self.max_pending_updates = max_pending_updates
+        self.max_wait = max_wait
+        # Принятые, но еще не обработанные обновления (ждут очереди или выполняются)
+        self.pending = 0
+        self.in_flight = 0
+        self.shed_count = 0
+        self.max_pending_seen = 0
+
+    @staticmethod
+    def get_chat_key(update):
+        """Ключ очереди для обновления: чат, а если его нет - пользователь"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    @staticmethod
+    def is_priority_update(update):
+        """Обновления администратора (и служебные) обрабатываются вне ограничений"""
+        if not isinstance(update, Update) or not update.effective_user:
+            return True
+        return str(update.effective_user.id) == ADMIN_CHAT_ID
+
+    def get_metrics(self):
+        """Глубина очереди обновлений: ждут, выполняются, отклонено с запуска"""
+        return {
+            'pending': self.pending,
+            'waiting': self.pending - self.in_flight,
+            'in_flight': self.in_flight,
+            'max_pending': self.max_pending_seen,
+            'shed': self.shed_count,
+        }
+
+    async def shed_update(self, update, coroutine, reason):
+        """Отклонить обновление без обработки: ответить «бот занят»"""
+        coroutine.close()
+        self.shed_count += 1
+        logging.debug("Обновление отклонено (%s), в очереди %s", reason, self.pending)
+        try:
+            if update.callback_query:
+                # Ответ на нажатие снимает «часики» с кнопки - можно нажать еще раз
+                await update.callback_query.answer(BUSY_TEXT)
+            elif update.message and update.effective_chat.type == 'private':
+                await update.message.reply_text(BUSY_TEXT)
+        except Exception as e:
+            logging.debug("Не удалось ответить на отклоненное обновление: %s", e)
+
+    async def do_process_update(self, update, coroutine):
+        priority = self.is_priority_update(update)
+        if not priority and self.pending >= self.max_pending_updates:
+            await self.shed_update(update, coroutine, "очередь заполнена")
+            return
+        
+        self.pending += 1
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        try:
+            await self.run_in_chat_order(update, coroutine, priority)
+        finally:
+            self.pending -= 1
+
+    async def run_in_chat_order(self, update, coroutine, priority):
+        """Дождаться очереди чата, затем слота обработки"""
+        received_at = time.monotonic()
+        key = self.get_chat_key(update)
+        if key is None:
+            await self.run_in_slot(update, coroutine, priority, received_at)
+            return
+        
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self.run_in_slot(update, coroutine, priority, received_at)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[key]
+
+    async def run_in_slot(self, update, coroutine, priority, received_at):
+        """Занять слот обработки; обновления сотрудников, прождавшие дольше
+        max_wait, отклоняются, чтобы задержка не росла без предела"""
+        if priority:
+            async with self._slots:
+                await self.run_update(update, coroutine)
+            return
+        async with self._employee_slots:
+            if time.monotonic() - received_at > self.max_wait:
+                await self.shed_update(update, coroutine, "долгое ожидание")
+                return
+            async with self._slots:
+                await self.run_update(update, coroutine)
+
+    async def run_update(self, update, coroutine):
+        """Выполнить обработчики обновления (в занятом слоте)"""
+        # Поля обновления добавляются ко всем записям журнала при его обработке
+        token = log_context.set(get_update_log_context(update))
+        started_at = time.monotonic()
+        self.in_flight += 1
+        try:
+            await coroutine
+        finally:
+            self.in_flight -= 1
+            duration_ms = round((time.monotonic() - started_at) * 1000, 1)
+            if duration_ms >= SLOW_UPDATE_MS:
+                logging.warning("Медленная обработка обновления: %.1f мс", duration_ms, extra={'duration_ms': duration_ms})
+            else:
+                logging.debug("Обновление обработано за %.1f мс", duration_ms, extra={'duration_ms': duration_ms})
+            log_context.reset(token)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+async def release_scheduler_lease(application: Application):
+    """Освободить аренду ведущего при остановке, чтобы другой процесс не ждал ее истечения"""
+    db.release_lease(SCHEDULER_LEASE, get_worker_id())
+
+async def shutdown_storage(application: Application):
+    """Действия с базой при остановке: сохранить черновики анкет, освободить аренду"""
+    try:
+        save_dirty_form_drafts()
+    except Exception as e:
+        logging.error("Ошибка сохранения черновиков анкет при остановке: %s", e)
+    await release_scheduler_lease(application)
+
+async def log_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Записать в лог время от запуска до первого обновления"""
+    if startup_metrics['first_update_seen'] or startup_metrics['started_at'] is None:
+        return
+    startup_metrics['first_update_seen'] = True
+    logging.info("Первое обновление получено через %.2f с после запуска", get_uptime())
+
+async def deferred_startup(context: ContextTypes.DEFAULT_TYPE):
+    """Некритичная инициализация после начала приема обновлений.
+
+    data задачи - устанавливать ли команды меню (только в процессе,
+    который сам принимает обновления).
+    """
+    try:
+        user_cache.preload()
+    except Exception as e:
+        logging.error("Ошибка загрузки кэша пользователей: %s", e)
+    if context.job.data:
+        try:
+            await set_commands(context.application)
+        except Exception as e:
+            logging.error("Ошибка установки команд меню: %s", e)
+    logging.info("Отложенная инициализация завершена через %.2f с после запуска", get_uptime())
+
+def build_application(with_updater=True):
+    """Создать приложение с обработчиками и задачами планировщика"""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    )
+    if not with_updater:
+        # Обновления приходят от процесса-диспетчера
+        builder = builder.updater(None)
+    application = builder.build()
+    
+    # Замер времени до первого обновления (группа -1 - до остальных обработчиков)
+    application.add_handler(TypeHandler(Update, log_first_update), group=-1)
     
     # Добавляем обработчики в правильном порядке (от более специфичных к более общим)
     application.add_handler(CommandHandler("start", start))
@@ -949,36 +2259,194 @@ def main():
     application.add_handler(CommandHandler("collect", manual_collect))
     application.add_handler(CommandHandler("sunday", manual_sunday_reminders))
     application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("coverage", coverage))
+    application.add_handler(CommandHandler("analytics", analytics))
+    application.add_handler(CommandHandler("gaps", manual_gap_requests))
+    application.add_handler(CommandHandler("setreminder", set_reminder))
+    application.add_handler(CommandHandler("settimezone", set_timezone))
+    application.add_handler(CommandHandler("import", import_command))
     application.add_handler(CallbackQueryHandler(handle_button_click))
     
     # Обработчики текстовых сообщений в правильном порядке
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_import_file))
     
-    # Настраиваем планировщик задач с учетом часового пояса Барнаула
+    # Настраиваем планировщик задач (время напоминаний - по часовому поясу каждого ПВЗ)
     job_queue = application.job_queue
     
     if job_queue:
-        # Задача на субботу (каждую субботу в 9:00 по Барнаулу)
-        job_queue.run_daily(
-            start_schedule_collection,
-            time=datetime.strptime("02:00", "%H:%M").time(),  # 9:00 Барнаул - 7 часов = 02:00 UTC
-            days=(5,)
+        # Субботние и воскресные напоминания по расписанию каждого ПВЗ
+        # (таблица reminder_schedule). Первая проверка сразу после старта
+        # догоняет напоминания, пропущенные во время перезапуска
+        job_queue.run_repeating(
+            leader_only(dispatch_due_reminders),
+            interval=REMINDER_CHECK_INTERVAL,
+            first=5
+        )
+        
+        # Сводка уведомлений администратору (первый запуск вскоре после старта -
+        # досылаем то, что накопилось до перезапуска)
+        job_queue.run_repeating(
+            leader_only(flush_admin_notifications),
+            interval=ADMIN_DIGEST_INTERVAL,
+            first=10
         )
         
-        # Задача на воскресенье (каждое воскресенье в 9:00 по Барнаулу)
-        job_queue.run_daily(
-            send_sunday_reminders,
-            time=datetime.strptime("02:00", "%H:%M").time(),  # 9:00 Барнаул - 7 часов = 02:00 UTC
-            days=(6,)
+        # Очистка журнала изменений расписания раз в сутки
+        job_queue.run_repeating(
+            leader_only(prune_schedule_changes),
+            interval=24 * 3600,
+            first=3600
         )
+        
+        # Черновики анкет (в каждом процессе - у каждого своя копия в памяти):
+        # сохранение измененных и удаление брошенных
+        job_queue.run_repeating(
+            flush_form_drafts,
+            interval=FORM_DRAFT_FLUSH_INTERVAL,
+            first=FORM_DRAFT_FLUSH_INTERVAL
+        )
+        job_queue.run_repeating(cleanup_form_drafts, interval=3600, first=60)
+        
+        # Метрики очереди обновлений (в каждом процессе - у каждого своя очередь)
+        job_queue.run_repeating(
+            log_update_metrics,
+            interval=UPDATE_METRICS_INTERVAL,
+            first=UPDATE_METRICS_INTERVAL,
+            data={'shed': 0}
+        )
+        
+        # Кэш пользователей и команды меню - после запуска, чтобы не задерживать
+        # прием обновлений (кэш нужен и рабочим процессам)
+        job_queue.run_once(deferred_startup, when=0, data=with_updater)
+    
+    return application
+
+def get_update_shard(update_data, workers):
+    """Номер рабочего процесса для обновления.
+
+    Все обновления одного чата попадают в один процесс, поэтому
+    порядок обработки в пределах чата сохраняется.
+    """
+    for key in ('message', 'edited_message', 'callback_query', 'my_chat_member'):
+        if key in update_data:
+            payload = update_data[key]
+            chat = payload.get('chat') or (payload.get('message') or {}).get('chat') or payload.get('from') or {}
+            return chat.get('id', 0) % workers
+    return 0
+
+def run_worker(worker_index, update_queue):
+    """Рабочий процесс: обрабатывает обновления, полученные от диспетчера"""
+    setup_logging()
+    mark_startup()
+    
+    async def process_updates():
+        application = build_application(with_updater=False)
+        loop = asyncio.get_running_loop()
+        async with application:
+            await application.start()
+            logging.info("Рабочий процесс %s (%s) запущен", worker_index, get_worker_id())
+            try:
+                while True:
+                    data = await loop.run_in_executor(None, update_queue.get)
+                    if data is None:
+                        break
+                    update = Update.de_json(json.loads(data), application.bot)
+                    await application.update_queue.put(update)
+            finally:
+                await application.stop()
+                await shutdown_storage(application)
+    
+    try:
+        asyncio.run(process_updates())
+    except KeyboardInterrupt:
+        pass
+
+async def dispatch_updates(worker_queues):
+    """Процесс-диспетчер: получает обновления (polling или вебхук) и раздает их рабочим"""
+    application = Application.builder().token(BOT_TOKEN).build()
+    async with application:
+        updater = application.updater
+        if WEBHOOK_URL:
+            await updater.start_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=BOT_TOKEN,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}"
+            )
+        else:
+            await updater.start_polling()
+        logging.info("Диспетчер принимает обновления через %.2f с после запуска", get_uptime())
+        
+        # Команды меню - в фоне, прием обновлений уже идет
+        commands_task = asyncio.create_task(set_commands(application))
+        
+        try:
+            while True:
+                update = await updater.update_queue.get()
+                update_data = update.to_dict()
+                shard = get_update_shard(update_data, len(worker_queues))
+                worker_queues[shard].put(json.dumps(update_data))
+        finally:
+            commands_task.cancel()
+            await updater.stop()
+
+def run_multiprocess():
+    """Запуск диспетчера и BOT_WORKERS рабочих процессов"""
+    worker_queues = [multiprocessing.Queue() for _ in range(BOT_WORKERS)]
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(i, queue), name=f"bot-worker-{i}")
+        for i, queue in enumerate(worker_queues)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    try:
+        asyncio.run(dispatch_updates(worker_queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in worker_queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+def main():
+    """Основная функция"""
+    setup_logging()
+    check_config()
+    mark_startup()
     
-    # Устанавливаем команды меню
-    application.post_init = set_commands
+    # Проверка схемы - до запуска рабочих процессов, чтобы они не мигрировали
+    # базу одновременно (при актуальной версии схемы это один PRAGMA)
+    db.ensure_schema()
+    
+    logging.info("Бот запущен, часовой пояс по умолчанию: %s...", DEFAULT_TIMEZONE)
+    print(f"Бот успешно запущен! Часовой пояс по умолчанию: {DEFAULT_TIMEZONE}")
+    
+    if BOT_WORKERS > 1:
+        logging.info("Режим нескольких процессов: %s рабочих", BOT_WORKERS)
+        run_multiprocess()
+        return
+    
+    application = build_application()
+    
+    # Команды меню устанавливаются отложенной задачей после запуска;
+    # без планировщика - как раньше, перед запуском
+    if not application.job_queue:
+        application.post_init = set_commands
+    application.post_shutdown = shutdown_storage
     
     # Запускаем бота
-    logging.info("Бот запущен с часовым поясом Барнаул (UTC+7)...")
-    print("Бот успешно запущен! Часовой пояс: Барнаул (UTC+7)")
-    application.run_polling()
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}"
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
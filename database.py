@@ -1,18 +1,158 @@
+import hashlib
+import json
+import re
 import sqlite3
 import logging
-from datetime import datetime
+import sys
+import time
+from pathlib import Path
+from datetime import date, datetime, timedelta
 
+from storage import Storage
 
-class Database:
-    def __init__(self, db_name='schedule_bot.db'):
+# Версия схемы базы (PRAGMA user_version). Увеличивайте при каждом изменении
+# init_database - иначе уже инициализированные базы не получат изменения
+SCHEMA_VERSION = 6
+
+# Часовой пояс ПВЗ по умолчанию
+DEFAULT_TIMEZONE = 'Asia/Barnaul'
+
+# Напоминания по умолчанию: (тип, день недели, время)
+DEFAULT_REMINDERS = (
+    ('saturday', 5, '09:00'),
+    ('sunday', 6, '09:00'),
+    ('gaps', 6, '18:00'),
+)
+
+# Виды записей расписания (schedule.slot_kind)
+SLOT_SHIFT = 'shift'            # смена с известным временем начала и окончания
+SLOT_AS_NEEDED = 'asneeded'     # "Как нужно ПВЗ"
+SLOT_DAY_OFF = 'dayoff'         # "Выходной"
+SLOT_UNKNOWN = 'unknown'        # строка, которую не удалось разобрать
+
+SLOT_KIND_BY_TEXT = {
+    'Как нужно ПВЗ': SLOT_AS_NEEDED,
+    'Выходной': SLOT_DAY_OFF,
+}
+
+# Заполнение анкеты сотрудниками ПВЗ по неделям из CTE weeks (week_start):
+# (week_start, user_id, fill_minutes), fill_minutes - минуты от субботнего
+# напоминания до сохранения анкеты на неделю (NULL - не заполнил). Напоминание
+# о неделе week_start приходит за неделю до ее начала: week_start - 14 дней +
+# день недели напоминания, время - местное (:utc_offset - минуты от UTC).
+# Сотрудник учитывается с недели, начавшейся после его регистрации в ПВЗ
+# (или раньше, если он уже заполнил анкету на эту неделю)
+USER_WEEK_FILL_SQL = '''
+    SELECT w.week_start, u.user_id, (
+        SELECT MAX(0, CAST(ROUND((julianday(MIN(s.created_at)) - (
+            julianday(w.week_start || ' ' || COALESCE(r.remind_time, '09:00'))
+            + COALESCE(r.weekday, 5) - 14 - :utc_offset / 1440.0
+        )) * 1440) AS INTEGER))
+        FROM schedule s
+        WHERE s.user_id = u.user_id AND s.week_start = w.week_start
+    ) AS fill_minutes
+    FROM weeks w
+    JOIN users u ON u.pvz_id = :pvz_id AND (
+        u.registered_at IS NULL OR u.registered_at < w.week_start
+        OR EXISTS (SELECT 1 FROM schedule s WHERE s.user_id = u.user_id AND s.week_start = w.week_start)
+    )
+    LEFT JOIN reminder_schedule r ON r.pvz_id = :pvz_id AND r.kind = 'saturday'
+'''
+
+# "9.00-15.00", "9:30-14:00"
+TIME_RANGE_RE = re.compile(r'^\s*(\d{1,2})[.:](\d{2})\s*-\s*(\d{1,2})[.:](\d{2})\s*$')
+
+
+def parse_time_slot(time_slot):
+    """Разобрать строку расписания: (вид, начало в минутах от полуночи, конец в минутах)"""
+    if time_slot in SLOT_KIND_BY_TEXT:
+        return SLOT_KIND_BY_TEXT[time_slot], None, None
+
+    match = TIME_RANGE_RE.match(time_slot or '')
+    if match:
+        start_hour, start_minute, end_hour, end_minute = map(int, match.groups())
+        start = start_hour * 60 + start_minute
+        end = end_hour * 60 + end_minute
+        if start < end:
+            return SLOT_SHIFT, start, end
+
+    return SLOT_UNKNOWN, None, None
+
+
+def get_week_start(day_month, reference=None):
+    """Понедельник недели, в которую попадает дата "дд.мм" (строка ГГГГ-ММ-ДД).
+
+    В schedule.date год не хранится, поэтому берется ближайшая к reference
+    (по умолчанию - сегодня по UTC) дата с таким днем и месяцем.
+    """
+    reference = reference or datetime.utcnow().date()
+    day, month = map(int, day_month.split('.'))
+    candidates = []
+    # Для 29.02 ближайший високосный год может быть в нескольких годах от reference
+    for year in range(reference.year - 4, reference.year + 5):
+        try:
+            candidates.append(date(year, month, day))
+        except ValueError:
+            continue
+    nearest = min(candidates, key=lambda candidate: abs(candidate - reference))
+    return (nearest - timedelta(days=nearest.weekday())).isoformat()
+
+
+def get_week_starts(dates):
+    """Понедельники недель дат "дд.мм" - вместе с датой однозначно задают запись
+    расписания (одна и та же "дд.мм" встречается каждый год)"""
+    return sorted({get_week_start(date) for date in dates})
+
+
+def get_report_names_digest(pvz_name, members):
+    """Хэш названия ПВЗ и имен сотрудников отчета - часть версии расписания.
+
+    members - [(user_id, full_name, first_name, username), ...] по user_id.
+    hashlib, а не hash(): версия сохраняется в базе и сравнивается другими
+    процессами, а hash() строк в каждом процессе свой.
+    """
+    data = json.dumps([pvz_name, [list(member) for member in members]], ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+
+class Database(Storage):
+    """Хранилище в файле SQLite (основное)"""
+
+    def __init__(self, db_name='schedule_bot.db', snapshot_max_age=0):
+        # Файл базы не открывается до первого запроса: схема проверяется
+        # лениво в get_connection (или явно через ensure_schema)
         self.db_name = db_name
-        self.init_database()
+        self.schema_ready = False
+        # Тяжелые отчеты читают из копии базы в памяти, если snapshot_max_age > 0
+        # (копия обновляется не реже раза в snapshot_max_age секунд), иначе -
+        # через отдельные соединения только для чтения (читатели WAL)
+        self.snapshot_max_age = snapshot_max_age
+        self.snapshot_uri = f'file:snapshot_{id(self)}?mode=memory&cache=shared'
+        self.snapshot_keeper = None
+        self.snapshot_taken_at = None
+
+    def ensure_schema(self):
+        """Проверить схему базы один раз за процесс"""
+        if not self.schema_ready:
+            self.init_database()
 
     def init_database(self):
-        """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_name)
+        """Инициализация базы данных (пропускается, если версия схемы актуальна)"""
+        started_at = time.monotonic()
+        conn = sqlite3.connect(self.db_name, timeout=30)
         cursor = conn.cursor()
 
+        cursor.execute('PRAGMA user_version')
+        if cursor.fetchone()[0] == SCHEMA_VERSION:
+            conn.close()
+            self.schema_ready = True
+            logging.info("Схема базы данных актуальна (версия %s), проверка пропущена", SCHEMA_VERSION)
+            return
+
+        # Журнал WAL (сохраняется в файле базы): читатели не блокируют запись
+        # анкет и не ждут ее, каждый читает согласованный снимок
+        cursor.execute('PRAGMA journal_mode = WAL')
+
         # Таблица ПВЗ
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS pvz (
@@ -23,6 +163,12 @@ class Database:
             )
         ''')
 
+        # Часовой пояс ПВЗ (добавлен позже - мигрируем существующие базы)
+        cursor.execute('PRAGMA table_info(pvz)')
+        pvz_columns = [row[1] for row in cursor.fetchall()]
+        if 'timezone' not in pvz_columns:
+            cursor.execute(f"ALTER TABLE pvz ADD COLUMN timezone TEXT NOT NULL DEFAULT '{DEFAULT_TIMEZONE}'")
+
         # Таблица пользователей
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -48,19 +194,256 @@ class Database:
             )
         ''')
 
+        # Разобранное время смены (добавлено позже - мигрируем существующие базы)
+        cursor.execute('PRAGMA table_info(schedule)')
+        schedule_columns = [row[1] for row in cursor.fetchall()]
+        if 'slot_kind' not in schedule_columns:
+            cursor.execute('ALTER TABLE schedule ADD COLUMN start_minute INTEGER')
+            cursor.execute('ALTER TABLE schedule ADD COLUMN end_minute INTEGER')
+            cursor.execute('ALTER TABLE schedule ADD COLUMN slot_kind TEXT')
+            cursor.execute('SELECT id, time_slot FROM schedule')
+            cursor.executemany(
+                'UPDATE schedule SET slot_kind = ?, start_minute = ?, end_minute = ? WHERE id = ?',
+                [(*parse_time_slot(time_slot), schedule_id) for schedule_id, time_slot in cursor.fetchall()]
+            )
+
+        # Индекс для поиска смен, пересекающих время (покрытие ПВЗ)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_schedule_interval
+            ON schedule (date, slot_kind, start_minute, end_minute)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_schedule_user_date
+            ON schedule (user_id, date)
+        ''')
+
+        # Неделя записи - понедельник ГГГГ-ММ-ДД (добавлено позже). Для старых
+        # записей год восстанавливается по дате заполнения анкеты
+        if 'week_start' not in schedule_columns:
+            cursor.execute('ALTER TABLE schedule ADD COLUMN week_start TEXT')
+            cursor.execute('SELECT id, date, created_at FROM schedule')
+            cursor.executemany(
+                'UPDATE schedule SET week_start = ? WHERE id = ?',
+                [
+                    (get_week_start(day_month, datetime.fromisoformat(created_at).date() if created_at else None), schedule_id)
+                    for schedule_id, day_month, created_at in cursor.fetchall()
+                ]
+            )
+
+        # Индекс для постраничного просмотра расписания по неделям
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_schedule_user_week
+            ON schedule (user_id, week_start)
+        ''')
+
+        # Время регистрации в текущем ПВЗ (UTC, добавлено позже - мигрируем
+        # существующие базы). Для старых пользователей - время первой записи
+        # расписания, а если их нет - время миграции
+        cursor.execute('PRAGMA table_info(users)')
+        if 'registered_at' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE users ADD COLUMN registered_at TIMESTAMP')
+            cursor.execute('''
+                UPDATE users SET registered_at = COALESCE(
+                    (SELECT MIN(created_at) FROM schedule WHERE schedule.user_id = users.user_id),
+                    CURRENT_TIMESTAMP
+                )
+            ''')
+
+        # Черновики анкет: ответы копятся здесь и переносятся в schedule
+        # одной транзакцией после ответа на последний день
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS form_drafts (
+                user_id INTEGER PRIMARY KEY,
+                week TEXT NOT NULL,
+                answers TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Номер дня, который изменяется отдельно от остальной недели (добавлено
+        # позже - мигрируем существующие базы); NULL - анкета на всю неделю
+        cursor.execute('PRAGMA table_info(form_drafts)')
+        if 'single_day' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE form_drafts ADD COLUMN single_day INTEGER')
+
+        # Журнал изменений расписания (только добавление). Пишется триггерами
+        # в той же транзакции, что и само изменение, поэтому попадают все
+        # изменения, кто бы их ни делал
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schedule_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                operation TEXT NOT NULL,
+                schedule_id INTEGER NOT NULL,
+                user_id INTEGER,
+                date TEXT NOT NULL,
+                time_slot TEXT NOT NULL,
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS schedule_changes_insert
+            AFTER INSERT ON schedule
+            BEGIN
+                INSERT INTO schedule_changes (operation, schedule_id, user_id, date, time_slot)
+                VALUES ('insert', NEW.id, NEW.user_id, NEW.date, NEW.time_slot);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS schedule_changes_delete
+            AFTER DELETE ON schedule
+            BEGIN
+                INSERT INTO schedule_changes (operation, schedule_id, user_id, date, time_slot)
+                VALUES ('delete', OLD.id, OLD.user_id, OLD.date, OLD.time_slot);
+            END
+        ''')
+
+        # Позиции читателей журнала изменений (последний обработанный id)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS change_cursors (
+                consumer TEXT PRIMARY KEY,
+                last_change_id INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Последний отправленный администратору отчет по ПВЗ и неделе:
+        # version - (число записей, максимальный id) расписания на момент отчета,
+        # snapshot - содержимое отчета (JSON) для вычисления изменений
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS report_snapshots (
+                pvz_id INTEGER NOT NULL,
+                week TEXT NOT NULL,
+                version TEXT NOT NULL,
+                snapshot TEXT NOT NULL,
+                message_id INTEGER,
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (pvz_id, week)
+            )
+        ''')
+
+        # Очередь уведомлений администратору (сводки)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS admin_notifications (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                text TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_admin_notifications_pending
+            ON admin_notifications (sent_at, id)
+        ''')
+
+        # Расписание напоминаний: время местное (по часовому поясу ПВЗ),
+        # last_run_at - время последнего запуска в UTC
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reminder_schedule (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pvz_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                weekday INTEGER NOT NULL,
+                remind_time TEXT NOT NULL,
+                last_run_at TEXT,
+                UNIQUE (pvz_id, kind),
+                FOREIGN KEY (pvz_id) REFERENCES pvz (id)
+            )
+        ''')
+
+        # Состояния диалога пользователей (регистрация) - общие для всех процессов бота
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_states (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Итоги заполнения завершенных недель для /analytics: строка на сотрудника
+        # ПВЗ и неделю (состав ПВЗ - на момент подсчета), fill_minutes - как в
+        # USER_WEEK_FILL_SQL. Завершенные недели не пересчитываются
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS week_fill (
+                pvz_id INTEGER NOT NULL,
+                week_start TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                fill_minutes INTEGER,
+                PRIMARY KEY (pvz_id, week_start, user_id)
+            )
+        ''')
+
+        # Аренды (leases) для координации процессов, например выбор ведущего
+        # процесса, который запускает напоминания. expires_at - unix time
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+
         # Добавляем ПВЗ Промышленная_6
         cursor.execute('''
             INSERT OR IGNORE INTO pvz (name, password) VALUES 
             ('Промышленная_6', '1525')
         ''')
 
+        # Напоминания по умолчанию для каждого ПВЗ (DEFAULT_REMINDERS).
+        # last_run_at = сейчас, чтобы новые записи не догоняли прошлые запуски
+        for kind, weekday, remind_time in DEFAULT_REMINDERS:
+            cursor.execute('''
+                INSERT OR IGNORE INTO reminder_schedule (pvz_id, kind, weekday, remind_time, last_run_at)
+                SELECT id, ?, ?, ?, ? FROM pvz
+            ''', (kind, weekday, remind_time, datetime.utcnow().isoformat()))
+
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
         conn.commit()
         conn.close()
-        logging.info("База данных инициализирована")
+        self.schema_ready = True
+        logging.info("База данных инициализирована за %.3f с", time.monotonic() - started_at)
 
     def get_connection(self):
         """Получить соединение с базой данных"""
-        return sqlite3.connect(self.db_name)
+        self.ensure_schema()
+        # С базой могут одновременно работать несколько процессов бота -
+        # ждем освобождения блокировки, а не падаем сразу
+        return sqlite3.connect(self.db_name, timeout=30)
+
+    def get_read_connection(self):
+        """Соединение только для чтения для тяжелых отчетов.
+
+        Без копии в памяти - отдельное соединение к файлу в режиме только для
+        чтения: в режиме WAL оно видит последний зафиксированный снимок и не
+        конкурирует с записью анкет. С копией - соединение к копии, которая
+        обновляется, если старше snapshot_max_age секунд.
+        """
+        self.ensure_schema()
+        if self.snapshot_max_age > 0:
+            self.refresh_snapshot()
+            conn = sqlite3.connect(self.snapshot_uri, uri=True)
+        else:
+            conn = sqlite3.connect(f'{Path(self.db_name).resolve().as_uri()}?mode=ro', uri=True, timeout=30)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def refresh_snapshot(self, force=False):
+        """Обновить копию базы в памяти (sqlite3 backup API), если она устарела"""
+        if (not force and self.snapshot_taken_at is not None
+                and time.monotonic() - self.snapshot_taken_at <= self.snapshot_max_age):
+            return
+
+        started_at = time.monotonic()
+        if self.snapshot_keeper is None:
+            # Общая база в памяти живет, пока открыто хотя бы одно соединение
+            self.snapshot_keeper = sqlite3.connect(self.snapshot_uri, uri=True)
+        source = sqlite3.connect(self.db_name, timeout=30)
+        try:
+            source.backup(self.snapshot_keeper)
+        finally:
+            source.close()
+        self.snapshot_taken_at = time.monotonic()
+        logging.info("Копия базы для отчетов обновлена за %.3f с", self.snapshot_taken_at - started_at)
 
     def get_pvz_by_password(self, password):
         """Получить ПВЗ по паролю"""
@@ -81,13 +464,15 @@ class Database:
         return pvz
 
     def add_user(self, user_id, username, first_name, pvz_id, full_name=None):
-        """Добавить пользователя"""
+        """Добавить пользователя (время регистрации сохраняется, если ПВЗ не меняется)"""
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name, pvz_id, full_name)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, pvz_id, full_name))
+            INSERT OR REPLACE INTO users (user_id, username, first_name, pvz_id, full_name, registered_at)
+            VALUES (?, ?, ?, ?, ?, COALESCE(
+                (SELECT registered_at FROM users WHERE user_id = ? AND pvz_id = ?), CURRENT_TIMESTAMP
+            ))
+        ''', (user_id, username, first_name, pvz_id, full_name, user_id, pvz_id))
         conn.commit()
         conn.close()
 
@@ -96,7 +481,8 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT u.*, p.name as pvz_name 
+            SELECT u.id, u.user_id, u.username, u.first_name, u.pvz_id, u.full_name,
+                   p.name as pvz_name, p.timezone as pvz_timezone
             FROM users u 
             LEFT JOIN pvz p ON u.pvz_id = p.id 
             WHERE u.user_id = ?
@@ -105,72 +491,533 @@ class Database:
         conn.close()
         return user
 
-    def save_schedule(self, user_id, date, time_slot):
-        """Сохранить расписание"""
+    def get_all_users(self):
+        """Получить всех пользователей (строки в формате get_user)"""
         conn = self.get_connection()
         cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.id, u.user_id, u.username, u.first_name, u.pvz_id, u.full_name,
+                   p.name as pvz_name, p.timezone as pvz_timezone
+            FROM users u
+            LEFT JOIN pvz p ON u.pvz_id = p.id
+        ''')
+        users = cursor.fetchall()
+        conn.close()
+        return users
 
-        # Удаляем старую запись для этой даты
-        cursor.execute('DELETE FROM schedule WHERE user_id = ? AND date = ?', (user_id, date))
+    def get_filled_user_ids(self, pvz_id, week_dates):
+        """Пользователи ПВЗ, у которых есть расписание хотя бы на один день недели"""
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        week_starts = get_week_starts(week_dates)
+        cursor.execute(f'''
+            SELECT DISTINCT user_id
+            FROM schedule
+            WHERE week_start IN ({','.join('?' for _ in week_starts)})
+            AND date IN ({','.join('?' for _ in week_dates)})
+            AND user_id IN (SELECT user_id FROM users WHERE pvz_id = ?)
+        ''', (*week_starts, *week_dates, pvz_id))
+        filled_users = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        return filled_users
+
+    def import_pvz_and_users(self, pvz_rows, user_rows):
+        """Загрузить ПВЗ и сотрудников одной транзакцией (команда /import).
+
+        pvz_rows - {имя: (пароль, часовой пояс или None)}: новые ПВЗ создаются
+        с напоминаниями по умолчанию, у существующих обновляются пароль и
+        часовой пояс (если указан). user_rows - [(user_id, username, full_name,
+        имя ПВЗ), ...]: сотрудники регистрируются или переводятся в этот ПВЗ.
+
+        Возвращает (статистика, ошибки). Если есть ошибки, ничего не меняется.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        errors = []
+        try:
+            cursor.execute('SELECT name FROM pvz')
+            existing_pvz = {row[0] for row in cursor.fetchall()}
+            user_ids = [row[0] for row in user_rows]
+            existing_users = set()
+            # Ограничение SQLite на число параметров запроса
+            for i in range(0, len(user_ids), 500):
+                chunk = user_ids[i:i + 500]
+                placeholders = ','.join('?' for _ in chunk)
+                cursor.execute(f'SELECT user_id FROM users WHERE user_id IN ({placeholders})', chunk)
+                existing_users.update(row[0] for row in cursor.fetchall())
 
-        # Добавляем новую запись
+            cursor.executemany('''
+                INSERT INTO pvz (name, password, timezone) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET
+                    password = excluded.password,
+                    timezone = COALESCE(?, timezone)
+            ''', [
+                (name, password, timezone_name or DEFAULT_TIMEZONE, timezone_name)
+                for name, (password, timezone_name) in pvz_rows.items()
+            ])
+
+            # Пароль - единственный способ выбрать ПВЗ при регистрации
+            cursor.execute('''
+                SELECT password, GROUP_CONCAT(name, ', ') FROM pvz
+                GROUP BY password HAVING COUNT(*) > 1
+            ''')
+            for password, names in cursor.fetchall():
+                errors.append(f"пароль {password} у нескольких ПВЗ: {names}")
+
+            cursor.execute('SELECT name, id FROM pvz')
+            pvz_ids = dict(cursor.fetchall())
+            unknown_pvz = sorted({row[3] for row in user_rows} - pvz_ids.keys())
+            for name in unknown_pvz:
+                errors.append(f"ПВЗ {name} не найден (для нового ПВЗ укажите пароль)")
+
+            if errors:
+                conn.rollback()
+                return None, errors
+
+            # Напоминания по умолчанию для новых ПВЗ (как в init_database)
+            now = datetime.utcnow().isoformat()
+            cursor.executemany('''
+                INSERT OR IGNORE INTO reminder_schedule (pvz_id, kind, weekday, remind_time, last_run_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (pvz_ids[name], kind, weekday, remind_time, now)
+                for name in pvz_rows.keys() - existing_pvz
+                for kind, weekday, remind_time in DEFAULT_REMINDERS
+            ])
+
+            cursor.executemany('''
+                INSERT INTO users (user_id, username, pvz_id, full_name, registered_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = COALESCE(excluded.username, username),
+                    pvz_id = excluded.pvz_id,
+                    full_name = COALESCE(excluded.full_name, full_name),
+                    registered_at = CASE WHEN pvz_id = excluded.pvz_id
+                                         THEN registered_at ELSE excluded.registered_at END
+            ''', [
+                (user_id, username, pvz_ids[pvz_name], full_name)
+                for user_id, username, full_name, pvz_name in user_rows
+            ])
+
+            conn.commit()
+        finally:
+            conn.close()
+
+        stats = {
+            'pvz_created': len(pvz_rows.keys() - existing_pvz),
+            'pvz_updated': len(pvz_rows.keys() & existing_pvz),
+            'users_created': len(set(user_ids) - existing_users),
+            'users_updated': len(existing_users),
+        }
+        return stats, errors
+
+    def save_week_schedule(self, user_id, answers):
+        """Записать ответы анкеты {дата: время} одной транзакцией и удалить черновик"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        week_starts = {date: get_week_start(date) for date in answers}
+        cursor.executemany(
+            'DELETE FROM schedule WHERE user_id = ? AND week_start = ? AND date = ?',
+            [(user_id, week_start, date) for date, week_start in week_starts.items()]
+        )
+        cursor.executemany('''
+            INSERT INTO schedule (user_id, date, time_slot, slot_kind, start_minute, end_minute, week_start)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (user_id, date, time_slot, *parse_time_slot(time_slot), week_starts[date])
+            for date, time_slot in answers.items()
+        ])
+        cursor.execute('DELETE FROM form_drafts WHERE user_id = ?', (user_id,))
+
+        conn.commit()
+        conn.close()
+
+    def get_user_previous_week(self, user_id, week_start):
+        """Последняя неделя с записями до week_start (ГГГГ-ММ-ДД) или None"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO schedule (user_id, date, time_slot)
-            VALUES (?, ?, ?)
-        ''', (user_id, date, time_slot))
+            SELECT MAX(week_start) FROM schedule
+            WHERE user_id = ? AND week_start < ?
+        ''', (user_id, week_start))
+        previous_week = cursor.fetchone()[0]
+        conn.close()
+        return previous_week
+
+    def copy_previous_week(self, user_id, week_start):
+        """Скопировать последнюю заполненную неделю пользователя на неделю week_start.
+
+        Расписание недели week_start и черновик анкеты заменяются одной
+        транзакцией; даты сдвигаются на соответствующие дни новой недели
+        прямо в INSERT ... SELECT. Возвращает (исходная неделя или None,
+        число скопированных дней).
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT MAX(week_start) FROM schedule
+            WHERE user_id = ? AND week_start < ?
+        ''', (user_id, week_start))
+        source_week = cursor.fetchone()[0]
+        if source_week is None:
+            conn.close()
+            return None, 0
+
+        cursor.execute('DELETE FROM schedule WHERE user_id = ? AND week_start = ?', (user_id, week_start))
+        # Номер дня недели записи (0-6) находится сопоставлением ее даты "дд.мм"
+        # с днями исходной недели
+        cursor.execute('''
+            INSERT INTO schedule (user_id, date, time_slot, slot_kind, start_minute, end_minute, week_start)
+            WITH days (offset) AS (VALUES (0), (1), (2), (3), (4), (5), (6))
+            SELECT s.user_id, strftime('%d.%m', :week_start, '+' || d.offset || ' days'),
+                   s.time_slot, s.slot_kind, s.start_minute, s.end_minute, :week_start
+            FROM schedule s
+            JOIN days d ON strftime('%d.%m', s.week_start, '+' || d.offset || ' days') = s.date
+            WHERE s.user_id = :user_id AND s.week_start = :source_week
+        ''', {'user_id': user_id, 'week_start': week_start, 'source_week': source_week})
+        copied = cursor.rowcount
+        cursor.execute('DELETE FROM form_drafts WHERE user_id = ?', (user_id,))
 
         conn.commit()
         conn.close()
+        return source_week, copied
 
-    def delete_user_schedule(self, user_id):
-        """Удалить все расписание пользователя"""
+    def get_form_draft(self, user_id, max_age_hours):
+        """Черновик анкеты не старше max_age_hours: (неделя, {дата: время}, single_day) или None"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('DELETE FROM schedule WHERE user_id = ?', (user_id,))
+        cursor.execute('''
+            SELECT week, answers, single_day FROM form_drafts
+            WHERE user_id = ? AND updated_at > datetime('now', ?)
+        ''', (user_id, f'-{max_age_hours} hours'))
+        result = cursor.fetchone()
+        conn.close()
+        return (result[0], json.loads(result[1]), result[2]) if result else None
+
+    def save_form_drafts(self, drafts):
+        """Сохранить черновики анкет одной транзакцией.
+
+        drafts - список (user_id, неделя, {дата: время}, single_day), где
+        single_day - номер дня, если изменяется один день, иначе None.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT OR REPLACE INTO form_drafts (user_id, week, answers, single_day, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', [
+            (user_id, week, json.dumps(answers, ensure_ascii=False), single_day)
+            for user_id, week, answers, single_day in drafts
+        ])
         conn.commit()
         conn.close()
 
-    def get_user_schedule(self, user_id, week_dates=None):
-        """Получить расписание пользователя"""
+    def delete_expired_form_drafts(self, max_age_hours):
+        """Удалить брошенные черновики старше max_age_hours, вернуть их количество"""
         conn = self.get_connection()
         cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM form_drafts WHERE updated_at <= datetime('now', ?)",
+            (f'-{max_age_hours} hours',)
+        )
+        deleted = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return deleted
 
-        if week_dates:
-            placeholders = ','.join('?' for _ in week_dates)
-            cursor.execute(f'''
-                SELECT date, time_slot FROM schedule 
-                WHERE user_id = ? AND date IN ({placeholders})
-            ''', (user_id, *week_dates))
-        else:
-            cursor.execute('SELECT date, time_slot FROM schedule WHERE user_id = ?', (user_id,))
+    def get_user_schedule(self, user_id, week_dates):
+        """Расписание пользователя на даты "дд.мм" ближайших недель: {дата: время}"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        week_starts = get_week_starts(week_dates)
+        cursor.execute(f'''
+            SELECT date, time_slot FROM schedule
+            WHERE user_id = ? AND week_start IN ({','.join('?' for _ in week_starts)})
+            AND date IN ({','.join('?' for _ in week_dates)})
+        ''', (user_id, *week_starts, *week_dates))
 
         schedule = cursor.fetchall()
         conn.close()
         return {row[0]: row[1] for row in schedule}
 
+    def get_user_week_schedule(self, user_id, week_start):
+        """Расписание пользователя на неделю с понедельника week_start (ГГГГ-ММ-ДД).
+
+        Возвращает ({дата: время}, предыдущая неделя с записями или None,
+        следующая неделя с записями или None). Соседние недели ищутся по
+        индексу (user_id, week_start), поэтому страница загружается за
+        одно и то же время при любой длине истории.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute(
+            'SELECT date, time_slot FROM schedule WHERE user_id = ? AND week_start = ?',
+            (user_id, week_start)
+        )
+        schedule = {row[0]: row[1] for row in cursor.fetchall()}
+
+        cursor.execute('''
+            SELECT MAX(week_start) FROM schedule
+            WHERE user_id = ? AND week_start < ?
+        ''', (user_id, week_start))
+        previous_week = cursor.fetchone()[0]
+
+        cursor.execute('''
+            SELECT MIN(week_start) FROM schedule
+            WHERE user_id = ? AND week_start > ?
+        ''', (user_id, week_start))
+        next_week = cursor.fetchone()[0]
+
+        conn.close()
+        return schedule, previous_week, next_week
+
     def get_pvz_schedule_report(self, pvz_id, week_dates):
         """Получить отчет по расписанию для ПВЗ"""
-        conn = self.get_connection()
+        conn = self.get_read_connection()
         cursor = conn.cursor()
 
-        placeholders = ','.join('?' for _ in week_dates)
+        week_starts = get_week_starts(week_dates)
         cursor.execute(f'''
-            SELECT u.first_name, u.username, u.user_id, s.date, s.time_slot, u.full_name
+            SELECT u.first_name, u.username, u.user_id, s.date, s.time_slot, u.full_name,
+                   s.slot_kind, s.start_minute, s.end_minute
             FROM schedule s
             JOIN users u ON s.user_id = u.user_id
-            WHERE u.pvz_id = ? AND s.date IN ({placeholders})
-            ORDER BY s.date, u.full_name
-        ''', (pvz_id, *week_dates))
+            WHERE u.pvz_id = ? AND s.week_start IN ({','.join('?' for _ in week_starts)})
+            AND s.date IN ({','.join('?' for _ in week_dates)})
+            ORDER BY s.date, s.start_minute IS NULL, s.start_minute, u.full_name
+        ''', (pvz_id, *week_starts, *week_dates))
 
         schedule_data = cursor.fetchall()
         conn.close()
         return schedule_data
 
+    def get_pvz_schedule_version(self, pvz_id, week_dates):
+        """Версия отчета ПВЗ на неделю: "число записей:максимальный id:хэш имен".
+
+        Записи расписания только добавляются и удаляются (не изменяются),
+        поэтому любое их изменение меняет первые две части. Хэш имен
+        (get_report_names_digest) меняется при переименовании ПВЗ или
+        сотрудника, у которого есть записи на эту неделю.
+        """
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+
+        week_starts = get_week_starts(week_dates)
+        filters = f'''
+            FROM schedule s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE u.pvz_id = ? AND s.week_start IN ({','.join('?' for _ in week_starts)})
+            AND s.date IN ({','.join('?' for _ in week_dates)})
+        '''
+        params = (pvz_id, *week_starts, *week_dates)
+        cursor.execute(f'SELECT COUNT(*), COALESCE(MAX(s.id), 0) {filters}', params)
+        count, max_id = cursor.fetchone()
+        cursor.execute(f'''
+            SELECT DISTINCT u.user_id, u.full_name, u.first_name, u.username {filters}
+            ORDER BY u.user_id
+        ''', params)
+        members = cursor.fetchall()
+        cursor.execute('SELECT name FROM pvz WHERE id = ?', (pvz_id,))
+        pvz = cursor.fetchone()
+
+        conn.close()
+        return f"{count}:{max_id}:{get_report_names_digest(pvz[0] if pvz else None, members)}"
+
+    def get_pvz_stats(self, pvz_id, week_dates):
+        """Статистика ПВЗ для /stats: (число сотрудников, сколько заполнили неделю)"""
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT COUNT(*) FROM users WHERE pvz_id = ?', (pvz_id,))
+        user_count = cursor.fetchone()[0]
+
+        week_starts = get_week_starts(week_dates)
+        cursor.execute(f'''
+            SELECT COUNT(DISTINCT user_id) FROM schedule
+            WHERE week_start IN ({','.join('?' for _ in week_starts)})
+            AND date IN ({','.join('?' for _ in week_dates)})
+            AND user_id IN (SELECT user_id FROM users WHERE pvz_id = ?)
+        ''', (*week_starts, *week_dates, pvz_id))
+        filled_count = cursor.fetchone()[0]
+
+        conn.close()
+        return user_count, filled_count
+
+    def refresh_fill_summary(self, pvz_id, since_week, before_week, utc_offset):
+        """Подсчитать итоги заполнения завершенных недель ПВЗ с since_week до before_week.
+
+        Недели берутся по календарю (все понедельники, в том числе недели, на
+        которые никто не заполнил анкету), но не раньше первой недели с
+        расписанием сотрудников ПВЗ. Уже подсчитанные недели пропускаются.
+        Возвращает число добавленных строк (сотрудник - неделя).
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            INSERT INTO week_fill (week_start, user_id, fill_minutes, pvz_id)
+            WITH RECURSIVE calendar (week_start) AS (
+                SELECT MAX(:since_week, MIN(s.week_start)) FROM schedule s
+                JOIN users u ON u.user_id = s.user_id
+                WHERE u.pvz_id = :pvz_id
+                UNION ALL
+                SELECT date(week_start, '+7 days') FROM calendar
+                WHERE date(week_start, '+7 days') < :before_week
+            ),
+            weeks (week_start) AS (
+                SELECT week_start FROM calendar
+                WHERE week_start < :before_week
+                AND week_start NOT IN (SELECT week_start FROM week_fill WHERE pvz_id = :pvz_id)
+            )
+            SELECT fill.*, :pvz_id FROM ({USER_WEEK_FILL_SQL}) fill
+        ''', {'pvz_id': pvz_id, 'since_week': since_week, 'before_week': before_week, 'utc_offset': utc_offset})
+        added = cursor.rowcount
+        conn.commit()
+        conn.close()
+
+        # Копия базы для отчетов должна сразу увидеть новые итоги
+        if added and self.snapshot_max_age > 0:
+            self.refresh_snapshot(force=True)
+        return added
+
+    def get_fill_analytics(self, pvz_id, since_week, live_weeks, utc_offset, min_missed):
+        """Аналитика заполнения анкет ПВЗ для /analytics.
+
+        Завершенные недели (с since_week) берутся из week_fill, недели
+        live_weeks считаются по расписанию. Возвращает:
+        - [(неделя, сотрудников, заполнили, медиана минут до заполнения), ...]
+          по неделям;
+        - [(user_id, full_name, first_name, username, пропущено недель,
+          недель всего, пропущено подряд до последней недели), ...] -
+          сотрудники, пропустившие не меньше min_missed завершенных недель.
+        """
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        params = {'pvz_id': pvz_id, 'since_week': since_week, 'utc_offset': utc_offset, 'min_missed': min_missed}
+        params.update({f'live{i}': week for i, week in enumerate(live_weeks)})
+        live_values = ', '.join(f'(:live{i})' for i in range(len(live_weeks)))
+
+        # Медиана - среднее одного или двух средних значений по номеру строки
+        # среди заполнивших (незаполнившие - в конце сортировки)
+        cursor.execute(f'''
+            WITH weeks (week_start) AS (VALUES {live_values}),
+            fills AS (
+                SELECT week_start, user_id, fill_minutes FROM week_fill
+                WHERE pvz_id = :pvz_id AND week_start >= :since_week
+                UNION ALL
+                {USER_WEEK_FILL_SQL}
+            ),
+            ranked AS (
+                SELECT week_start, fill_minutes,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY week_start ORDER BY fill_minutes IS NULL, fill_minutes
+                       ) AS position,
+                       COUNT(fill_minutes) OVER (PARTITION BY week_start) AS filled
+                FROM fills
+            )
+            SELECT week_start, COUNT(*), MAX(filled),
+                   AVG(CASE WHEN fill_minutes IS NOT NULL
+                            AND position IN ((filled + 1) / 2, (filled + 2) / 2)
+                       THEN fill_minutes END)
+            FROM ranked
+            GROUP BY week_start
+            ORDER BY week_start
+        ''', params)
+        weeks = cursor.fetchall()
+
+        # Пропуски подряд - недели после последнего заполнения (накопительная
+        # сумма заполнений от новых недель к старым равна нулю)
+        cursor.execute('''
+            WITH recent AS (
+                SELECT user_id, fill_minutes IS NULL AS missed,
+                       SUM(fill_minutes IS NOT NULL) OVER (
+                           PARTITION BY user_id ORDER BY week_start DESC ROWS UNBOUNDED PRECEDING
+                       ) AS fills_since
+                FROM week_fill
+                WHERE pvz_id = :pvz_id AND week_start >= :since_week
+            )
+            SELECT u.user_id, u.full_name, u.first_name, u.username,
+                   SUM(r.missed), COUNT(*), SUM(r.fills_since = 0)
+            FROM recent r
+            JOIN users u ON u.user_id = r.user_id AND u.pvz_id = :pvz_id
+            GROUP BY u.user_id
+            HAVING SUM(r.missed) >= :min_missed
+            ORDER BY SUM(r.fills_since = 0) DESC, SUM(r.missed) DESC, u.full_name
+        ''', params)
+        non_fillers = cursor.fetchall()
+
+        conn.close()
+        return weeks, non_fillers
+
+    def get_report_snapshot(self, pvz_id, week):
+        """Последний отправленный отчет ПВЗ за неделю: (version, snapshot, message_id) или None"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT version, snapshot, message_id FROM report_snapshots WHERE pvz_id = ? AND week = ?',
+            (pvz_id, week)
+        )
+        result = cursor.fetchone()
+        conn.close()
+        if not result:
+            return None
+        return result[0], json.loads(result[1]), result[2]
+
+    def save_report_snapshot(self, pvz_id, week, version, snapshot, message_id):
+        """Запомнить отправленный отчет ПВЗ за неделю"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO report_snapshots (pvz_id, week, version, snapshot, message_id, sent_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (pvz_id, week, version, json.dumps(snapshot, ensure_ascii=False), message_id))
+        conn.commit()
+        conn.close()
+
+    def get_pvz_shifts(self, pvz_id, dates, start_minute=0, end_minute=24 * 60, slot_kinds=(SLOT_SHIFT,)):
+        """Записи расписания ПВЗ на даты dates, пересекающие интервал [start_minute, end_minute).
+
+        Для SLOT_SHIFT учитывается время смены, записи других видов
+        (например, SLOT_AS_NEEDED) возвращаются без проверки времени.
+        Строки: (user_id, full_name, first_name, username, date, slot_kind, start_minute, end_minute),
+        отсортированы по дате и началу смены.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        week_starts = get_week_starts(dates)
+        week_placeholders = ','.join('?' for _ in week_starts)
+        date_placeholders = ','.join('?' for _ in dates)
+        kind_placeholders = ','.join('?' for _ in slot_kinds)
+        cursor.execute(f'''
+            SELECT u.user_id, u.full_name, u.first_name, u.username,
+                   s.date, s.slot_kind, s.start_minute, s.end_minute
+            FROM schedule s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE s.week_start IN ({week_placeholders})
+            AND s.date IN ({date_placeholders})
+            AND s.slot_kind IN ({kind_placeholders})
+            AND (s.slot_kind != ? OR (s.start_minute < ? AND s.end_minute > ?))
+            AND u.pvz_id = ?
+            ORDER BY s.date, s.start_minute, u.full_name
+        ''', (*week_starts, *dates, *slot_kinds, SLOT_SHIFT, end_minute, start_minute, pvz_id))
+
+        shifts = cursor.fetchall()
+        conn.close()
+        return shifts
+
+    def get_pvz_coverage_at(self, pvz_id, date, minute):
+        """Кто из сотрудников ПВЗ на смене в момент minute (минуты от полуночи) даты date"""
+        return self.get_pvz_shifts(pvz_id, [date], minute, minute + 1)
+
     def get_all_pvz(self):
         """Получить все ПВЗ"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM pvz')
+        cursor.execute('SELECT id, name, password, chat_id, timezone FROM pvz')
         pvz_list = cursor.fetchall()
         conn.close()
         return pvz_list
@@ -183,6 +1030,14 @@ class Database:
         conn.commit()
         conn.close()
 
+    def set_pvz_timezone(self, pvz_id, timezone_name):
+        """Установить часовой пояс ПВЗ"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE pvz SET timezone = ? WHERE id = ?', (timezone_name, pvz_id))
+        conn.commit()
+        conn.close()
+
     def get_pvz_chat_id(self, pvz_id):
         """Получить chat_id ПВЗ"""
         conn = self.get_connection()
@@ -190,4 +1045,336 @@ class Database:
         cursor.execute('SELECT chat_id FROM pvz WHERE id = ?', (pvz_id,))
         result = cursor.fetchone()
         conn.close()
-        return result[0] if result else None
\ No newline at end of file
+        return result[0] if result else None
+
+    def add_admin_notification(self, kind, text):
+        """Поставить уведомление администратору в очередь"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO admin_notifications (kind, text)
+            VALUES (?, ?)
+        ''', (kind, text))
+        conn.commit()
+        conn.close()
+
+    def get_pending_admin_notifications(self):
+        """Получить неотправленные уведомления администратору (по порядку)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, kind, text, created_at FROM admin_notifications
+            WHERE sent_at IS NULL
+            ORDER BY id
+        ''')
+        notifications = cursor.fetchall()
+        conn.close()
+        return notifications
+
+    def mark_admin_notifications_sent(self, notification_ids):
+        """Отметить уведомления как отправленные"""
+        if not notification_ids:
+            return
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany(
+            'UPDATE admin_notifications SET sent_at = CURRENT_TIMESTAMP WHERE id = ?',
+            [(notification_id,) for notification_id in notification_ids]
+        )
+        # Отправленные уведомления храним неделю, чтобы таблица не разрасталась
+        cursor.execute('''
+            DELETE FROM admin_notifications
+            WHERE sent_at IS NOT NULL AND sent_at < datetime('now', '-7 days')
+        ''')
+        conn.commit()
+        conn.close()
+
+    def get_reminder_schedule(self):
+        """Получить расписание напоминаний всех ПВЗ"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT r.id, r.pvz_id, r.kind, r.weekday, r.remind_time, r.last_run_at,
+                   p.name, p.chat_id, p.timezone
+            FROM reminder_schedule r
+            JOIN pvz p ON r.pvz_id = p.id
+            ORDER BY r.id
+        ''')
+        reminders = cursor.fetchall()
+        conn.close()
+        return reminders
+
+    def get_pvz_reminders(self, pvz_id):
+        """Получить напоминания ПВЗ: {тип: (день недели, время)}"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT kind, weekday, remind_time FROM reminder_schedule WHERE pvz_id = ?',
+            (pvz_id,)
+        )
+        reminders = cursor.fetchall()
+        conn.close()
+        return {row[0]: (row[1], row[2]) for row in reminders}
+
+    def set_reminder_time(self, pvz_id, kind, weekday, remind_time):
+        """Установить день недели и время напоминания ПВЗ"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO reminder_schedule (pvz_id, kind, weekday, remind_time, last_run_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (pvz_id, kind) DO UPDATE SET
+                weekday = excluded.weekday,
+                remind_time = excluded.remind_time,
+                last_run_at = excluded.last_run_at
+        ''', (pvz_id, kind, weekday, remind_time, datetime.utcnow().isoformat()))
+        conn.commit()
+        conn.close()
+
+    def mark_reminder_run(self, reminder_id, run_at):
+        """Запомнить время запуска напоминания (UTC)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE reminder_schedule SET last_run_at = ? WHERE id = ?',
+            (run_at.isoformat(), reminder_id)
+        )
+        conn.commit()
+        conn.close()
+
+    def get_user_state(self, user_id):
+        """Получить состояние диалога пользователя (словарь) или None"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT data FROM user_states WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+        conn.close()
+        return json.loads(result[0]) if result else None
+
+    def set_user_state(self, user_id, state):
+        """Сохранить состояние диалога пользователя"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO user_states (user_id, data, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', (user_id, json.dumps(state, ensure_ascii=False)))
+        conn.commit()
+        conn.close()
+
+    def clear_user_state(self, user_id):
+        """Удалить состояние диалога пользователя"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
+        conn.commit()
+        conn.close()
+
+    def acquire_lease(self, name, holder, ttl):
+        """Взять или продлить аренду name на ttl секунд.
+
+        Возвращает True, если аренда принадлежит holder: была свободна,
+        истекла или уже принадлежала ему.
+        """
+        now = time.time()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                holder = excluded.holder,
+                expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+        ''', (name, holder, now + ttl, now))
+        acquired = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        return acquired
+
+    def release_lease(self, name, holder):
+        """Освободить аренду, если она принадлежит holder"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, holder))
+        conn.commit()
+        conn.close()
+
+    def get_schedule_changes(self, after_id=0, limit=500):
+        """Изменения расписания с id > after_id по порядку.
+
+        Строки: (id, operation, schedule_id, user_id, date, time_slot, changed_at),
+        operation - 'insert' или 'delete' (замена записи - это delete + insert).
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, operation, schedule_id, user_id, date, time_slot, changed_at
+            FROM schedule_changes
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, limit))
+        changes = cursor.fetchall()
+        conn.close()
+        return changes
+
+    def get_change_cursor(self, consumer):
+        """Последний обработанный читателем consumer id изменения (0 - ничего не обработано)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT last_change_id FROM change_cursors WHERE consumer = ?', (consumer,))
+        result = cursor.fetchone()
+        conn.close()
+        return result[0] if result else 0
+
+    def set_change_cursor(self, consumer, change_id):
+        """Сохранить позицию читателя журнала изменений"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO change_cursors (consumer, last_change_id, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', (consumer, change_id))
+        conn.commit()
+        conn.close()
+
+    def read_new_schedule_changes(self, consumer, limit=500):
+        """Изменения, которые читатель consumer еще не обработал.
+
+        Позиция не сдвигается: после обработки вызовите
+        set_change_cursor(consumer, id последнего изменения).
+        """
+        return self.get_schedule_changes(self.get_change_cursor(consumer), limit)
+
+    def delete_old_schedule_changes(self, max_age_days):
+        """Удалить записи журнала изменений старше max_age_days, вернуть их количество"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM schedule_changes WHERE changed_at <= datetime('now', ?)",
+            (f'-{max_age_days} days',)
+        )
+        deleted = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return deleted
+
+
+def get_deep_size(rows, seen=None):
+    """Примерный объем памяти строк-кортежей вместе с их значениями (байт).
+
+    Общие для нескольких строк объекты учитываются один раз; seen - множество
+    id уже учтенных объектов, общее для нескольких вызовов.
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    for row in rows:
+        for obj in (row, *row):
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                size += sys.getsizeof(obj)
+    return size
+
+
+class UserCache:
+    """Пользователи и ПВЗ в памяти процесса.
+
+    Хранит те же строки-кортежи, что возвращают Database.get_user и
+    Database.get_all_pvz, с индексами по user_id и по ПВЗ. Загружается
+    целиком одним запросом (preload) и перезагружается через ttl секунд,
+    чтобы подхватить изменения из других процессов. Пользователей, которых
+    нет в кэше, ищет в базе.
+
+    Кортеж - самое компактное представление строки в Python (объект с
+    __slots__ того же размера не меньше), поэтому отдельных классов записей
+    нет. Название и часовой пояс ПВЗ в строках пользователей - те же объекты,
+    что в строке ПВЗ, а не копии на каждого сотрудника.
+    """
+
+    def __init__(self, db, ttl):
+        self.db = db
+        self.ttl = ttl
+        self.users = {}
+        self.users_by_pvz = {}
+        self.pvz = {}
+        self.loaded_at = None
+        # Данные изменились (invalidate) - перезагрузить при следующем обращении
+        self.stale = False
+
+    def preload(self, max_age=0):
+        """Загрузить всех пользователей и ПВЗ, если кэш старше max_age секунд"""
+        if not self.stale and self.loaded_at is not None and time.monotonic() - self.loaded_at <= max_age:
+            return
+
+        started_at = time.monotonic()
+        pvz = {row[0]: row for row in self.db.get_all_pvz()}
+        users = {}
+        users_by_pvz = {}
+        for row in self.db.get_all_users():
+            # row структура: [1]user_id, [4]pvz_id, [6]pvz_name, [7]pvz_timezone (как в get_user)
+            pvz_row = pvz.get(row[4])
+            if pvz_row is not None:
+                row = row[:6] + (pvz_row[1], pvz_row[4])
+            users[row[1]] = row
+            users_by_pvz.setdefault(row[4], []).append(row)
+
+        self.users, self.users_by_pvz, self.pvz = users, users_by_pvz, pvz
+        self.loaded_at = time.monotonic()
+        self.stale = False
+
+        logging.info(
+            "Кэш загружен: %s пользователей, %s ПВЗ, ~%.0f КБ за %.3f с",
+            len(users), len(pvz), self.get_memory_size() / 1024, self.loaded_at - started_at
+        )
+
+    def get_memory_size(self):
+        """Примерный объем памяти кэша (байт)"""
+        seen = set()
+        return (
+            sys.getsizeof(self.users) + sys.getsizeof(self.users_by_pvz) + sys.getsizeof(self.pvz)
+            + sum(sys.getsizeof(rows) for rows in self.users_by_pvz.values())
+            + get_deep_size(self.pvz.values(), seen) + get_deep_size(self.users.values(), seen)
+        )
+
+    def refresh_if_stale(self):
+        """Перезагрузить кэш, если истек ttl или он помечен устаревшим"""
+        if self.stale or (self.loaded_at is not None and time.monotonic() - self.loaded_at > self.ttl):
+            self.preload()
+
+    def get_user(self, user_id):
+        """Пользователь из кэша (или из базы, если его там нет)"""
+        self.refresh_if_stale()
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.db.get_user(user_id)
+            if user is not None and self.loaded_at is not None:
+                self.users[user_id] = user
+                self.users_by_pvz.setdefault(user[4], []).append(user)
+        return user
+
+    def get_all_pvz(self):
+        """Все ПВЗ (строки в формате Database.get_all_pvz)"""
+        if self.loaded_at is None:
+            self.preload()
+        self.refresh_if_stale()
+        return list(self.pvz.values())
+
+    def get_pvz_users(self, pvz_id):
+        """Все пользователи ПВЗ"""
+        if self.loaded_at is None:
+            self.preload()
+        self.refresh_if_stale()
+        return self.users_by_pvz.get(pvz_id, [])
+
+    def invalidate_user(self, user_id):
+        """Забыть пользователя (после регистрации или изменения)"""
+        user = self.users.pop(user_id, None)
+        if user is not None:
+            pvz_users = self.users_by_pvz.get(user[4], [])
+            if user in pvz_users:
+                pvz_users.remove(user)
+
+    def invalidate(self):
+        """Пометить кэш устаревшим: следующее обращение загрузит его заново"""
+        self.stale = True
@@ -0,0 +1,87 @@
+import csv
+import io
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Колонки CSV для /import (заголовок обязателен, порядок любой)
+IMPORT_COLUMNS = ('pvz', 'password', 'timezone', 'user_id', 'full_name', 'username')
+REQUIRED_COLUMNS = ('pvz',)
+
+
+def decode_import_file(data):
+    """Текст CSV из байтов файла: UTF-8 (в том числе с BOM) или Windows-1251 из Excel"""
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp1251')
+
+
+def parse_import_csv(text):
+    """Разобрать CSV с ПВЗ и сотрудниками.
+
+    Строка с паролем описывает ПВЗ (создает его или обновляет пароль и
+    часовой пояс), строка с user_id - сотрудника этого ПВЗ. В одной строке
+    может быть и то и другое. Разделитель - запятая или точка с запятой.
+
+    Возвращает (pvz_rows, user_rows, errors):
+    pvz_rows - {имя: (пароль, часовой пояс или None)},
+    user_rows - [(user_id, username, full_name, имя ПВЗ), ...],
+    errors - ["строка N: ...", ...].
+    """
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+
+    header = [name.strip().lower() for name in reader.fieldnames or []]
+    missing = [name for name in REQUIRED_COLUMNS if name not in header]
+    if missing:
+        return {}, [], [f"нет колонок: {', '.join(missing)} (ожидаются {', '.join(IMPORT_COLUMNS)})"]
+    reader.fieldnames = header
+
+    pvz_rows = {}
+    user_rows = []
+    seen_user_ids = {}
+    errors = []
+
+    for row in reader:
+        line = reader.line_num
+        values = {name: (row.get(name) or '').strip() for name in IMPORT_COLUMNS}
+        pvz_name = values['pvz']
+        if not pvz_name:
+            if any(values.values()):
+                errors.append(f"строка {line}: не указан ПВЗ")
+            continue
+
+        if values['password']:
+            timezone_name = values['timezone'] or None
+            if timezone_name:
+                try:
+                    ZoneInfo(timezone_name)
+                except (ZoneInfoNotFoundError, ValueError):
+                    errors.append(f"строка {line}: неизвестный часовой пояс {timezone_name}")
+                    continue
+            pvz = (values['password'], timezone_name)
+            if pvz_rows.get(pvz_name, pvz) != pvz:
+                errors.append(f"строка {line}: ПВЗ {pvz_name} уже описан с другими паролем или часовым поясом")
+                continue
+            pvz_rows[pvz_name] = pvz
+        elif values['timezone']:
+            errors.append(f"строка {line}: часовой пояс указан без пароля ПВЗ")
+            continue
+
+        if values['user_id']:
+            try:
+                user_id = int(values['user_id'])
+            except ValueError:
+                errors.append(f"строка {line}: user_id должен быть числом, а не {values['user_id']}")
+                continue
+            if user_id in seen_user_ids:
+                errors.append(f"строка {line}: user_id {user_id} уже встречался в строке {seen_user_ids[user_id]}")
+                continue
+            seen_user_ids[user_id] = line
+            user_rows.append((user_id, values['username'].lstrip('@') or None, values['full_name'] or None, pvz_name))
+        elif values['full_name'] or values['username']:
+            errors.append(f"строка {line}: у сотрудника не указан user_id")
+
+    return pvz_rows, user_rows, errors
@@ -0,0 +1,117 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from contextvars import ContextVar
+
+# Поля обрабатываемого обновления (update_id, user_id, pvz) - добавляются ко
+# всем записям журнала, сделанным во время его обработки
+log_context = ContextVar('log_context', default=None)
+
+# Поля записи, которые попадают в JSON (кроме времени, уровня и текста)
+CONTEXT_FIELDS = ('update_id', 'user_id', 'pvz', 'duration_ms', 'metrics')
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи поля текущего обновления из log_context"""
+
+    def filter(self, record):
+        context = log_context.get()
+        if context:
+            for key, value in context.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю rate записей уровня DEBUG (остальные уровни - все)"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись журнала одной строкой JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который передает в очередь запись без форматирования.
+
+    В потоке цикла событий только подставляются аргументы сообщения и
+    сохраняется текст исключения; форматирование и вывод выполняет поток
+    QueueListener.
+    """
+
+    def prepare(self, record):
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+
+def setup_logging(level=logging.INFO, log_format='json', debug_sample_rate=1.0, log_file=None):
+    """Журнал через очередь: обработчики пишут в очередь, вывод - в отдельном потоке.
+
+    Вызывается в каждом процессе бота: обработчики, унаследованные от
+    родительского процесса, заменяются (их поток вывода остался в родителе).
+    Возвращает запущенный QueueListener.
+    """
+    if log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,525 @@
+import bisect
+import copy
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from database import (
+    DEFAULT_REMINDERS, DEFAULT_TIMEZONE, SLOT_SHIFT,
+    get_report_names_digest, get_week_start, parse_time_slot,
+)
+from storage import Storage
+
+
+def sqlite_timestamp():
+    """Текущее время UTC в формате CURRENT_TIMESTAMP SQLite"""
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class MemoryStorage(Storage):
+    """Хранилище в словарях памяти процесса (для тестов и замеров).
+
+    Повторяет поведение Database, включая формат строк и начальный ПВЗ.
+    Данные не переживают перезапуск и не видны другим процессам, поэтому
+    для работы бота с несколькими процессами не подходит.
+    """
+
+    def __init__(self):
+        self.pvz = {}                   # id -> [id, name, password, chat_id, timezone]
+        self.pvz_by_name = {}           # name -> id
+        self.users = {}                 # user_id -> [id, user_id, username, first_name, pvz_id, full_name]
+        self.users_by_pvz = {}          # pvz_id -> {user_id}
+        self.registered_at = {}         # user_id -> время регистрации в текущем ПВЗ (UTC)
+        self.schedule_by_week = {}      # (user_id, week_start) -> {date: запись}
+        self.schedule_by_date = {}      # (week_start, date) -> {schedule_id: запись}
+        self.user_weeks = {}            # user_id -> отсортированный список week_start
+        self.form_drafts = {}           # user_id -> (week, answers, updated_at, single_day)
+        self.report_snapshots = {}      # (pvz_id, week) -> (version, snapshot, message_id)
+        self.admin_notifications = {}   # id -> [id, kind, text, created_at, sent_at]
+        self.reminders = {}             # id -> [id, pvz_id, kind, weekday, remind_time, last_run_at]
+        self.reminder_ids = {}          # (pvz_id, kind) -> id
+        self.user_states = {}           # user_id -> словарь
+        self.leases = {}                # name -> (holder, expires_at)
+        self.week_fill = {}             # (pvz_id, week_start) -> {user_id: fill_minutes}
+        self.schedule_changes = []      # [(id, operation, schedule_id, user_id, date, time_slot, changed_at)]
+        self.change_cursors = {}        # consumer -> last_change_id
+        self.next_ids = {}
+
+        # Начальный ПВЗ, как в Database.init_database
+        self.create_pvz('Промышленная_6', '1525', DEFAULT_TIMEZONE)
+
+    def next_id(self, table):
+        """Следующий id (аналог AUTOINCREMENT)"""
+        self.next_ids[table] = self.next_ids.get(table, 0) + 1
+        return self.next_ids[table]
+
+    def create_pvz(self, name, password, timezone_name):
+        """Новый ПВЗ с напоминаниями по умолчанию"""
+        pvz_id = self.next_id('pvz')
+        self.pvz[pvz_id] = [pvz_id, name, password, None, timezone_name]
+        self.pvz_by_name[name] = pvz_id
+        now = datetime.utcnow().isoformat()
+        for kind, weekday, remind_time in DEFAULT_REMINDERS:
+            reminder_id = self.next_id('reminder_schedule')
+            self.reminders[reminder_id] = [reminder_id, pvz_id, kind, weekday, remind_time, now]
+            self.reminder_ids[(pvz_id, kind)] = reminder_id
+        return pvz_id
+
+    def user_row(self, user):
+        """Строка пользователя в формате Database.get_user"""
+        pvz = self.pvz.get(user[4])
+        return (*user, pvz[1] if pvz else None, pvz[4] if pvz else None)
+
+    def insert_schedule(self, user_id, date, time_slot, week_start, parsed=None):
+        """Добавить запись расписания (замена записи - удаление + добавление)"""
+        slot_kind, start_minute, end_minute = parsed or parse_time_slot(time_slot)
+        entry = {
+            'id': self.next_id('schedule'), 'user_id': user_id, 'date': date, 'time_slot': time_slot,
+            'slot_kind': slot_kind, 'start_minute': start_minute, 'end_minute': end_minute,
+            'week_start': week_start, 'created_at': sqlite_timestamp(),
+        }
+        self.delete_schedule(user_id, date, week_start)
+        self.log_schedule_change('insert', entry)
+        week = self.schedule_by_week.setdefault((user_id, week_start), {})
+        if not week:
+            bisect.insort(self.user_weeks.setdefault(user_id, []), week_start)
+        week[date] = entry
+        self.schedule_by_date.setdefault((week_start, date), {})[entry['id']] = entry
+
+    def delete_schedule(self, user_id, date, week_start):
+        """Удалить запись расписания пользователя на дату недели week_start"""
+        week = self.schedule_by_week.get((user_id, week_start))
+        if not week or date not in week:
+            return
+        entry = week.pop(date)
+        del self.schedule_by_date[(week_start, date)][entry['id']]
+        self.log_schedule_change('delete', entry)
+        if not week:
+            del self.schedule_by_week[(user_id, week_start)]
+            self.user_weeks[user_id].remove(week_start)
+
+    def user_week_fill(self, pvz_id, week_start, utc_offset):
+        """Заполнение недели сотрудниками ПВЗ, как USER_WEEK_FILL_SQL: {user_id: минуты или None}"""
+        reminder = self.reminders.get(self.reminder_ids.get((pvz_id, 'saturday')))
+        weekday, remind_time = (reminder[3], reminder[4]) if reminder else (5, '09:00')
+        reminder_at = (datetime.strptime(f'{week_start} {remind_time}', '%Y-%m-%d %H:%M')
+                       + timedelta(days=weekday - 14, minutes=-utc_offset))
+        fills = {}
+        for user_id in self.users_by_pvz.get(pvz_id, ()):
+            week = self.schedule_by_week.get((user_id, week_start))
+            if not week:
+                # Неделя до регистрации в ПВЗ не считается пропущенной
+                if self.registered_at[user_id] < week_start:
+                    fills[user_id] = None
+                continue
+            filled_at = datetime.strptime(min(entry['created_at'] for entry in week.values()), '%Y-%m-%d %H:%M:%S')
+            fills[user_id] = max(0, round((filled_at - reminder_at).total_seconds() / 60))
+        return fills
+
+    def log_schedule_change(self, operation, entry):
+        """Запись журнала изменений (как триггеры schedule_changes в Database)"""
+        self.schedule_changes.append((
+            self.next_id('schedule_changes'), operation, entry['id'], entry['user_id'],
+            entry['date'], entry['time_slot'], sqlite_timestamp(),
+        ))
+
+    def pvz_entries(self, pvz_id, dates):
+        """Записи расписания сотрудников ПВЗ на даты dates"""
+        user_ids = self.users_by_pvz.get(pvz_id, ())
+        for date in dates:
+            for entry in self.schedule_by_date.get((get_week_start(date), date), {}).values():
+                if entry['user_id'] in user_ids:
+                    yield entry
+
+    # ПВЗ
+
+    def get_pvz_by_password(self, password):
+        for pvz in self.pvz.values():
+            if pvz[2] == password:
+                return tuple(pvz)
+        return None
+
+    def get_pvz_by_id(self, pvz_id):
+        pvz = self.pvz.get(pvz_id)
+        return tuple(pvz) if pvz else None
+
+    def get_all_pvz(self):
+        return [tuple(pvz) for pvz in self.pvz.values()]
+
+    def set_pvz_chat_id(self, pvz_id, chat_id):
+        if pvz_id in self.pvz:
+            self.pvz[pvz_id][3] = str(chat_id)
+
+    def set_pvz_timezone(self, pvz_id, timezone_name):
+        if pvz_id in self.pvz:
+            self.pvz[pvz_id][4] = timezone_name
+
+    def get_pvz_chat_id(self, pvz_id):
+        pvz = self.pvz.get(pvz_id)
+        return pvz[3] if pvz else None
+
+    # Пользователи
+
+    def add_user(self, user_id, username, first_name, pvz_id, full_name=None):
+        old = self.users.get(user_id)
+        if old:
+            self.users_by_pvz[old[4]].discard(user_id)
+        if not old or old[4] != pvz_id:
+            self.registered_at[user_id] = sqlite_timestamp()
+        self.users[user_id] = [self.next_id('users'), user_id, username, first_name, pvz_id, full_name]
+        self.users_by_pvz.setdefault(pvz_id, set()).add(user_id)
+
+    def get_user(self, user_id):
+        user = self.users.get(user_id)
+        return self.user_row(user) if user else None
+
+    def get_all_users(self):
+        return [self.user_row(user) for user in self.users.values()]
+
+    def get_filled_user_ids(self, pvz_id, week_dates):
+        return {entry['user_id'] for entry in self.pvz_entries(pvz_id, week_dates)}
+
+    def import_pvz_and_users(self, pvz_rows, user_rows):
+        errors = []
+        passwords = {pvz[1]: pvz[2] for pvz in self.pvz.values()}
+        passwords.update({name: password for name, (password, timezone_name) in pvz_rows.items()})
+        names_by_password = {}
+        for name, password in passwords.items():
+            names_by_password.setdefault(password, []).append(name)
+        for password, names in names_by_password.items():
+            if len(names) > 1:
+                errors.append(f"пароль {password} у нескольких ПВЗ: {', '.join(names)}")
+        for name in sorted({row[3] for row in user_rows} - passwords.keys()):
+            errors.append(f"ПВЗ {name} не найден (для нового ПВЗ укажите пароль)")
+        if errors:
+            return None, errors
+
+        existing_pvz = set(self.pvz_by_name)
+        existing_users = {row[0] for row in user_rows if row[0] in self.users}
+        for name, (password, timezone_name) in pvz_rows.items():
+            if name in self.pvz_by_name:
+                pvz = self.pvz[self.pvz_by_name[name]]
+                pvz[2] = password
+                pvz[4] = timezone_name or pvz[4]
+            else:
+                self.create_pvz(name, password, timezone_name or DEFAULT_TIMEZONE)
+
+        for user_id, username, full_name, pvz_name in user_rows:
+            old = self.users.get(user_id)
+            if old:
+                self.add_user(user_id, username or old[2], old[3], self.pvz_by_name[pvz_name], full_name or old[5])
+            else:
+                self.add_user(user_id, username, None, self.pvz_by_name[pvz_name], full_name)
+
+        stats = {
+            'pvz_created': len(pvz_rows.keys() - existing_pvz),
+            'pvz_updated': len(pvz_rows.keys() & existing_pvz),
+            'users_created': len(user_rows) - len(existing_users),
+            'users_updated': len(existing_users),
+        }
+        return stats, errors
+
+    # Расписание
+
+    def save_week_schedule(self, user_id, answers):
+        for date, time_slot in answers.items():
+            self.insert_schedule(user_id, date, time_slot, get_week_start(date))
+        self.form_drafts.pop(user_id, None)
+
+    def get_user_schedule(self, user_id, week_dates):
+        schedule = {}
+        for week_start in {get_week_start(date) for date in week_dates}:
+            week = self.schedule_by_week.get((user_id, week_start), {})
+            schedule.update({date: week[date]['time_slot'] for date in week_dates if date in week})
+        return schedule
+
+    def get_user_week_schedule(self, user_id, week_start):
+        week = self.schedule_by_week.get((user_id, week_start), {})
+        weeks = self.user_weeks.get(user_id, [])
+        i = bisect.bisect_left(weeks, week_start)
+        j = bisect.bisect_right(weeks, week_start)
+        previous_week = weeks[i - 1] if i > 0 else None
+        next_week = weeks[j] if j < len(weeks) else None
+        return {date: entry['time_slot'] for date, entry in week.items()}, previous_week, next_week
+
+    def get_user_previous_week(self, user_id, week_start):
+        weeks = self.user_weeks.get(user_id, [])
+        i = bisect.bisect_left(weeks, week_start)
+        return weeks[i - 1] if i > 0 else None
+
+    def copy_previous_week(self, user_id, week_start):
+        source_week = self.get_user_previous_week(user_id, week_start)
+        if source_week is None:
+            return None, 0
+
+        for date in list(self.schedule_by_week.get((user_id, week_start), {})):
+            self.delete_schedule(user_id, date, week_start)
+        source_monday = datetime.strptime(source_week, '%Y-%m-%d')
+        target_monday = datetime.strptime(week_start, '%Y-%m-%d')
+        source_dates = {(source_monday + timedelta(days=i)).strftime('%d.%m'): i for i in range(7)}
+        copied = 0
+        for date, entry in list(self.schedule_by_week[(user_id, source_week)].items()):
+            offset = source_dates.get(date)
+            if offset is None:
+                continue
+            target_date = (target_monday + timedelta(days=offset)).strftime('%d.%m')
+            self.insert_schedule(
+                user_id, target_date, entry['time_slot'], week_start,
+                (entry['slot_kind'], entry['start_minute'], entry['end_minute'])
+            )
+            copied += 1
+        self.form_drafts.pop(user_id, None)
+        return source_week, copied
+
+    def get_pvz_schedule_report(self, pvz_id, week_dates):
+        rows = []
+        for entry in self.pvz_entries(pvz_id, week_dates):
+            user = self.users[entry['user_id']]
+            rows.append((
+                user[3], user[2], user[1], entry['date'], entry['time_slot'], user[5],
+                entry['slot_kind'], entry['start_minute'], entry['end_minute'],
+            ))
+        # Как ORDER BY date, start_minute IS NULL, start_minute, full_name
+        rows.sort(key=lambda row: (row[3], row[7] is None, row[7] or 0, row[5] or ''))
+        return rows
+
+    def get_pvz_schedule_version(self, pvz_id, week_dates):
+        entries = list(self.pvz_entries(pvz_id, week_dates))
+        max_id = max((entry['id'] for entry in entries), default=0)
+        members = sorted({
+            (user[1], user[5], user[3], user[2])
+            for user in (self.users[entry['user_id']] for entry in entries)
+        })
+        pvz = self.pvz.get(pvz_id)
+        return f"{len(entries)}:{max_id}:{get_report_names_digest(pvz[1] if pvz else None, members)}"
+
+    def get_pvz_stats(self, pvz_id, week_dates):
+        return len(self.users_by_pvz.get(pvz_id, ())), len(self.get_filled_user_ids(pvz_id, week_dates))
+
+    def get_pvz_shifts(self, pvz_id, dates, start_minute=0, end_minute=24 * 60, slot_kinds=(SLOT_SHIFT,)):
+        rows = []
+        for entry in self.pvz_entries(pvz_id, dates):
+            if entry['slot_kind'] not in slot_kinds:
+                continue
+            if entry['slot_kind'] == SLOT_SHIFT and not (
+                    entry['start_minute'] < end_minute and entry['end_minute'] > start_minute):
+                continue
+            user = self.users[entry['user_id']]
+            rows.append((
+                user[1], user[5], user[3], user[2],
+                entry['date'], entry['slot_kind'], entry['start_minute'], entry['end_minute'],
+            ))
+        rows.sort(key=lambda row: (row[4], row[6] is not None, row[6] or 0, row[1] or ''))
+        return rows
+
+    def get_pvz_coverage_at(self, pvz_id, date, minute):
+        return self.get_pvz_shifts(pvz_id, [date], minute, minute + 1)
+
+    # Журнал изменений расписания
+
+    def get_schedule_changes(self, after_id=0, limit=500):
+        start = bisect.bisect_right(self.schedule_changes, after_id, key=lambda change: change[0])
+        return self.schedule_changes[start:start + limit]
+
+    def get_change_cursor(self, consumer):
+        return self.change_cursors.get(consumer, 0)
+
+    def set_change_cursor(self, consumer, change_id):
+        self.change_cursors[consumer] = change_id
+
+    def read_new_schedule_changes(self, consumer, limit=500):
+        return self.get_schedule_changes(self.get_change_cursor(consumer), limit)
+
+    def delete_old_schedule_changes(self, max_age_days):
+        # Журнал упорядочен по времени: старые записи - в начале
+        expired_before = (datetime.utcnow() - timedelta(days=max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+        count = bisect.bisect_right(self.schedule_changes, expired_before, key=lambda change: change[6])
+        del self.schedule_changes[:count]
+        return count
+
+    # Черновики анкет
+
+    def get_form_draft(self, user_id, max_age_hours):
+        draft = self.form_drafts.get(user_id)
+        if not draft or time.time() - draft[2] >= max_age_hours * 3600:
+            return None
+        return draft[0], copy.deepcopy(draft[1]), draft[3]
+
+    def save_form_drafts(self, drafts):
+        for user_id, week, answers, single_day in drafts:
+            self.form_drafts[user_id] = (week, copy.deepcopy(answers), time.time(), single_day)
+
+    def delete_expired_form_drafts(self, max_age_hours):
+        expired_before = time.time() - max_age_hours * 3600
+        expired = [user_id for user_id, draft in self.form_drafts.items() if draft[2] <= expired_before]
+        for user_id in expired:
+            del self.form_drafts[user_id]
+        return len(expired)
+
+    # Отчеты администратору
+
+    def refresh_fill_summary(self, pvz_id, since_week, before_week, utc_offset):
+        first_weeks = [
+            self.user_weeks[user_id][0]
+            for user_id in self.users_by_pvz.get(pvz_id, ())
+            if self.user_weeks.get(user_id)
+        ]
+        if not first_weeks:
+            return 0
+
+        added = 0
+        monday = datetime.strptime(max(since_week, min(first_weeks)), '%Y-%m-%d')
+        while monday.strftime('%Y-%m-%d') < before_week:
+            week_start = monday.strftime('%Y-%m-%d')
+            if (pvz_id, week_start) not in self.week_fill:
+                self.week_fill[(pvz_id, week_start)] = self.user_week_fill(pvz_id, week_start, utc_offset)
+                added += len(self.week_fill[(pvz_id, week_start)])
+            monday += timedelta(days=7)
+        return added
+
+    def get_fill_analytics(self, pvz_id, since_week, live_weeks, utc_offset, min_missed):
+        fills = {
+            week_start: week_fills for (fill_pvz_id, week_start), week_fills in self.week_fill.items()
+            if fill_pvz_id == pvz_id and week_start >= since_week
+        }
+        completed = sorted(fills, reverse=True)
+        for week_start in live_weeks:
+            fills[week_start] = self.user_week_fill(pvz_id, week_start, utc_offset)
+
+        weeks = []
+        for week_start in sorted(fills):
+            if not fills[week_start]:
+                continue
+            minutes = sorted(value for value in fills[week_start].values() if value is not None)
+            median = (minutes[(len(minutes) - 1) // 2] + minutes[len(minutes) // 2]) / 2 if minutes else None
+            weeks.append((week_start, len(fills[week_start]), len(minutes), median))
+
+        # user_id -> [пропущено, недель, пропущено подряд, серия не прервана] (от новых недель к старым)
+        counters = {}
+        for week_start in completed:
+            for user_id, value in fills[week_start].items():
+                counter = counters.setdefault(user_id, [0, 0, 0, True])
+                counter[1] += 1
+                if value is None:
+                    counter[0] += 1
+                    if counter[3]:
+                        counter[2] += 1
+                else:
+                    counter[3] = False
+        non_fillers = []
+        for user_id, (missed, total, streak, _) in counters.items():
+            user = self.users.get(user_id)
+            if user and user[4] == pvz_id and missed >= min_missed:
+                non_fillers.append((user_id, user[5], user[3], user[2], missed, total, streak))
+        non_fillers.sort(key=lambda row: (-row[6], -row[4], row[1] or ''))
+        return weeks, non_fillers
+
+    def get_report_snapshot(self, pvz_id, week):
+        snapshot = self.report_snapshots.get((pvz_id, week))
+        return copy.deepcopy(snapshot) if snapshot else None
+
+    def save_report_snapshot(self, pvz_id, week, version, snapshot, message_id):
+        self.report_snapshots[(pvz_id, week)] = (version, copy.deepcopy(snapshot), message_id)
+
+    def add_admin_notification(self, kind, text):
+        notification_id = self.next_id('admin_notifications')
+        self.admin_notifications[notification_id] = [notification_id, kind, text, sqlite_timestamp(), None]
+
+    def get_pending_admin_notifications(self):
+        return [
+            tuple(notification[:4])
+            for notification in self.admin_notifications.values()
+            if notification[4] is None
+        ]
+
+    def mark_admin_notifications_sent(self, notification_ids):
+        sent_at = sqlite_timestamp()
+        for notification_id in notification_ids:
+            if notification_id in self.admin_notifications:
+                self.admin_notifications[notification_id][4] = sent_at
+        # Отправленные уведомления храним неделю, как в Database
+        expired_before = (datetime.utcnow() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
+        for notification_id, notification in list(self.admin_notifications.items()):
+            if notification[4] is not None and notification[4] < expired_before:
+                del self.admin_notifications[notification_id]
+
+    # Напоминания
+
+    def get_reminder_schedule(self):
+        rows = []
+        for reminder in self.reminders.values():
+            pvz = self.pvz.get(reminder[1])
+            if pvz:
+                rows.append((*reminder, pvz[1], pvz[3], pvz[4]))
+        return rows
+
+    def get_pvz_reminders(self, pvz_id):
+        return {
+            reminder[2]: (reminder[3], reminder[4])
+            for reminder in self.reminders.values()
+            if reminder[1] == pvz_id
+        }
+
+    def set_reminder_time(self, pvz_id, kind, weekday, remind_time):
+        now = datetime.utcnow().isoformat()
+        reminder_id = self.reminder_ids.get((pvz_id, kind))
+        if reminder_id is None:
+            reminder_id = self.next_id('reminder_schedule')
+            self.reminder_ids[(pvz_id, kind)] = reminder_id
+        self.reminders[reminder_id] = [reminder_id, pvz_id, kind, weekday, remind_time, now]
+
+    def mark_reminder_run(self, reminder_id, run_at):
+        if reminder_id in self.reminders:
+            self.reminders[reminder_id][5] = run_at.isoformat()
+
+    # Состояния диалогов и аренды
+
+    def get_user_state(self, user_id):
+        state = self.user_states.get(user_id)
+        return copy.deepcopy(state) if state is not None else None
+
+    def set_user_state(self, user_id, state):
+        self.user_states[user_id] = copy.deepcopy(state)
+
+    def clear_user_state(self, user_id):
+        self.user_states.pop(user_id, None)
+
+    def acquire_lease(self, name, holder, ttl):
+        now = time.time()
+        lease = self.leases.get(name)
+        if lease and lease[0] != holder and lease[1] >= now:
+            return False
+        self.leases[name] = (holder, now + ttl)
+        return True
+
+    def release_lease(self, name, holder):
+        if self.leases.get(name, (None,))[0] == holder:
+            del self.leases[name]
+
+    # Разовые запросы
+
+    def get_read_connection(self):
+        """Копия pvz, users и schedule в базе SQLite в памяти (создается при каждом вызове)"""
+        conn = sqlite3.connect(':memory:')
+        conn.executescript('''
+            CREATE TABLE pvz (id INTEGER PRIMARY KEY, name TEXT, password TEXT, chat_id TEXT, timezone TEXT);
+            CREATE TABLE users (
+                id INTEGER PRIMARY KEY, user_id INTEGER, username TEXT, first_name TEXT,
+                pvz_id INTEGER, full_name TEXT
+            );
+            CREATE TABLE schedule (
+                id INTEGER PRIMARY KEY, user_id INTEGER, date TEXT, time_slot TEXT, created_at TIMESTAMP,
+                start_minute INTEGER, end_minute INTEGER, slot_kind TEXT, week_start TEXT
+            );
+        ''')
+        conn.executemany('INSERT INTO pvz VALUES (?, ?, ?, ?, ?)', self.pvz.values())
+        conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)', self.users.values())
+        conn.executemany('''
+            INSERT INTO schedule VALUES (
+                :id, :user_id, :date, :time_slot, :created_at,
+                :start_minute, :end_minute, :slot_kind, :week_start
+            )
+        ''', [entry for week in self.schedule_by_week.values() for entry in week.values()])
+        conn.commit()
+        conn.execute('PRAGMA query_only = ON')
+        return conn
@@ -0,0 +1,131 @@
+import html
+from itertools import accumulate
+
+# Рабочий день ПВЗ и шаг сетки покрытия (в минутах от полуночи)
+DAY_START = 9 * 60
+DAY_END = 21 * 60
+BLOCK_MINUTES = 30
+BLOCKS_PER_DAY = (DAY_END - DAY_START) // BLOCK_MINUTES
+
+WEEKDAY_SHORT_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+# Запас до лимита сообщения Telegram (4096) под хвост "… и еще N"
+MAX_TEXT_LENGTH = 4000
+
+
+def format_minutes(minutes):
+    """Минуты от полуночи -> "9:30" """
+    return f"{minutes // 60}:{minutes % 60:02d}"
+
+
+def block_start(block):
+    """Время начала блока сетки в минутах от полуночи"""
+    return DAY_START + block * BLOCK_MINUTES
+
+
+def build_coverage_matrix(dates, shifts):
+    """Матрица покрытия: для каждой даты - число сотрудников в каждом получасовом блоке.
+
+    shifts - тройки (date, start_minute, end_minute). Блок считается покрытым,
+    если смена занимает его целиком. Каждая смена добавляет +1 в начале и -1
+    в конце своего интервала (разностный массив), затем одна накопительная
+    сумма по строке дает покрытие - без перебора блоков для каждой смены.
+    """
+    date_index = {date: i for i, date in enumerate(dates)}
+    diff = [[0] * (BLOCKS_PER_DAY + 1) for _ in dates]
+
+    for date, start_minute, end_minute in shifts:
+        row = date_index.get(date)
+        if row is None:
+            continue
+        first = max(0, -(-(start_minute - DAY_START) // BLOCK_MINUTES))
+        last = min(BLOCKS_PER_DAY, (end_minute - DAY_START) // BLOCK_MINUTES)
+        if first < last:
+            diff[row][first] += 1
+            diff[row][last] -= 1
+
+    return [list(accumulate(row[:-1])) for row in diff]
+
+
+def find_uncovered_intervals(shifts, day_start=DAY_START, day_end=DAY_END):
+    """Незакрытые интервалы рабочего дня.
+
+    shifts - пары (start_minute, end_minute), отсортированные по началу смены.
+    Один проход: курсор движется до конца самой поздней из уже просмотренных
+    смен, разрыв между курсором и началом следующей смены - незакрытый интервал.
+    """
+    gaps = []
+    covered_until = day_start
+    for start_minute, end_minute in shifts:
+        if start_minute > covered_until:
+            gaps.append((covered_until, min(start_minute, day_end)))
+        covered_until = max(covered_until, end_minute)
+        if covered_until >= day_end:
+            break
+    if covered_until < day_end:
+        gaps.append((covered_until, day_end))
+    return [(start, end) for start, end in gaps if start < end]
+
+
+def find_ranges(counts, predicate):
+    """Непрерывные участки блоков, для которых predicate(count) истинно.
+
+    Возвращает тройки (первый блок, блок после последнего, максимум сотрудников на участке).
+    """
+    ranges = []
+    start = None
+    for block, count in enumerate(counts + [None]):
+        matches = count is not None and predicate(count)
+        if matches and start is None:
+            start = block
+        elif not matches and start is not None:
+            ranges.append((start, block, max(counts[start:block])))
+            start = None
+    return ranges
+
+
+def render_coverage_grid(pvz_name, dates, matrix, as_needed_counts, min_staff, max_staff):
+    """Текстовая сетка покрытия (HTML для parse_mode='HTML').
+
+    Строка - день, символ - получасовой блок: цифра - число сотрудников,
+    "." - никого. Ниже перечислены участки с нехваткой и избытком сотрудников.
+    """
+    header = "".join(f"{hour:<4}" for hour in range(DAY_START // 60, DAY_END // 60, 2))
+    lines = [f"{'':9}{header}"]
+    problems = []
+
+    for i, (date, counts) in enumerate(zip(dates, matrix)):
+        cells = "".join("." if count == 0 else (str(count) if count < 10 else "+") for count in counts)
+        day_label = f"{WEEKDAY_SHORT_NAMES[i % 7]} {date}"
+        as_needed = f" +{as_needed_counts[i]}" if as_needed_counts[i] else ""
+        lines.append(f"{day_label:<9}{cells}{as_needed}")
+
+        for first, last, peak in find_ranges(counts, lambda count: count < min_staff):
+            problems.append(
+                f"⚠️ {day_label} {format_minutes(block_start(first))}-{format_minutes(block_start(last))}: "
+                f"{'никого' if peak == 0 else f'до {peak} чел.'}"
+            )
+        for first, last, peak in find_ranges(counts, lambda count: count > max_staff):
+            problems.append(
+                f"🔺 {day_label} {format_minutes(block_start(first))}-{format_minutes(block_start(last))}: "
+                f"до {peak} чел."
+            )
+
+    text = f"🧮 Покрытие смен\nПВЗ: {html.escape(pvz_name)}\nПериод: {dates[0]} - {dates[-1]}\n\n"
+    text += "<pre>" + html.escape("\n".join(lines)) + "</pre>\n"
+    text += "Цифра - сотрудников в получасе, «.» - никого, +N - «Как нужно ПВЗ».\n"
+    text += f"Норма: {min_staff}-{max_staff} чел.\n\n"
+
+    if problems:
+        # Сообщение должно уложиться в лимит Telegram
+        shown = []
+        for problem in problems:
+            if len(text) + sum(len(line) + 1 for line in shown) + len(problem) > MAX_TEXT_LENGTH:
+                break
+            shown.append(problem)
+        text += "\n".join(shown)
+        if len(shown) < len(problems):
+            text += f"\n… и еще {len(problems) - len(shown)}"
+    else:
+        text += "✅ Все получасы укомплектованы в пределах нормы"
+    return text
@@ -0,0 +1,227 @@
+from abc import ABC, abstractmethod
+
+
+class Storage(ABC):
+    """Хранилище данных бота - все, что нужно обработчикам.
+
+    Реализации: Database (SQLite, database.py) и MemoryStorage (словари в
+    памяти процесса, memory_storage.py - для тестов и замеров). Строки
+    возвращаются кортежами с тем же порядком полей, что у SQLite-реализации,
+    поэтому обработчики не зависят от выбранного хранилища.
+    """
+
+    def ensure_schema(self):
+        """Подготовить хранилище к работе (для SQLite - проверить схему)"""
+
+    # ПВЗ
+
+    @abstractmethod
+    def get_pvz_by_password(self, password):
+        """ПВЗ по паролю: (id, name, password, chat_id, timezone) или None"""
+
+    @abstractmethod
+    def get_pvz_by_id(self, pvz_id):
+        """ПВЗ по ID: (id, name, password, chat_id, timezone) или None"""
+
+    @abstractmethod
+    def get_all_pvz(self):
+        """Все ПВЗ: [(id, name, password, chat_id, timezone), ...]"""
+
+    @abstractmethod
+    def set_pvz_chat_id(self, pvz_id, chat_id):
+        """Установить чат ПВЗ для напоминаний"""
+
+    @abstractmethod
+    def set_pvz_timezone(self, pvz_id, timezone_name):
+        """Установить часовой пояс ПВЗ"""
+
+    @abstractmethod
+    def get_pvz_chat_id(self, pvz_id):
+        """Чат ПВЗ или None"""
+
+    # Пользователи
+
+    @abstractmethod
+    def add_user(self, user_id, username, first_name, pvz_id, full_name=None):
+        """Зарегистрировать (или перерегистрировать) пользователя"""
+
+    @abstractmethod
+    def get_user(self, user_id):
+        """Пользователь: (id, user_id, username, first_name, pvz_id, full_name, pvz_name, pvz_timezone) или None"""
+
+    @abstractmethod
+    def get_all_users(self):
+        """Все пользователи в формате get_user"""
+
+    @abstractmethod
+    def get_filled_user_ids(self, pvz_id, week_dates):
+        """Множество user_id ПВЗ, у которых есть расписание хотя бы на один из дней week_dates"""
+
+    @abstractmethod
+    def import_pvz_and_users(self, pvz_rows, user_rows):
+        """Загрузить ПВЗ и сотрудников целиком или никак: (статистика или None, ошибки)"""
+
+    # Расписание
+
+    @abstractmethod
+    def save_week_schedule(self, user_id, answers):
+        """Записать ответы анкеты {дата: время} и удалить черновик"""
+
+    @abstractmethod
+    def get_user_schedule(self, user_id, week_dates):
+        """Расписание пользователя на даты "дд.мм" ближайших недель: {дата: время}"""
+
+    @abstractmethod
+    def get_user_week_schedule(self, user_id, week_start):
+        """({дата: время} недели week_start, предыдущая неделя с записями, следующая неделя с записями)"""
+
+    @abstractmethod
+    def get_user_previous_week(self, user_id, week_start):
+        """Последняя неделя с записями до week_start или None"""
+
+    @abstractmethod
+    def copy_previous_week(self, user_id, week_start):
+        """Скопировать последнюю заполненную неделю на week_start: (исходная неделя или None, число дней)"""
+
+    @abstractmethod
+    def get_pvz_schedule_report(self, pvz_id, week_dates):
+        """Записи ПВЗ на даты: [(first_name, username, user_id, date, time_slot, full_name,
+        slot_kind, start_minute, end_minute), ...] по дате и началу смены"""
+
+    @abstractmethod
+    def get_pvz_schedule_version(self, pvz_id, week_dates):
+        """Строка, которая меняется при любом изменении отчета ПВЗ на эти даты:
+        записей расписания, названия ПВЗ или имен сотрудников с записями"""
+
+    @abstractmethod
+    def get_pvz_stats(self, pvz_id, week_dates):
+        """(число сотрудников ПВЗ, сколько из них заполнили расписание на эти даты)"""
+
+    @abstractmethod
+    def get_pvz_shifts(self, pvz_id, dates, start_minute=0, end_minute=24 * 60, slot_kinds=('shift',)):
+        """Записи ПВЗ, пересекающие интервал: [(user_id, full_name, first_name, username,
+        date, slot_kind, start_minute, end_minute), ...] по дате и началу смены.
+        По умолчанию - только смены со временем (SLOT_SHIFT)"""
+
+    @abstractmethod
+    def get_pvz_coverage_at(self, pvz_id, date, minute):
+        """Кто из сотрудников ПВЗ на смене в момент minute (минуты от полуночи) даты date:
+        строки get_pvz_shifts"""
+
+    # Журнал изменений расписания
+
+    @abstractmethod
+    def get_schedule_changes(self, after_id=0, limit=500):
+        """Изменения расписания с id > after_id по порядку: [(id, operation, schedule_id,
+        user_id, date, time_slot, changed_at), ...], operation - 'insert' или 'delete'"""
+
+    @abstractmethod
+    def get_change_cursor(self, consumer):
+        """Последний обработанный читателем consumer id изменения (0 - ничего не обработано)"""
+
+    @abstractmethod
+    def set_change_cursor(self, consumer, change_id):
+        """Сохранить позицию читателя журнала изменений"""
+
+    @abstractmethod
+    def delete_old_schedule_changes(self, max_age_days):
+        """Удалить записи журнала старше max_age_days, вернуть их количество"""
+
+    @abstractmethod
+    def read_new_schedule_changes(self, consumer, limit=500):
+        """Изменения, которые читатель consumer еще не обработал (позиция не сдвигается)"""
+
+    # Черновики анкет
+
+    @abstractmethod
+    def get_form_draft(self, user_id, max_age_hours):
+        """Черновик не старше max_age_hours: (неделя, {дата: время}, single_day) или None"""
+
+    @abstractmethod
+    def save_form_drafts(self, drafts):
+        """Сохранить черновики [(user_id, неделя, ответы, single_day)] одной транзакцией"""
+
+    @abstractmethod
+    def delete_expired_form_drafts(self, max_age_hours):
+        """Удалить черновики старше max_age_hours, вернуть их количество"""
+
+    # Отчеты администратору
+
+    @abstractmethod
+    def refresh_fill_summary(self, pvz_id, since_week, before_week, utc_offset):
+        """Подсчитать итоги заполнения завершенных недель ПВЗ с since_week до before_week
+        (все недели по календарю, только еще не подсчитанные), вернуть число строк
+        сотрудник - неделя"""
+
+    @abstractmethod
+    def get_fill_analytics(self, pvz_id, since_week, live_weeks, utc_offset, min_missed):
+        """([(неделя, сотрудников, заполнили, медиана минут до заполнения), ...],
+        [(user_id, full_name, first_name, username, пропущено, недель, пропущено подряд), ...])"""
+
+    @abstractmethod
+    def get_report_snapshot(self, pvz_id, week):
+        """Последний отправленный отчет: (version, snapshot, message_id) или None"""
+
+    @abstractmethod
+    def save_report_snapshot(self, pvz_id, week, version, snapshot, message_id):
+        """Запомнить отправленный отчет"""
+
+    @abstractmethod
+    def add_admin_notification(self, kind, text):
+        """Поставить уведомление администратору в очередь"""
+
+    @abstractmethod
+    def get_pending_admin_notifications(self):
+        """Неотправленные уведомления по порядку: [(id, kind, text, created_at), ...]"""
+
+    @abstractmethod
+    def mark_admin_notifications_sent(self, notification_ids):
+        """Отметить уведомления как отправленные"""
+
+    # Напоминания
+
+    @abstractmethod
+    def get_reminder_schedule(self):
+        """Напоминания всех ПВЗ: [(id, pvz_id, kind, weekday, remind_time, last_run_at,
+        name, chat_id, timezone), ...]"""
+
+    @abstractmethod
+    def get_pvz_reminders(self, pvz_id):
+        """Напоминания ПВЗ: {тип: (день недели, время)}"""
+
+    @abstractmethod
+    def set_reminder_time(self, pvz_id, kind, weekday, remind_time):
+        """Установить день недели и время напоминания ПВЗ"""
+
+    @abstractmethod
+    def mark_reminder_run(self, reminder_id, run_at):
+        """Запомнить время запуска напоминания (UTC)"""
+
+    # Состояния диалогов и аренды
+
+    @abstractmethod
+    def get_user_state(self, user_id):
+        """Состояние диалога пользователя (словарь) или None"""
+
+    @abstractmethod
+    def set_user_state(self, user_id, state):
+        """Сохранить состояние диалога пользователя"""
+
+    @abstractmethod
+    def clear_user_state(self, user_id):
+        """Удалить состояние диалога пользователя"""
+
+    @abstractmethod
+    def acquire_lease(self, name, holder, ttl):
+        """Взять или продлить аренду на ttl секунд; True - аренда принадлежит holder"""
+
+    @abstractmethod
+    def release_lease(self, name, holder):
+        """Освободить аренду, если она принадлежит holder"""
+
+    # Разовые запросы
+
+    @abstractmethod
+    def get_read_connection(self):
+        """Соединение sqlite3 только для чтения с таблицами pvz, users и schedule
+        в схеме Database - для разовых запросов, которых нет среди методов"""
@@ -0,0 +1,19 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import Database  # noqa: E402
+from memory_storage import MemoryStorage  # noqa: E402
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def storage(request, tmp_path):
+    """Каждый тест хранилища выполняется для обеих реализаций"""
+    if request.param == 'memory':
+        return MemoryStorage()
+    db = Database(str(tmp_path / 'test.db'))
+    db.ensure_schema()
+    return db
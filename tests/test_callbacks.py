@@ -0,0 +1,35 @@
+from datetime import datetime, timezone
+
+from telegram import CallbackQuery, Chat, InaccessibleMessage, InlineKeyboardButton, InlineKeyboardMarkup, Message, User
+
+from bot import get_callback_key
+
+USER = User(10, 'Иван', False)
+CHAT = Chat(10, 'private')
+EDITED_AT = datetime(2026, 10, 19, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def build_query(message, data='mysched_2026-10-12'):
+    return CallbackQuery('1', USER, 'instance', message=message, data=data)
+
+
+def build_message(text, week):
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Раньше", callback_data=f'mysched_{week}')]])
+    return Message(5, EDITED_AT, CHAT, text=text, reply_markup=markup, edit_date=EDITED_AT)
+
+
+def test_inaccessible_message():
+    query = build_query(InaccessibleMessage(CHAT, 5))
+    assert get_callback_key(query) == (10, 'mysched_2026-10-12')
+
+
+def test_same_message_version_gives_same_key():
+    first = get_callback_key(build_query(build_message("Неделя 19.10", '2026-10-12')))
+    second = get_callback_key(build_query(build_message("Неделя 19.10", '2026-10-12'), 'mysched_2026-10-26'))
+    assert first == second
+
+
+def test_edits_within_one_second_give_different_keys():
+    first = get_callback_key(build_query(build_message("Неделя 19.10", '2026-10-12')))
+    second = get_callback_key(build_query(build_message("Неделя 12.10", '2026-10-05')))
+    assert first != second
@@ -0,0 +1,63 @@
+import sqlite3
+
+import pytest
+
+import bot
+from database import Database
+
+TIME_SLOTS = ['9.00-15.00', '15.00-21.00', 'Выходной', '9.00-21.00', 'Как нужно ПВЗ', 'Выходной', '10.00-12.00']
+
+
+class CountingConnection(sqlite3.Connection):
+    """Соединение, считающее завершенные транзакции записи"""
+    commits = 0
+
+    def commit(self):
+        if self.in_transaction:
+            CountingConnection.commits += 1
+        super().commit()
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    database = Database(str(tmp_path / 'test.db'))
+    database.ensure_schema()
+    database.add_user(10, 'ivan', 'Иван', 1)
+    monkeypatch.setattr(database, 'get_connection', lambda: sqlite3.connect(database.db_name, factory=CountingConnection))
+    monkeypatch.setattr(bot, 'db', database)
+    monkeypatch.setattr(bot, 'form_drafts', {})
+    CountingConnection.commits = 0
+    return database
+
+
+def week_dates():
+    return bot.get_target_week_dates(bot.DEFAULT_TIMEZONE)
+
+
+def test_form_is_one_transaction(db):
+    dates = week_dates()
+    bot.start_form_draft(10, dates)
+    for day, time_slot in zip(dates, TIME_SLOTS):
+        bot.record_form_answer(10, dates, day, time_slot)
+    assert bot.commit_form_draft(10, dates)
+
+    assert CountingConnection.commits == 1
+    assert db.get_user_schedule(10, dates) == dict(zip(dates, TIME_SLOTS))
+
+
+def test_dirty_drafts_are_flushed_in_one_transaction(db):
+    dates = week_dates()
+    db.add_user(20, 'petr', 'Петр', 1)
+    CountingConnection.commits = 0
+    bot.start_form_draft(10, dates)
+    bot.record_form_answer(10, dates, dates[0], TIME_SLOTS[0])
+    bot.start_day_edit(20, dates, 3)
+
+    assert bot.save_dirty_form_drafts() == 2
+    assert bot.save_dirty_form_drafts() == 0
+    assert CountingConnection.commits == 1
+
+    # После перезапуска черновик восстанавливается из базы
+    bot.form_drafts.clear()
+    assert bot.get_form_draft(10, dates)['answers'] == {dates[0]: TIME_SLOTS[0]}
+    assert bot.get_form_draft(20, dates)['single_day'] == 3
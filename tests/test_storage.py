@@ -0,0 +1,326 @@
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+from database import SLOT_AS_NEEDED, SLOT_SHIFT, UserCache, get_week_start, parse_time_slot
+from memory_storage import MemoryStorage
+
+PVZ_ID = 1
+
+
+def week(offset=0):
+    """Даты "дд.мм" и понедельник ГГГГ-ММ-ДД недели через offset недель от текущей"""
+    monday = date.today() - timedelta(days=date.today().weekday()) + timedelta(weeks=offset)
+    return [(monday + timedelta(days=i)).strftime('%d.%m') for i in range(7)], monday.isoformat()
+
+
+def add_schedule_row(storage, user_id, day_month, time_slot, week_start):
+    """Запись расписания на неделю week_start в обход get_week_start (например, прошлогодняя)"""
+    if isinstance(storage, MemoryStorage):
+        storage.insert_schedule(user_id, day_month, time_slot, week_start)
+        return
+    conn = sqlite3.connect(storage.db_name)
+    conn.execute('''
+        INSERT INTO schedule (user_id, date, time_slot, slot_kind, start_minute, end_minute, week_start)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, day_month, time_slot, *parse_time_slot(time_slot), week_start))
+    conn.commit()
+    conn.close()
+
+
+def set_registered_at(storage, user_id, registered_at):
+    """Время регистрации сотрудника в ПВЗ (строка UTC, как CURRENT_TIMESTAMP)"""
+    if isinstance(storage, MemoryStorage):
+        storage.registered_at[user_id] = registered_at
+        return
+    conn = sqlite3.connect(storage.db_name)
+    conn.execute('UPDATE users SET registered_at = ? WHERE user_id = ?', (registered_at, user_id))
+    conn.commit()
+    conn.close()
+
+
+def set_change_time(storage, change_id, changed_at):
+    """Перенести запись журнала изменений в прошлое"""
+    if isinstance(storage, MemoryStorage):
+        storage.schedule_changes = [
+            change[:6] + (changed_at,) if change[0] == change_id else change
+            for change in storage.schedule_changes
+        ]
+        return
+    conn = sqlite3.connect(storage.db_name)
+    conn.execute('UPDATE schedule_changes SET changed_at = ? WHERE id = ?', (changed_at, change_id))
+    conn.commit()
+    conn.close()
+
+
+def test_initial_pvz(storage):
+    pvz = storage.get_pvz_by_password('1525')
+    assert pvz[:3] == (PVZ_ID, 'Промышленная_6', '1525')
+    assert storage.get_pvz_by_id(PVZ_ID) == pvz
+    assert storage.get_all_pvz() == [pvz]
+    assert storage.get_pvz_by_password('0000') is None
+
+    storage.set_pvz_chat_id(PVZ_ID, -100)
+    storage.set_pvz_timezone(PVZ_ID, 'Europe/Moscow')
+    assert storage.get_pvz_chat_id(PVZ_ID) == '-100'
+    assert storage.get_pvz_by_id(PVZ_ID)[4] == 'Europe/Moscow'
+
+
+def test_user_rows(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID, 'Иванов Иван')
+    assert storage.get_user(10)[1:] == (10, 'ivan', 'Иван', PVZ_ID, 'Иванов Иван', 'Промышленная_6', 'Asia/Barnaul')
+    assert storage.get_all_users() == [storage.get_user(10)]
+    assert storage.get_user(11) is None
+
+
+def test_user_cache(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID, 'Иванов Иван')
+    storage.add_user(20, 'petr', 'Петр', PVZ_ID, 'Петров Петр')
+    cache = UserCache(storage, ttl=60)
+    assert cache.get_all_pvz() == storage.get_all_pvz()
+    assert cache.get_user(10) == storage.get_user(10)
+    # Строки пользователей ссылаются на название ПВЗ из строки ПВЗ, а не на копии
+    assert cache.get_user(10)[6] is cache.get_user(20)[6] is cache.pvz[PVZ_ID][1]
+    assert cache.get_memory_size() > 0
+
+    storage.set_pvz_chat_id(PVZ_ID, -100)
+    cache.invalidate()
+    assert cache.get_all_pvz() == storage.get_all_pvz()
+
+
+def test_week_schedule_navigation(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID)
+    previous_dates, previous_week = week(-1)
+    dates, week_start = week(1)
+    storage.save_week_schedule(10, {previous_dates[0]: '9.00-15.00'})
+    storage.save_week_schedule(10, {dates[0]: 'Выходной', dates[1]: '15.00-21.00'})
+
+    assert storage.get_user_schedule(10, dates) == {dates[0]: 'Выходной', dates[1]: '15.00-21.00'}
+    assert storage.get_user_week_schedule(10, week_start) == (
+        {dates[0]: 'Выходной', dates[1]: '15.00-21.00'}, previous_week, None
+    )
+    assert storage.get_user_week_schedule(10, previous_week)[1:] == (None, week_start)
+    assert storage.get_user_previous_week(10, week_start) == previous_week
+
+
+def test_copy_previous_week(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID)
+    previous_dates, previous_week = week(0)
+    dates, week_start = week(1)
+    storage.save_week_schedule(10, {previous_dates[0]: '9.00-15.00', previous_dates[6]: 'Как нужно ПВЗ'})
+    storage.save_form_drafts([(10, 'черновик', {}, None)])
+
+    assert storage.copy_previous_week(10, week_start) == (previous_week, 2)
+    assert storage.get_user_schedule(10, dates) == {dates[0]: '9.00-15.00', dates[6]: 'Как нужно ПВЗ'}
+    assert storage.get_form_draft(10, 48) is None
+    assert storage.copy_previous_week(20, week_start) == (None, 0)
+
+
+def test_pvz_reports(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID, 'Иванов')
+    storage.add_user(11, 'petr', 'Петр', PVZ_ID, 'Петров')
+    dates, week_start = week(1)
+    storage.save_week_schedule(10, {dates[0]: '9.00-15.00'})
+    storage.save_week_schedule(11, {dates[0]: 'Как нужно ПВЗ', dates[1]: '12.00-18.00'})
+
+    assert storage.get_pvz_stats(PVZ_ID, dates) == (2, 2)
+    assert storage.get_filled_user_ids(PVZ_ID, dates) == {10, 11}
+    report = storage.get_pvz_schedule_report(PVZ_ID, dates)
+    assert [(row[2], row[3], row[4]) for row in report] == [
+        (10, dates[0], '9.00-15.00'), (11, dates[0], 'Как нужно ПВЗ'), (11, dates[1], '12.00-18.00'),
+    ]
+    assert storage.get_pvz_shifts(PVZ_ID, dates) == [
+        (10, 'Иванов', 'Иван', 'ivan', dates[0], SLOT_SHIFT, 540, 900),
+        (11, 'Петров', 'Петр', 'petr', dates[1], SLOT_SHIFT, 720, 1080),
+    ]
+    assert [row[0] for row in storage.get_pvz_shifts(PVZ_ID, dates, slot_kinds=(SLOT_AS_NEEDED,))] == [11]
+    assert [row[0] for row in storage.get_pvz_coverage_at(PVZ_ID, dates[0], 600)] == [10]
+    assert storage.get_pvz_coverage_at(PVZ_ID, dates[0], 900) == []
+
+    version = storage.get_pvz_schedule_version(PVZ_ID, dates)
+    storage.save_week_schedule(10, {dates[0]: '10.00-15.00'})
+    assert storage.get_pvz_schedule_version(PVZ_ID, dates) != version
+
+
+def test_report_version_tracks_names(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID, 'Иванов')
+    dates, week_start = week(1)
+    storage.save_week_schedule(10, {dates[0]: '9.00-15.00'})
+    version = storage.get_pvz_schedule_version(PVZ_ID, dates)
+    assert storage.get_pvz_schedule_version(PVZ_ID, dates) == version
+
+    # Сотрудник без записей на неделю в отчет не попадает
+    storage.add_user(11, 'petr', 'Петр', PVZ_ID, 'Петров')
+    assert storage.get_pvz_schedule_version(PVZ_ID, dates) == version
+
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID, 'Иванов Иван')
+    renamed_user = storage.get_pvz_schedule_version(PVZ_ID, dates)
+    assert renamed_user != version
+
+    if isinstance(storage, MemoryStorage):
+        storage.pvz[PVZ_ID][1] = 'Промышленная_6а'
+    else:
+        conn = sqlite3.connect(storage.db_name)
+        conn.execute('UPDATE pvz SET name = ? WHERE id = ?', ('Промышленная_6а', PVZ_ID))
+        conn.commit()
+        conn.close()
+    assert storage.get_pvz_schedule_version(PVZ_ID, dates) != renamed_user
+
+
+def test_same_day_month_from_previous_year_is_ignored(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID)
+    dates, week_start = week(1)
+    last_year = date.fromisoformat(get_week_start(dates[0])) - timedelta(weeks=52)
+    add_schedule_row(storage, 10, dates[0], '9.00-15.00', last_year.isoformat())
+
+    assert storage.get_pvz_stats(PVZ_ID, dates) == (1, 0)
+    assert storage.get_filled_user_ids(PVZ_ID, dates) == set()
+    storage.save_week_schedule(10, {dates[0]: '10.00-12.00'})
+    assert [row[4] for row in storage.get_pvz_schedule_report(PVZ_ID, dates)] == ['10.00-12.00']
+    assert len(storage.get_pvz_shifts(PVZ_ID, dates)) == 1
+
+
+def test_form_draft(storage):
+    storage.save_form_drafts([(10, 'неделя', {'01.01': 'Выходной'}, 3), (20, 'неделя', {}, None)])
+    assert storage.get_form_draft(10, 48) == ('неделя', {'01.01': 'Выходной'}, 3)
+    storage.save_form_drafts([(10, 'неделя', {}, None)])
+    assert storage.get_form_draft(10, 48) == ('неделя', {}, None)
+    assert storage.delete_expired_form_drafts(0) == 2
+    assert storage.get_form_draft(10, 48) is None
+
+
+def test_schedule_change_log(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID)
+    dates, week_start = week(1)
+    storage.save_week_schedule(10, {dates[0]: '9.00-15.00'})
+    storage.save_week_schedule(10, {dates[0]: 'Выходной'})
+
+    changes = storage.read_new_schedule_changes('тест')
+    assert [(change[1], change[3], change[4], change[5]) for change in changes] == [
+        ('insert', 10, dates[0], '9.00-15.00'),
+        ('delete', 10, dates[0], '9.00-15.00'),
+        ('insert', 10, dates[0], 'Выходной'),
+    ]
+    assert storage.get_schedule_changes(changes[0][0], limit=1) == changes[1:2]
+
+    storage.set_change_cursor('тест', changes[-1][0])
+    assert storage.get_change_cursor('тест') == changes[-1][0]
+    assert storage.read_new_schedule_changes('тест') == []
+
+
+def test_old_schedule_changes_are_deleted(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID)
+    dates, week_start = week(1)
+    storage.save_week_schedule(10, {dates[0]: '9.00-15.00'})
+    storage.save_week_schedule(10, {dates[0]: 'Выходной'})
+    old_change_id = storage.get_schedule_changes()[0][0]
+    set_change_time(storage, old_change_id, '2000-01-01 00:00:00')
+
+    assert storage.delete_old_schedule_changes(90) == 1
+    assert [change[0] for change in storage.get_schedule_changes()] == [old_change_id + 1, old_change_id + 2]
+    assert storage.delete_old_schedule_changes(90) == 0
+
+
+def test_read_connection(storage):
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID)
+    dates, week_start = week(1)
+    storage.save_week_schedule(10, {dates[0]: '9.00-15.00'})
+
+    conn = storage.get_read_connection()
+    try:
+        assert conn.execute('''
+            SELECT p.name, u.user_id, s.date, s.slot_kind, s.week_start
+            FROM schedule s JOIN users u ON u.user_id = s.user_id JOIN pvz p ON p.id = u.pvz_id
+        ''').fetchall() == [('Промышленная_6', 10, dates[0], SLOT_SHIFT, week_start)]
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute('DELETE FROM schedule')
+    finally:
+        conn.close()
+
+
+def test_reminders(storage):
+    reminders = storage.get_pvz_reminders(PVZ_ID)
+    assert reminders == {'saturday': (5, '09:00'), 'sunday': (6, '09:00'), 'gaps': (6, '18:00')}
+
+    storage.set_reminder_time(PVZ_ID, 'saturday', 4, '18:30')
+    assert storage.get_pvz_reminders(PVZ_ID)['saturday'] == (4, '18:30')
+    rows = storage.get_reminder_schedule()
+    assert len(rows) == 3 and all(row[6] == 'Промышленная_6' for row in rows)
+
+
+def test_admin_notifications(storage):
+    storage.add_admin_notification('report', 'первое')
+    storage.add_admin_notification('report', 'второе')
+    pending = storage.get_pending_admin_notifications()
+    assert [row[2] for row in pending] == ['первое', 'второе']
+
+    storage.mark_admin_notifications_sent([pending[0][0]])
+    assert [row[2] for row in storage.get_pending_admin_notifications()] == ['второе']
+
+
+def test_user_state_and_leases(storage):
+    storage.set_user_state(10, {'state': 'waiting_password'})
+    assert storage.get_user_state(10) == {'state': 'waiting_password'}
+    storage.clear_user_state(10)
+    assert storage.get_user_state(10) is None
+
+    assert storage.acquire_lease('scheduler', 'a', 60)
+    assert not storage.acquire_lease('scheduler', 'b', 60)
+    storage.release_lease('scheduler', 'a')
+    assert storage.acquire_lease('scheduler', 'b', 60)
+
+
+def test_import(storage):
+    stats, errors = storage.import_pvz_and_users(
+        {'Ленина_1': ('2000', None)},
+        [(10, 'ivan', 'Иванов', 'Ленина_1'), (11, None, 'Петров', 'Промышленная_6')],
+    )
+    assert errors == []
+    assert stats == {'pvz_created': 1, 'pvz_updated': 0, 'users_created': 2, 'users_updated': 0}
+    assert storage.get_user(10)[6] == 'Ленина_1'
+    assert storage.get_pvz_reminders(storage.get_pvz_by_password('2000')[0])
+
+    stats, errors = storage.import_pvz_and_users({'Гагарина_2': ('2000', None)}, [(12, None, None, 'Нет_ПВЗ')])
+    assert stats is None and len(errors) == 2
+    assert storage.get_user(12) is None
+
+
+def test_fill_analytics_mid_history_hire(storage):
+    weeks = [week(offset) for offset in range(-6, 2)]
+    since_week, live_weeks = weeks[0][1], [weeks[-2][1], weeks[-1][1]]
+    long_ago = (date.fromisoformat(since_week) - timedelta(weeks=10)).isoformat() + ' 12:00:00'
+    # Старые сотрудники: 10 заполняет каждую неделю, 11 - никогда
+    for user_id in (10, 11):
+        storage.add_user(user_id, None, 'Старый', PVZ_ID, f'Сотрудник {user_id}')
+        set_registered_at(storage, user_id, long_ago)
+    for dates, week_start in weeks:
+        storage.save_week_schedule(10, {dates[0]: '9.00-15.00'})
+    # Новый сотрудник пришел на прошлой неделе и заполнил текущую и следующую
+    storage.add_user(12, None, 'Новый', PVZ_ID, 'Сотрудник 12')
+    set_registered_at(storage, 12, weeks[-3][1] + ' 12:00:00')
+    for dates, week_start in weeks[-2:]:
+        storage.save_week_schedule(12, {dates[0]: 'Выходной'})
+
+    assert storage.refresh_fill_summary(PVZ_ID, since_week, live_weeks[0], 420) == 12
+    assert storage.refresh_fill_summary(PVZ_ID, since_week, live_weeks[0], 420) == 0
+    rows, non_fillers = storage.get_fill_analytics(PVZ_ID, since_week, live_weeks, 420, 3)
+
+    assert [(row[0], row[1], row[2]) for row in rows] == (
+        [(week_start, 2, 1) for dates, week_start in weeks[:-2]]
+        + [(week_start, 3, 2) for week_start in live_weeks]
+    )
+    assert [(row[0], row[4], row[5], row[6]) for row in non_fillers] == [(11, 6, 6, 6)]
+
+
+def test_reregistration_keeps_registered_at_within_pvz(storage):
+    storage.add_user(10, None, 'Иван', PVZ_ID)
+    set_registered_at(storage, 10, '2020-01-01 00:00:00')
+    storage.add_user(10, 'ivan', 'Иван', PVZ_ID)
+    storage.import_pvz_and_users({}, [(10, None, 'Иванов', 'Промышленная_6')])
+    rows, non_fillers = storage.get_fill_analytics(PVZ_ID, '2020-01-06', ['2020-01-06'], 0, 1)
+    assert rows == [('2020-01-06', 1, 0, None)]
+
+    storage.import_pvz_and_users({'Ленина_1': ('2000', None)}, [(10, None, None, 'Ленина_1')])
+    new_pvz_id = storage.get_pvz_by_password('2000')[0]
+    assert storage.get_fill_analytics(new_pvz_id, '2020-01-06', ['2020-01-06'], 0, 1) == ([], [])
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+import bot
+from bot import ADMIN_CHAT_ID, BUSY_TEXT, PerChatUpdateProcessor
+
+SENT_AT = datetime(2026, 10, 19, 12, 0, 0, tzinfo=timezone.utc)
+
+
+class FakeBot:
+    def __init__(self):
+        self.answers = []
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def build_message_update(update_id, user_id):
+    user = User(user_id, 'Иван', False)
+    message = Message(update_id, SENT_AT, Chat(user_id, 'private'), from_user=user, text='/myschedule')
+    return Update(update_id, message=message)
+
+
+def build_callback_update(update_id, user_id, bot):
+    user = User(user_id, 'Иван', False)
+    message = Message(update_id, SENT_AT, Chat(user_id, 'private'), text='Неделя 19.10')
+    query = CallbackQuery(str(update_id), user, 'instance', message=message, data='mysched_2026-10-12')
+    query.set_bot(bot)
+    return Update(update_id, callback_query=query)
+
+
+def test_updates_of_one_chat_keep_order():
+    async def scenario():
+        processor = PerChatUpdateProcessor(4)
+        handled = []
+
+        async def handle(name, delay):
+            await asyncio.sleep(delay)
+            handled.append(name)
+
+        await asyncio.gather(
+            processor.process_update(build_message_update(1, 10), handle('first', 0.02)),
+            processor.process_update(build_message_update(2, 10), handle('second', 0)),
+        )
+        return handled
+
+    assert asyncio.run(scenario()) == ['first', 'second']
+
+
+def test_overload_sheds_employees_but_not_admin():
+    async def scenario():
+        processor = PerChatUpdateProcessor(2, max_pending_updates=1)
+        bot = FakeBot()
+        release = asyncio.Event()
+        handled = []
+
+        async def handle(name, wait=False):
+            if wait:
+                await release.wait()
+            handled.append(name)
+
+        blocker = asyncio.create_task(
+            processor.process_update(build_message_update(1, 10), handle('blocker', wait=True))
+        )
+        await asyncio.sleep(0)
+        await processor.process_update(build_callback_update(2, 20, bot), handle('employee'))
+        await processor.process_update(build_message_update(3, int(ADMIN_CHAT_ID)), handle('admin'))
+        release.set()
+        await blocker
+        return processor, bot, handled
+
+    processor, bot, handled = asyncio.run(scenario())
+    assert handled == ['admin', 'blocker']
+    assert bot.answers == [BUSY_TEXT]
+    assert processor.get_metrics()['shed'] == 1
+    assert processor.get_metrics()['pending'] == 0
+
+
+def test_slow_update_is_logged_as_warning(monkeypatch, caplog):
+    async def handle():
+        pass
+
+    async def scenario(update_id):
+        await PerChatUpdateProcessor(2).process_update(build_message_update(update_id, 10), handle())
+
+    with caplog.at_level(logging.DEBUG):
+        asyncio.run(scenario(1))
+        monkeypatch.setattr(bot, 'SLOW_UPDATE_MS', 0)
+        asyncio.run(scenario(2))
+
+    fast, slow = [record for record in caplog.records if hasattr(record, 'duration_ms')]
+    assert fast.levelno == logging.DEBUG
+    assert slow.levelno == logging.WARNING